@@ -1,8 +1,5 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
-from __future__ import absolute_import
-from __future__ import print_function
-
 import io
 import re
 from glob import glob
@@ -49,11 +46,8 @@ setup(
         'Operating System :: POSIX',
         'Operating System :: Microsoft :: Windows',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: Implementation :: CPython',
         'Programming Language :: Python :: Implementation :: PyPy',
@@ -71,10 +65,10 @@ setup(
     keywords=[
         'machine learning', 'data', 'download', 'life science', 'training', 'validation'
     ],
-    python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*',
-    #python_requires='>=3.4, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*',
+    # zipfile compression levels, streamed zip members and the served folder of the test server need python 3.7
+    python_requires='>=3.7',
     install_requires=[
-        'requests>=2.20.0', 'beautifulsoup4>=4.7.1', 'tifffile>=2019.3.8', 'numpy>=1.11.3', 'six>=1.11.0', 'tqdm>=4.31.1'
+        'requests>=2.20.0', 'beautifulsoup4>=4.7.1', 'tifffile>=2019.3.8', 'numpy>=1.11.3', 'tqdm>=4.31.1'
     ],
     extras_require={
         # eg:
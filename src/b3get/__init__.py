@@ -1,3 +1,3 @@
 __version__ = '0.4.1'
 
-from b3get.api import to_numpy
+from b3get.api import to_numpy, to_numpy_many, load, prefetch
@@ -1,27 +1,126 @@
 import os
-from b3get.datasets import *
+import numpy as np
+from b3get.utils import filter_files, check_conversion
+from b3get.stores import shard_basename, shard_sequence
+from b3get.datasets import get_dataset, dataset_number, REGISTRY, pull_many, stage_files, prefetch_handle
 
 
-def to_numpy(dataset_id=None, labels_match='foreground'):
+def _create_dataset(dataset_id):
+    """ return the dataset of ID <dataset_id> (see datasets.get_dataset), None if that fails """
+    try:
+        if dataset_number(dataset_id) not in REGISTRY:
+            print('support for BBBC{0:03} planned, but not thoroughly tested yet'.format(dataset_number(dataset_id)))
+        return get_dataset(dataset_id)
+    except Exception as ex:
+        print('unable to create dataset from', dataset_id, ex)
+        return None
+
+
+def _dataset_to_numpy(ds, labels_match='foreground', pages=None, roi=None,
+                      dtype=None, scaling=None, downcast_labels=False, max_memory=None, spill_dir=None):
+    """ download and convert the images and labels of dataset <ds>, see to_numpy """
+    imgs = ds.images_to_numpy(pages=pages, roi=roi, dtype=dtype, scaling=scaling,
+                              max_memory=max_memory, spill_dir=spill_dir)
+    if max_memory is not None:
+        # whatever the images keep on the heap is not available to the labels
+        max_memory = max(max_memory - sum(item.nbytes for item in imgs if not isinstance(item, np.memmap)), 0)
+    labs = ds.gt_to_numpy(rex=labels_match, pages=pages, roi=roi, downcast=downcast_labels,
+                          max_memory=max_memory, spill_dir=spill_dir)
+    return (imgs, labs)
+
+
+def to_numpy(dataset_id=None, labels_match='foreground', pages=None, roi=None,
+             dtype=None, scaling=None, downcast_labels=False, max_memory=None, spill_dir=None):
     """ function to download and convert dataset of ID <dataeset_id>
+    only the <pages> and <roi> of each image are decoded (see b3get.utils.read_tiff)
+    images are converted to <dtype> with <scaling> and labels to the smallest integer dtype
+    if <downcast_labels> is True while they are decoded (see b3get.utils.convert)
+    if the images and labels are estimated to need more than <max_memory> bytes, they are
+    spilled to np.memmap files inside <spill_dir> (see dataset.files_to_numpy)
     return value: tuple (size 2)
     - item 0: images associated with this dataset
     - item 1: labels selected according to <labels_match>
+    raises ValueError before anything is downloaded if dtype and scaling don't fit together
     """
 
+    check_conversion(dtype, scaling)
     value = (None, None)
-    dsint = int(dataset_id)
-    ds = None
-    try:
-        if dsint not in [6, 8, 24, 27]:
-            print('support for BBBC{0:03} planned, but not thoroughly tested yet'.format(dsint))
-            ds = eval('dataset(datasetid="BBBC{0:03}")'.format(dsint))
-        else:
-            ds = eval('ds_{0:03}()'.format(dsint))
-    except Exception as ex:
-        print('unable to create dataset from', dataset_id, ex)
+    ds = _create_dataset(dataset_id)
+    if ds is None:
         return value
 
-    value = ds.images_to_numpy(), ds.gt_to_numpy(rex=labels_match)
+    value = _dataset_to_numpy(ds, labels_match, pages, roi, dtype, scaling, downcast_labels, max_memory, spill_dir)
 
     return value
+
+
+def to_numpy_many(dataset_ids, labels_match='foreground', nprocs=1, max_rate=None, adaptive=False, **kwargs):
+    """ function to download and convert several datasets like to_numpy,
+    the files of all datasets are downloaded first through one global queue of <nprocs> downloads
+    limited to <max_rate> bytes per second and <adaptive> concurrency (see datasets.pull_many),
+    keyword arguments (pages, roi, dtype, scaling, downcast_labels, max_memory, spill_dir) are passed on
+    to to_numpy for every dataset
+    return value: list with one tuple (size 2) per dataset in <dataset_ids>, (None, None) if it can't be created
+    - item 0: images associated with this dataset
+    - item 1: labels selected according to <labels_match>
+    raises ValueError before anything is downloaded if dtype and scaling don't fit together
+    """
+
+    check_conversion(kwargs.get('dtype'), kwargs.get('scaling'))
+    dss = [_create_dataset(item) for item in dataset_ids]
+    jobs = []
+    for ds in dss:
+        if ds is None:
+            continue
+        jobs.append((ds, filter_files(ds.list_images(), ds.images_rex)))
+        jobs.append((ds, filter_files(ds.list_gt(), labels_match)))
+    pull_many(jobs, nprocs, max_rate, adaptive)
+
+    # all files are present now, so converting each dataset does not download anything
+    return [_dataset_to_numpy(ds, labels_match, **kwargs) if ds is not None else (None, None) for ds in dss]
+
+
+def prefetch(dataset_ids, labels_match='foreground', extract=True, nprocs=1, max_rate=None, adaptive=False, **kwargs):
+    """ function to start downloading (and with <extract> extracting) several datasets in the background,
+    so that e.g. building a model overlaps with staging the data, the files of all datasets share one global queue of
+    <nprocs> downloads limited to <max_rate> bytes per second and <adaptive> concurrency, further keyword arguments
+    (policy, cache, mirrors, ...) are passed on to datasets.pull_many
+    return value: a datasets.prefetch_handle whose result() is a list with one tuple (size 2) per dataset in
+    <dataset_ids>, (None, None) if it can't be created, to_numpy and to_numpy_many find the files in place afterwards
+    - item 0: image files of this dataset
+    - item 1: label files selected according to <labels_match>
+    """
+
+    def stage(handle):
+        handle.stage = 'listing'
+        dss = [_create_dataset(item) for item in dataset_ids]
+        jobs = []
+        for ds in [item for item in dss if item is not None]:
+            jobs.append((ds, filter_files(ds.list_images(), ds.images_rex)))
+            jobs.append((ds, filter_files(ds.list_gt(), labels_match)))
+        files = iter(stage_files(handle, jobs, extract, nprocs, max_rate=max_rate, adaptive=adaptive, **kwargs))
+        return [(next(files), next(files)) if ds is not None else (None, None) for ds in dss]
+
+    return prefetch_handle(stage)
+
+
+def load(path_or_prefix, nprocs=1, cache=None):
+    """ open data written by `b3get resave` without decoding it
+    <path_or_prefix> is either one set of shards (its .json index, one of its shards or their common basename,
+    e.g. BBBC006_images) or the prefix of a resaved dataset (e.g. BBBC006) whose image and label shards
+    are opened together, arrays are decoded on access by <nprocs> threads (see stores.shard_sequence)
+    and kept in <cache> (defaults to utils.DECODED_CACHE)
+    return value: a stores.shard_sequence for one set of shards, for a dataset prefix a tuple (size 2)
+    - item 0: images associated with this dataset (None if they were not resaved)
+    - item 1: labels associated with this dataset (None if they were not resaved)
+    """
+
+    basename = shard_basename(path_or_prefix)
+    if basename is not None:
+        return shard_sequence(basename, nprocs=nprocs, cache=cache)
+
+    value = tuple(shard_basename(path_or_prefix+suffix) for suffix in ('_images', '_labels'))
+    if value == (None, None):
+        raise IOError('no resaved shards found for {0}'.format(path_or_prefix))
+
+    return tuple(shard_sequence(item, nprocs=nprocs, cache=cache) if item is not None else None for item in value)
@@ -0,0 +1,97 @@
+""" metadata of the BBBC datasets (zip files, their sizes, image counts, shapes and dtypes) that is shipped with b3get
+as catalog.json, so that sizes and listings can be answered without asking the server,
+entries refreshed with `b3get catalog` are stored in the user catalog and take precedence """
+import json
+import os
+
+from b3get.utils import tmp_location
+from b3get.download import size_of_content
+
+PACKAGED_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json')
+
+_CATALOG = None
+
+
+def catalog_location():
+    """ return the path of the user catalog, $B3GET_CATALOG or catalog.json inside tmp_location() """
+    return os.environ.get('B3GET_CATALOG') or os.path.join(tmp_location(), 'catalog.json')
+
+
+def read_catalog(path):
+    """ return the entries stored in the catalog file <path>, an empty dict if there is none """
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path) as fi:
+        return json.load(fi)
+
+
+def load_catalog(reload=False):
+    """ return the catalog: the packaged entries updated by those of the user catalog (read once per process)
+    keys are dataset ids like BBBC008, values dicts with
+    - title : title of the dataset
+    - images: names of all image zip files (only if the listing is known to be complete)
+    - gt    : names of all ground truth zip files (only if the listing is known to be complete)
+    - files : per zip file name what is known of it, out of size (bytes), count (number of tifs),
+              shape and dtype (if the same for all tifs) and decoded_size (bytes of all decoded tifs)
+    """
+    global _CATALOG
+    if _CATALOG is None or reload:
+        value = read_catalog(PACKAGED_CATALOG)
+        for dsid, entry in read_catalog(catalog_location()).items():
+            merged = dict(value.get(dsid, {}))
+            merged.update((key, item) for key, item in entry.items() if key != 'files')
+            merged['files'] = dict(value.get(dsid, {}).get('files', {}), **entry.get('files', {}))
+            value[dsid] = merged
+        _CATALOG = value
+    return _CATALOG
+
+
+def dataset_entry(datasetid):
+    """ return the catalog entry of dataset <datasetid> (e.g. BBBC008), an empty dict if it is unknown """
+    return load_catalog().get(datasetid, {})
+
+
+def file_entry(datasetid, fname):
+    """ return what the catalog knows about zip file <fname> (name or URL) of dataset <datasetid>, an empty dict if nothing """
+    return dataset_entry(datasetid).get('files', {}).get(os.path.split(fname)[-1], {})
+
+
+def describe_dataset(ds, with_content=True):
+    """ build the catalog entry of dataset <ds> from its web site: listings and byte sizes of all zip files,
+    if <with_content> also the image counts, shapes, dtypes and decoded sizes (see dataset.describe) """
+    images = [os.path.split(item)[-1] for item in ds.list_images()]
+    gt = [os.path.split(item)[-1] for item in ds.list_gt()]
+
+    files = {}
+    for fname in images + gt:
+        files[fname] = {'size': size_of_content("/".join([ds.baseurl.rstrip('/'), fname]))}
+
+    if with_content:
+        for member in ds.describe(rex="", lrex=""):
+            entry = files.setdefault(member['zip'], {})
+            entry['count'] = entry.get('count', 0) + 1
+            entry['decoded_size'] = entry.get('decoded_size', 0) + (member['decoded_size'] or 0)
+            for key in ('shape', 'dtype'):
+                item = list(member[key]) if key == 'shape' and member[key] is not None else member[key]
+                if entry.get(key, item) != item:
+                    item = None
+                entry[key] = item
+
+    value = {'images': images, 'gt': gt, 'files': files}
+    try:
+        value['title'] = ds.title()
+    except Exception as ex:
+        print('unable to obtain the title of {0} due to {1}'.format(ds.datasetid, ex))
+    return value
+
+
+def save_catalog(entries, path=None):
+    """ store <entries> (dataset id to catalog entry) in the catalog file <path> (the user catalog by default),
+    replacing the entries of the same datasets, returns the path written """
+    path = path or catalog_location()
+    value = read_catalog(path)
+    value.update(entries)
+    with open(path, 'w') as fo:
+        json.dump(value, fo, indent=1, sort_keys=True)
+    load_catalog(reload=True)
+    return path
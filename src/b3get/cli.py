@@ -14,16 +14,18 @@ Why does this file exist, and why not put this in __main__?
 
   Also see (1) from http://click.pocoo.org/5/setuptools/#setuptools-integration
 """
-from __future__ import print_function, with_statement
 import argparse
 import inspect
+import json
 import os
 import sys
 import traceback
 from multiprocessing import cpu_count
 
-from b3get import datasets
-from b3get.utils import filter_files, size_of_content, chunk_npz
+from b3get import datasets, catalog, manifest
+from b3get.utils import filter_files
+from b3get.download import benchmark_download, retry_policy, lockfile, parse_shard
+from b3get.stores import benchmark_codecs, CODECS, WRITERS
 import b3get
 
 
@@ -77,7 +79,31 @@ The most commonly used commands are:\n'''
         parser.add_argument('-n', '--dryrun', action='store_true', default=False,
                             help='don\'t download, just print filenames')
         parser.add_argument('-j', '--nprocs', action='store', default=1, type=int,
-                            help='perform <nprocs> many parallel downloads')
+                            help='perform <nprocs> many parallel downloads (shared by all datasets)')
+        parser.add_argument('--max-rate', action='store', default=0, type=float,
+                            help='download at most this many MB/s with all downloads together (0 means no limit)')
+        parser.add_argument('--adaptive', action='store_true', default=False,
+                            help='run only as many of the <nprocs> downloads at a time as raise the throughput')
+        parser.add_argument('--retries', action='store', default=4, type=int,
+                            help='retry failed requests this many times with exponential backoff')
+        parser.add_argument('--report', action='store', default=None, type=str,
+                            help='write the files that could not be downloaded to this .json file')
+        parser.add_argument('--locked', action='store_true', default=False,
+                            help='trust files recorded in <to>/b3get.lock after one stat, download the other recorded '
+                                 'files and check them against their recorded SHA-256, skip and report files the lock '
+                                 'does not record, never change the lock file')
+        parser.add_argument('--cache', action='store_true', default=False,
+                            help='download into the shared cache (tmp_location, $B3GET_CACHE) once and hardlink, '
+                                 'reflink or copy the files into <to> from there')
+        parser.add_argument('--mirror', action='append', default=None, type=str,
+                            help='fetch files from this mirror of the BBBC site (URL, file:// URL or folder with the '
+                                 'BBBCxxx folders) if it is faster, can be repeated, default: $B3GET_MIRRORS')
+        parser.add_argument('--shard', action='store', default=None, type=parse_shard,
+                            help='pull only part i/n (counting from 0) of the files, split by bytes, so that n nodes '
+                                 'together pull every file once')
+        parser.add_argument('-b', '--benchmark', action='store', default=0, type=int,
+                            help='don\'t pull, report the throughput of all download writers on the first file '
+                                 '(best of <benchmark> downloads each)')
         parser.add_argument('datasets', nargs='+', help='dataset(s) to download')
         # now that we're inside a subcommand, ignore the first
         # TWO argvs, ie the command (git) and the subcommand (commit)
@@ -93,13 +119,10 @@ The most commonly used commands are:\n'''
             print('{0} does not exist, please create it first'.format(args.to))
             return
 
+        jobs = []
         for item in args.datasets:
-            ds = None
-            dsid = int(item)
-            if not args.experimental:
-                ds = eval('datasets.ds_{0:03}()'.format(dsid))
-            else:
-                ds = eval('datasets.dataset(baseurl="https://data.broadinstitute.org/bbbc/BBBC{0:03}/")'.format(dsid))
+            dsid = datasets.dataset_number(item)
+            ds = datasets.get_dataset(dsid, args.experimental)
 
             print('fetching image information for dataset', dsid)
             files = ds.list_images()
@@ -108,18 +131,40 @@ The most commonly used commands are:\n'''
             gt = ds.list_gt()
             files.extend(filter_files(gt, args.lrex))
 
-            if args.dryrun:
-                for fname in files:
-                    print('[dryrun] pulling', os.path.join(ds.baseurl, fname))
+            if args.benchmark > 0:
+                if not files:
+                    continue
+                url = os.path.join(ds.baseurl, files[0])
+                print('benchmarking download writers on', url)
+                for res in benchmark_download(url, args.to, repeats=args.benchmark):
+                    print("{0:>12}\t{1:8.04} MB/s\t{2:8.04} s\t{3:8.04} s cpu".format(
+                        res['writer'], res['throughput'], res['seconds'], res['cpu_seconds']))
             else:
-                ds.pull_files(files, dstdir=args.to, nprocs=nprocs)
+                jobs.append((ds, files, args.to))
 
-        self.exit_code = 0
+        if args.dryrun:
+            for ds, files, _ in (datasets.shard_jobs(jobs, *args.shard) if args.shard else jobs):
+                for fname in files:
+                    print('[dryrun] pulling', os.path.join(ds.baseurl, fname))
+            jobs = []
+
+        # the files of all datasets share one queue of <nprocs> downloads
+        failures = []
+        if jobs:
+            datasets.pull_many(jobs, nprocs, args.max_rate*1024*1024, args.adaptive,
+                               policy=retry_policy(retries=args.retries), report=failures,
+                               lock=lockfile(args.to), locked=args.locked, cache=args.cache, shard=args.shard,
+                               mirrors=args.mirror)
+        if args.report:
+            with open(args.report, 'w') as fo:
+                json.dump(failures, fo, indent=1)
+            print('wrote', args.report)
+        self.exit_code = 1 if failures else 0
 
     def resave(self):
-        """ resave a dataset to .npz format """
+        """ resave a dataset to .npz (or .raw, .zarr) format """
         parser = argparse.ArgumentParser(
-            description='resave dataset to .npz format')
+            description='resave dataset to .npz format (or flat .raw files or a chunked .zarr store, all with a .json index)')
         # prefixing the argument with -- means it's optional
         parser.add_argument('-o', '--to', action='store', default='.', type=str,
                             help='directory where to store the downloaded dataset (error if it doesn\'t exist')
@@ -134,14 +179,53 @@ The most commonly used commands are:\n'''
 
         parser.add_argument('-m', '--max_megabytes', action='store', default=0, type=int,
                             help='produce at max files that are close to max_megabytes in size (0 refers to one single blob)')
+        parser.add_argument('--sharding', action='store', default='greedy', choices=['greedy', 'balanced'],
+                            help='fill files in order (greedy) or balance their sizes (balanced)')
+        parser.add_argument('--tolerance', action='store', default=0.1, type=float,
+                            help='files may exceed max_megabytes by this fraction')
+        parser.add_argument('-f', '--format', action='store', default='npz', choices=sorted(WRITERS),
+                            help='write compressed .npz archives, flat memory mappable .raw files or a chunked .zarr store')
+        parser.add_argument('--chunks', action='store', default=None, type=str,
+                            help='comma separated chunk shape of the .zarr store (e.g. 64,64,64)')
+        parser.add_argument('-c', '--codec', action='store', default='zlib', choices=sorted(CODECS),
+                            help='compression used inside the .npz files')
+        parser.add_argument('-l', '--level', action='store', default=None, type=int,
+                            help='compression level of the codec (zlib: 0-9, bz2: 1-9)')
+        parser.add_argument('--locked', action='store_true', default=False,
+                            help='trust files recorded in <to>/b3get.lock after one stat, download the other recorded '
+                                 'files and check them against their recorded SHA-256, skip and report files the lock '
+                                 'does not record, never change the lock file')
+        parser.add_argument('--cache', action='store_true', default=False,
+                            help='download into the shared cache (tmp_location, $B3GET_CACHE) once and hardlink, '
+                                 'reflink or copy the files into <to> from there')
+        parser.add_argument('--mirror', action='append', default=None, type=str,
+                            help='fetch files from this mirror of the BBBC site (URL, file:// URL or folder with the '
+                                 'BBBCxxx folders) if it is faster, can be repeated, default: $B3GET_MIRRORS')
+        parser.add_argument('--shard', action='store', default=None, type=parse_shard,
+                            help='pull only part i/n (counting from 0) of the files, split by bytes, so that n nodes '
+                                 'together pull every file once, the files written are named after the shard')
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='rewrite all files even if the archives and arguments did not change since the last resave')
+        parser.add_argument('-b', '--benchmark', action='store', default=0, type=int,
+                            help='don\'t resave, report throughput and ratio of all codecs on <benchmark> many images '
+                                 '(pulling only the zip files they are in)')
 
         parser.add_argument('-j', '--nprocs', action='store', default=1, type=int,
                             help='perform <nprocs> many parallel downloads')
+        parser.add_argument('--max-rate', action='store', default=0, type=float,
+                            help='download at most this many MB/s with all downloads together (0 means no limit)')
+        parser.add_argument('--adaptive', action='store_true', default=False,
+                            help='run only as many of the <nprocs> downloads at a time as raise the throughput')
         parser.add_argument('datasets', nargs='+', help='dataset(s) to download')
         # now that we're inside a subcommand, ignore the first
         # TWO argvs, ie the command (git) and the subcommand (commit)
         args = parser.parse_args(self.args[2:])
         nprocs = int(cpu_count() if args.nprocs < 0 else args.nprocs)
+        writer_options = {}
+        if args.format in ('npz', 'zarr'):
+            writer_options = {'codec': args.codec, 'level': args.level}
+        if args.format == 'zarr' and args.chunks:
+            writer_options['chunks'] = [int(item) for item in args.chunks.split(',')]
 
         if not hasattr(args, 'datasets'):
             print('no datasets given', args)
@@ -153,12 +237,8 @@ The most commonly used commands are:\n'''
             return
 
         for item in args.datasets:
-            ds = None
-            dsid = int(item)
-            if not args.experimental:
-                ds = eval('datasets.ds_{0:03}()'.format(dsid))
-            else:
-                ds = eval('datasets.dataset(baseurl="https://data.broadinstitute.org/bbbc/BBBC{0:03}/")'.format(dsid))
+            dsid = datasets.dataset_number(item)
+            ds = datasets.get_dataset(dsid, args.experimental)
 
             print('fetching image information for dataset', dsid)
             files = ds.list_images()
@@ -174,23 +254,45 @@ The most commonly used commands are:\n'''
                     print('[dryrun] pulling', os.path.join(ds.baseurl, fname))
                 return
 
-            zipimgs = ds.pull_files(imgs, dstdir=args.to, nprocs=nprocs)
-            zipgt = ds.pull_files(gt, dstdir=args.to, nprocs=nprocs)
+            if args.benchmark > 0:
+                # only as many zip files are pulled as it takes to sample <benchmark> images
+                ximgs = []
+                for zname in imgs:
+                    zips = ds.pull_files([zname], dstdir=args.to, nprocs=nprocs, max_rate=args.max_rate*1024*1024,
+                                         adaptive=args.adaptive, lock=lockfile(args.to), locked=args.locked,
+                                         cache=args.cache, mirrors=args.mirror)
+                    ximgs.extend(ds.select_files(ds.zips_to_files(zips, nprocs)))
+                    if len(ximgs) >= args.benchmark:
+                        break
+                sample = [item for item in (ds.read_file(fn) for fn in ximgs[:args.benchmark]) if item is not None]
+                print('benchmarking codecs on {0} images of BBBC{1:03}'.format(len(sample), dsid))
+                for res in benchmark_codecs(sample, level=args.level):
+                    print("{0:8}\t{1:10.04} MB/s\t{2:8.04}x".format(res['codec'], res['throughput'], res['ratio']))
+                self.exit_code = 0
+                continue
 
-            if zipimgs:
-                npimgs = ds.zips_to_numpy(zipimgs, nprocs=nprocs)
+            zipimgs = ds.pull_files(imgs, dstdir=args.to, nprocs=nprocs, max_rate=args.max_rate*1024*1024,
+                                    adaptive=args.adaptive, lock=lockfile(args.to), locked=args.locked, cache=args.cache,
+                                    shard=args.shard, mirrors=args.mirror)
+            zipgt = ds.pull_files(gt, dstdir=args.to, nprocs=nprocs, max_rate=args.max_rate*1024*1024,
+                                  adaptive=args.adaptive, lock=lockfile(args.to), locked=args.locked, cache=args.cache,
+                                  shard=args.shard, mirrors=args.mirror)
+            suffix = '_shard{0}of{1}'.format(*args.shard) if args.shard else ''
 
-                fname = os.path.join(args.to, 'BBBC{0:03}_images'.format(dsid))
-                npzimgs = chunk_npz(npimgs, fname, args.max_megabytes)
+            if zipimgs:
+                fname = os.path.join(args.to, 'BBBC{0:03}_images{1}'.format(dsid, suffix))
+                npzimgs = ds.zips_to_shards(zipimgs, fname, args.format, args.max_megabytes, nprocs=nprocs,
+                                            method=args.sharding, tolerance=args.tolerance,
+                                            writer_options=writer_options, force=args.force)
                 if npzimgs:
                     print('wrote ', ", ".join(npzimgs))
                     self.exit_code = 0
 
             if zipgt:
-                npgt = ds.zips_to_numpy(zipgt, nprocs=nprocs)
-
-                fname = os.path.join(args.to, 'BBBC{0:03}_labels'.format(dsid))
-                npzgt = chunk_npz(npgt, fname, args.max_megabytes)
+                fname = os.path.join(args.to, 'BBBC{0:03}_labels{1}'.format(dsid, suffix))
+                npzgt = ds.zips_to_shards(zipgt, fname, args.format, args.max_megabytes, nprocs=nprocs,
+                                          method=args.sharding, tolerance=args.tolerance,
+                                          writer_options=writer_options, force=args.force)
                 if npzgt:
                     print('wrote ', ", ".join(npzgt))
                     self.exit_code = 0
@@ -212,17 +314,16 @@ The most commonly used commands are:\n'''
             parser.print_help()
             return
 
-        av = [6, 8, 24, 27]
+        av = sorted(datasets.REGISTRY)
         for i in av:
             dsid = "BBBC{0:03}".format(i)
-            if dsid in datasets.TESTED_DATASETS.keys():
-                print("BBBC{0:03} {1}".format(i, datasets.TESTED_DATASETS[dsid]))
+            print("BBBC{0:03} {1:34}".format(i, catalog.dataset_entry(dsid).get('title', '')))
 
         for dsid in range(1, 43):
             if dsid in av:
                 continue
             try:
-                ds = eval('datasets.dataset(baseurl="https://data.broadinstitute.org/bbbc/BBBC{0:03}/")'.format(dsid))
+                ds = datasets.get_dataset(dsid)
             except Exception as ex:
                 continue
 
@@ -254,12 +355,8 @@ The most commonly used commands are:\n'''
             return
 
         for item in args.datasets:
-            ds = None
-            dsid = int(item)
-            if not args.experimental:
-                ds = eval('datasets.ds_{0:03}()'.format(dsid))
-            else:
-                ds = eval('datasets.dataset(baseurl="https://data.broadinstitute.org/bbbc/BBBC{0:03}/")'.format(dsid))
+            dsid = datasets.dataset_number(item)
+            ds = datasets.get_dataset(dsid, args.experimental)
 
             files = ds.list_images()
             files = filter_files(files, rex=args.rex)
@@ -270,13 +367,88 @@ The most commonly used commands are:\n'''
             for fname in files:
                 url = os.path.join(ds.baseurl, fname)
                 if args.add_size:
-                    size = size_of_content(url)
+                    size = ds.expected_size(url)
                     print("{0:10.04}MB\t{1}".format(size/(1024.*1024.*1024), url))
                 else:
                     print(url)
 
         self.exit_code = 0
 
+    def describe(self):
+        """show shape, dtype and size of all images in a dataset without downloading it"""
+        parser = argparse.ArgumentParser(
+            description='show shape, dtype and size of the images in a dataset, reading only zip directories and tif headers')
+        parser.add_argument('datasets', nargs='+', help='dataset(s) to describe')
+        parser.add_argument('--rex', action='store', type=str, default=None,
+                            help='regular expression to limit the images to describe')
+        parser.add_argument('-x', '--experimental', default=True, action='store_true',
+                            help='try an unconfigured dataset')
+        parser.add_argument('--lrex', action='store', type=str, default=None,
+                            help='regular expression to limit the labels to describe')
+        args = parser.parse_args(self.args[2:])
+
+        for item in args.datasets:
+            dsid = datasets.dataset_number(item)
+            ds = datasets.get_dataset(dsid, args.experimental)
+
+            entries = ds.describe(rex=args.rex, lrex=args.lrex)
+            compressed, decoded = 0, 0
+            for entry in entries:
+                print("{0}\t{1}\t{2}\t{3}\t{4:10.04}MB\t{5:10.04}MB".format(entry['zip'], entry['name'],
+                                                                            entry['shape'], entry['dtype'],
+                                                                            entry['compressed_size']/(1024.*1024.),
+                                                                            (entry['decoded_size'] or 0)/(1024.*1024.)))
+                compressed += entry['compressed_size']
+                decoded += entry['decoded_size'] or 0
+            print("BBBC{0:03}: {1} images, {2:.04} MB compressed, {3:.04} MB decoded".format(dsid, len(entries),
+                                                                                             compressed/(1024.*1024.),
+                                                                                             decoded/(1024.*1024.)))
+
+        self.exit_code = 0
+
+    def catalog(self):
+        """store listings, sizes and image shapes of datasets in the catalog to answer later queries offline"""
+        parser = argparse.ArgumentParser(
+            description='store file listings, sizes, image counts, shapes and dtypes of datasets in the catalog')
+        parser.add_argument('datasets', nargs='+', help='dataset(s) to catalog')
+        parser.add_argument('-o', '--to', action='store', default=None, type=str,
+                            help='catalog file to update (default: the user catalog, see b3get.catalog.catalog_location)')
+        parser.add_argument('-s', '--sizes_only', default=False, action='store_true',
+                            help='only store listings and file sizes, don\'t read zip directories and tif headers')
+        args = parser.parse_args(self.args[2:])
+
+        entries = {}
+        for item in args.datasets:
+            dsid = datasets.dataset_number(item)
+            ds = datasets.get_dataset(dsid)
+            print('cataloging', ds.datasetid)
+            entries[ds.datasetid] = catalog.describe_dataset(ds, with_content=not args.sizes_only)
+
+        print('updated', catalog.save_catalog(entries, args.to))
+        self.exit_code = 0
+
+    def run(self):
+        """ pull and export the datasets declared in a manifest, skipping what is up to date """
+        parser = argparse.ArgumentParser(
+            description='pull and export the datasets declared in a .json (or .toml) manifest as one plan, '
+                        'see b3get.manifest for its format')
+        parser.add_argument('manifest', help='manifest to run')
+        parser.add_argument('-n', '--dryrun', action='store_true', default=False,
+                            help='don\'t download or export, just print the plan')
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='ignore the stamps of previous runs and rewrite all exports')
+        parser.add_argument('--report', action='store', default=None, type=str,
+                            help='write the files that could not be downloaded to this .json file')
+        args = parser.parse_args(self.args[2:])
+
+        failures = []
+        manifest.run_manifest(args.manifest, force=args.force, dryrun=args.dryrun, report=failures)
+        if args.report:
+            with open(args.report, 'w') as fo:
+                json.dump(failures, fo, indent=1)
+            print('wrote', args.report)
+        self.exit_code = 1 if failures else 0
+
     def version(self):
         """ show the version of b3get """
 
@@ -1,56 +1,131 @@
-from __future__ import absolute_import, print_function, with_statement
-
 import re
 import os
 import glob
+import json
 import requests
 import zipfile
 import tifffile
-import six
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from bs4 import BeautifulSoup
-from b3get.utils import tmp_location, filter_files, size_of_content, wrap_serial_download_file, wrap_unzip_to
-from tqdm import tqdm
-from multiprocessing import Pool, freeze_support, RLock, cpu_count
+from b3get.utils import tmp_location, filter_files, wrap_unzip_to, pair_files, read_tiff, convert, check_conversion
+from b3get.utils import DECODED_CACHE, file_fingerprint, zip_checksums, tiff_shape, converted_dtype, spill_file
+from b3get.utils import memory_stage, BBBC_URL
+from b3get.download import size_of_content, download_files, http_range_file, describe_zip, materialize, file_sha256
+from b3get.download import split_by_size, mirror_list, has_size
+from b3get.stores import plan_shards, interleave_plan, WRITERS, shard_writer, shard_names, shard_index
+from b3get.catalog import dataset_entry, file_entry
+from multiprocessing.pool import ThreadPool
+
 
-TESTED_DATASETS = {
-    "BBBC006": "Human U2OS cells (out of focus)   ",
-    "BBBC008": "Human HT29 colon-cancer cells     ",
-    "BBBC024": "3D HL60 Cell Line (synthetic data)",
-    "BBBC027": "3D Colon Tissue (synthetic data)  "
-}
+class sample_index(object):
+    """ random access to (image, label) pairs of extracted tif files,
+    decoded arrays are kept in a byte-bounded cache that is shared across datasets by default """
+
+    def __init__(self, images, labels, key_rex=None, cache=None):
+        """
+        pair the files in <images> and <labels> by their sample key (see utils.sample_key)
+        - key_rex: regular expression applied to the basename of each file to obtain the key
+        - cache  : byte_lru_cache to hold decoded arrays (defaults to utils.DECODED_CACHE)
+        """
+        self.pairs = pair_files(images, labels, key_rex)
+        self.cache = cache if cache is not None else DECODED_CACHE
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        img, lab = self.pairs[i]
+        return self.read_file(img), self.read_file(lab)
+
+    def read(self, i, pages=None, roi=None):
+        """ return the pair (image, label) of sample <i> restricted to <pages> and <roi> (see utils.read_tiff),
+        partial reads bypass the cache """
+        img, lab = self.pairs[i]
+        return self.read_file(img, pages, roi), self.read_file(lab, pages, roi)
+
+    def read_file(self, fname, pages=None, roi=None):
+        """ return the decoded array of <fname>, from the cache if possible """
+        if pages is not None or roi:
+            return read_tiff(fname, pages=pages, roi=roi)
+
+        key = os.path.abspath(fname)
+        value = self.cache.get(key)
+        if value is None:
+            value = self.cache.put(key, tifffile.imread(fname))
+        return value
 
 
 class dataset():
     """ base class that offers methods which all deriving classes can override if needed """
 
+    # default filters applied to the image and ground truth zip files
+    images_rex = ""
+    gt_rex = ""
+
     def __init__(self, baseurl=None, datasetid=None):
         """
         constructor of dataset given a baseurl or dataasetid (baseurl has precedence)
         - will throw RuntimeError if neither <baseurl> nor <datasetid> is given
         - will throw RuntimeError if <datasetid> invalid (greater than 42)
         - will throw RuntimeError if URL <baseurl> is not reachable
+        if the catalog lists all zip files of the dataset, the site is only contacted once it is needed
         """
         if not baseurl:
             if datasetid is None:
                 raise RuntimeError('No URL {} or datasetid {} given to b3get. Nothing todo then.'.format(baseurl, datasetid))
             elif datasetid < 43:
-                baseurl = "https://data.broadinstitute.org/bbbc/BBBC{0:03}/".format(datasetid)
+                baseurl = BBBC_URL.format(datasetid)
             else:
                 raise RuntimeError('Dataset id {} given to b3get invalid.'.format(datasetid))
 
-        r = requests.get(baseurl, timeout=2.)
-        if not r.ok:
-            raise RuntimeError('No dataset can be reached at {}'.format(baseurl))
-
         self.baseurl = baseurl
         self.datasetid = baseurl.rstrip('/').split('/')[-1]
         self.tmp_location = os.path.join(tmp_location(), self.datasetid)
-        self.baseurl_request = r
+        self._request = None
+        self._sizes = {}
+
+        entry = self.metadata()
+        if 'images' not in entry or 'gt' not in entry:
+            self._request = self.baseurl_request
+
+    @property
+    def baseurl_request(self):
+        """ response of the dataset site, requested on first use """
+        if self._request is None:
+            r = requests.get(self.baseurl, timeout=2.)
+            if not r.ok:
+                raise RuntimeError('No dataset can be reached at {}'.format(self.baseurl))
+            self._request = r
+        return self._request
+
+    def metadata(self):
+        """ return what the catalog knows about this dataset (see catalog.load_catalog) """
+        return dataset_entry(self.datasetid)
+
+    def expected_size(self, fname):
+        """ return the size in bytes of zip file <fname> (name or URL) from the catalog,
+        asking the server (once per dataset object) if it is unknown """
+        size = file_entry(self.datasetid, fname).get('size')
+        if size is not None:
+            return size
+        url = "/".join([self.baseurl.rstrip('/'), fname]) if self.baseurl not in fname else fname
+        if not self._sizes.get(url):
+            # 0 means the server could not tell, so that is asked again next time
+            self._sizes[url] = size_of_content(url)
+        return self._sizes[url]
 
     def title(self):
         """ retrieve the title of the dataset """
 
+        if self._request is None and 'title' in self.metadata():
+            return self.metadata()['title']
         hdoc = BeautifulSoup(self.baseurl_request.text, 'html.parser')
         return hdoc.title.string
 
@@ -58,6 +133,8 @@ class dataset():
         """ retrieve the list of images for this dataset """
         values = []
 
+        if 'images' in self.metadata():
+            return ["/".join([self.baseurl, item]) if absolute_url else item for item in self.metadata()['images']]
         hdoc = BeautifulSoup(self.baseurl_request.text, 'html.parser')
         all_links = hdoc.find_all('a')
         for anc in all_links:
@@ -71,6 +148,8 @@ class dataset():
         """ retrieve the list of images for this dataset """
         values = []
 
+        if 'gt' in self.metadata():
+            return ["/".join([self.baseurl, item]) if absolute_url else item for item in self.metadata()['gt']]
         hdoc = BeautifulSoup(self.baseurl_request.text, 'html.parser')
         all_links = hdoc.find_all('a')
         for anc in all_links:
@@ -80,19 +159,21 @@ class dataset():
                 values.append(url)
         return values
 
-    def pull_files(self, filelist, dstdir=None, rex="", nprocs=1):
-        """ given a regular expression <rex>, download the files matching it from the dataset site
-        filelist: a list of file names (no paths)
-        dstdir  : destination folder where to download files to
-        rex     : filter <filelist> for this regex string
-        nprocs  : perform download with this many processors (nprocs=-1 means all CPUs)
+    def plan_downloads(self, filelist, dstdir=None, rex="", lock=None):
+        """ given a regular expression <rex>, find the files in <filelist> (names, no paths) matching it
+        that are not in folder <dstdir> (tmp_location by default) yet with their expected size
+        files recorded in the download.lockfile <lock> are expected with their locked size and are taken as they are
+        if they still have the size and modification time they were locked with (one stat, no request)
+        returns a tuple (size 2)
+        - item 0: files found in <dstdir> already
+        - item 1: list of (url, dstdir, expected size) to download, see download.download_files
         """
 
         imgs = filter_files(filelist, rex) if rex else filelist
         done = []
         if len(imgs) == 0:
             print("no images found matching {}".format(rex))
-            return done
+            return done, []
 
         if not dstdir:
             dstdir = self.tmp_location
@@ -101,50 +182,51 @@ class dataset():
             os.makedirs(dstdir)
         print('received {} files'.format(len(filelist)))
 
-        fullurls = []
-        total_bytes = 0
+        jobs = []
         for zurl in imgs:
             url = "/".join([self.baseurl.rstrip('/'), zurl]) if self.baseurl not in zurl else zurl
-            exp_size = size_of_content(url)
-            total_bytes += exp_size
             fname = os.path.split(zurl)[-1]
             dstf = os.path.join(dstdir, fname)
-            if os.path.exists(dstf) and os.path.isfile(dstf) and os.stat(dstf).st_size == exp_size:
+            entry = lock.get(dstf) if lock is not None else None
+            if entry is not None and entry['url'] == url:
+                if lock.matches(dstf):
+                    done.append(dstf)
+                    continue
+                jobs.append((url, dstdir, entry['size']))
+                continue
+
+            exp_size = self.expected_size(url)
+            # a file of unknown size (the server didn't tell) can't be checked, it is downloaded again
+            if exp_size and has_size(dstf, exp_size):
                 print('{0} already exists in {1} with the correct size {2:04.4} kB, skipping it'.format(fname,
                                                                                                         dstdir,
                                                                                                         exp_size/(1024.*1024.)))
                 done.append(dstf)
                 continue
-            fullurls.append(url)
-
-        nprocs = cpu_count() if nprocs < 0 else nprocs
-        freeze_support()  # for Windows support
-
-        dstfolders = [dstdir]*len(fullurls)
-        cbytes = [1024*1024]*len(fullurls)
-        procids = [item % nprocs for item in range(len(fullurls))]
-        if len(fullurls) > 0:
-            print('downloading {0} files with {1} threads of {2:04.04} MB in total'.format(len(fullurls),
-                                                                                           nprocs,
-                                                                                           total_bytes/(1024.*1024.*1024.)))
-        zipped_args = zip(fullurls, dstfolders, cbytes, procids)
-        p = Pool(nprocs,
-                 # again, for Windows support
-                 initializer=tqdm.set_lock, initargs=(RLock(),))
-        dpaths = p.map(wrap_serial_download_file, zipped_args)
-        print()
-
-        for i in range(len(fullurls)):
-            fpath = dpaths[i]
-            url = fullurls[i]
-            exp_size = size_of_content(url)
-            if os.path.isfile(fpath) and os.stat(fpath).st_size == exp_size:
-                print("downloaded {0} to {1} ({2:.4} MB)".format(url, fpath, exp_size/(1024.*1024.*1024.)))
-                done.append(fpath)
-            else:
-                print("download of {0} to {1} failed ({2} != {3} B)".format(url, fpath, exp_size, os.stat(fpath).st_size))
+            jobs.append((url, dstdir, exp_size))
 
-        return done
+        return done, jobs
+
+    def pull_files(self, filelist, dstdir=None, rex="", nprocs=1, max_rate=None, adaptive=False, policy=None, report=None,
+                   lock=None, locked=False, cache=False, shard=None, mirrors=None):
+        """ given a regular expression <rex>, download the files matching it from the dataset site
+        filelist: a list of file names (no paths)
+        dstdir  : destination folder where to download files to
+        rex     : filter <filelist> for this regex string
+        nprocs  : perform download with this many threads (nprocs=-1 means all CPUs)
+        max_rate: receive at most this many bytes per second with all threads together
+        adaptive: run only as many of the <nprocs> downloads at a time as raise throughput
+        policy  : retry_policy for failed requests (download.DEFAULT_RETRY if None)
+        report  : list that failed downloads are appended to (see download.download_files)
+        lock    : download.lockfile to record the files in, or to check them against if <locked> (see pull_many)
+        cache   : fetch into the shared cache and link the files into <dstdir> from there (see pull_many)
+        shard   : tuple (i, n), pull only part i of n of the files, split by bytes (see shard_jobs)
+        mirrors : URLs or folders to fetch the files from if they are faster than the site (see pull_many)
+        """
+
+        imgs = filter_files(filelist, rex) if rex else filelist
+        return pull_many([(self, imgs, dstdir)], nprocs, max_rate, adaptive, policy, report, lock, locked, cache,
+                         shard, mirrors)[0]
 
     def pull_images(self, rex=""):
         """ given a regular expression <rex>, download the image files matching it from the dataset site """
@@ -154,6 +236,48 @@ class dataset():
         """ given a regular expression <rex>, download the ground truth files matching it from the dataset site """
         return self.pull_files(self.list_gt(), rex=rex)
 
+    def prefetch(self, rex=None, lrex=None, extract=True, nprocs=1, **kwargs):
+        """ start downloading (and with <extract> extracting) the images matching <rex> and the ground truth
+        matching <lrex> (images_rex and gt_rex of the class if None) in the background, keyword arguments
+        (max_rate, adaptive, policy, cache, mirrors, ...) are passed on to pull_many
+        returns a prefetch_handle, its result() is the tuple (image files, ground truth files), extracted ones
+        with <extract>, the zip files otherwise; images_to_numpy and gt_to_numpy find them in place afterwards
+        """
+        def stage(handle):
+            handle.stage = 'listing'
+            jobs = [(self, filter_files(self.list_images(), self.images_rex if rex is None else rex)),
+                    (self, filter_files(self.list_gt(), self.gt_rex if lrex is None else lrex))]
+            return tuple(stage_files(handle, jobs, extract, nprocs, **kwargs))
+        return prefetch_handle(stage)
+
+    def describe(self, rex=None, lrex=None, folder=None):
+        """ scan the image and ground truth zip files matching <rex> and <lrex> (class defaults if None) without extracting them
+        zip files already downloaded to <folder> (tmp_location by default) are read from disk, all others
+        through HTTP range requests, in both cases only zip central directories and tif headers are read
+        returns a list of dicts with zip, member name, shape, dtype, compressed and decoded size in bytes
+        """
+        rex = self.images_rex if rex is None else rex
+        lrex = self.gt_rex if lrex is None else lrex
+        folder = folder or self.tmp_location
+
+        value = []
+        zips = filter_files(self.list_images(), rex) + filter_files(self.list_gt(), lrex)
+        for zname in zips:
+            fname = os.path.split(zname)[-1]
+            local = os.path.join(folder, fname)
+            url = "/".join([self.baseurl.rstrip('/'), zname]) if self.baseurl not in zname else zname
+            try:
+                source = local if os.path.isfile(local) else http_range_file(url)
+                entries = describe_zip(source)
+            except Exception as ex:
+                print('unable to describe {0} due to {1}'.format(url, ex))
+                continue
+            for entry in entries:
+                entry['zip'] = fname
+                value.append(entry)
+
+        return value
+
     def extract_files(self, filelist, dstdir, nprocs=1):
         """ unpack each file in <filelist> to folder <dstdir>
         returns a list of extracted files
@@ -164,10 +288,13 @@ class dataset():
             print('{0} does not exists, will not extract anything to it')
             return value
 
-        workers = Pool(nprocs)
+        # zlib releases the GIL, threads also work from the background thread of a prefetch
+        workers = ThreadPool(nprocs)
         inputargs = list(zip(filelist,
                              [dstdir]*len(filelist)))
         zresults = workers.map(wrap_unzip_to, inputargs)
+        workers.close()
+        workers.join()
 
         for res in zresults:
             for fn in res:
@@ -218,34 +345,97 @@ class dataset():
 
         return self.extract_files(cands, datasetdir, nprocs)
 
-    def files_to_numpy(self, file_list, filter_for_rex=".*tif"):
-        """ given a list of file_names, sort the found .tif files and try to open them with tifffile and return a list of numpy arrays """
-        value = []
+    def select_files(self, file_list, filter_for_rex=".*tif"):
+        """ return the sorted list of files in <file_list> matching <filter_for_rex> (only tif files are supported) """
         if not file_list:
-            return value
+            return []
 
         if not filter_for_rex.count('tif'):
             print('only tif files are supported')
-            return value
+            return []
 
         crex = re.compile(filter_for_rex)
         files = [item for item in file_list if crex.search(item)]
         if not files:
             print('nothing found for {0} in {1} ...'.format(filter_for_rex, " ".join(file_list[1:3])))
-            return value
 
-        files = sorted(files)
-        for fn in files:
+        return sorted(files)
+
+    def read_file(self, fname, pages=None, roi=None, dtype=None, scaling=None, downcast=False):
+        """ read tif file <fname> into a numpy array, returns None if that fails
+        only the <pages> and <roi> of the file are decoded, see utils.read_tiff
+        <dtype>, <scaling> and <downcast> convert the array right after decoding, see utils.convert
+        """
+        try:
+            value = read_tiff(fname, pages=pages, roi=roi)
+            if dtype is not None or scaling or downcast:
+                value = convert(value, dtype=dtype, scaling=scaling, downcast=downcast)
+        except Exception as ex:
+            print('unable to open {0} with tifffile due to {1}'.format(fname, ex))
+            return None
+        return value
+
+    def iter_files(self, file_list, filter_for_rex=".*tif", **kwargs):
+        """ given a list of file_names, sort the found .tif files and yield them one at a time as numpy arrays
+        keyword arguments (pages, roi, dtype, scaling, downcast) are passed on to read_file
+        """
+        for fn in self.select_files(file_list, filter_for_rex):
+            value = self.read_file(fn, **kwargs)
+            if value is not None:
+                yield value
+
+    def estimate_nbytes(self, file_list, pages=None, roi=None, dtype=None, scaling=None, **kwargs):
+        """ estimate the bytes required to hold the arrays read from <file_list> from their tif headers alone,
+        returns a list with one entry per file (0 if the header can't be read) """
+        value = []
+        for fn in file_list:
             try:
-                value.append(tifffile.imread(fn))
+                shape, native = tiff_shape(fn, pages=pages, roi=roi)
             except Exception as ex:
-                print('unable to open {0} with tifffile due to {1}'.format(fn, ex))
+                print('unable to read the header of {0} due to {1}'.format(fn, ex))
+                value.append(0)
                 continue
+            value.append(int(np.prod(shape))*converted_dtype(native, dtype, scaling).itemsize)
+        return value
 
+    def files_to_numpy(self, file_list, filter_for_rex=".*tif", max_memory=None, spill_dir=None, **kwargs):
+        """ given a list of file_names, sort the found .tif files and try to open them with tifffile and return a list of numpy arrays
+        if the size estimated from the tif headers exceeds <max_memory> bytes, the arrays are np.memmap views
+        into a file inside <spill_dir> (tmp_location of the dataset by default) instead of living on the heap,
+        the file is unlinked right away and its space freed once the arrays are gone (see utils.spill_file)
+        keyword arguments (pages, roi, dtype, scaling, downcast) are passed on to read_file,
+        raises ValueError if dtype, scaling and downcast don't fit together (see utils.check_conversion)
+        """
+        check_conversion(kwargs.get('dtype'), kwargs.get('scaling'), kwargs.get('downcast', False))
+        files = self.select_files(file_list, filter_for_rex)
+        if max_memory is None or not files:
+            return list(self.iter_files(files, filter_for_rex, **kwargs))
+
+        estimates = self.estimate_nbytes(files, **kwargs)
+        total = sum(estimates)
+        if total <= max_memory:
+            return list(self.iter_files(files, filter_for_rex, **kwargs))
+
+        spill_dir = spill_dir or self.tmp_location
+        if not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+        fd, path = tempfile.mkstemp(prefix=self.datasetid+'_', suffix='.spill', dir=spill_dir)
+        os.close(fd)
+        print('estimated {0:.4} MB exceed max_memory of {1:.4} MB, spilling to {2}'.format(total/(1024.*1024.),
+                                                                                           max_memory/(1024.*1024.),
+                                                                                           path))
+        store = spill_file(path, total, narrays=len(files), delete=True)
+        value = []
+        for fn in files:
+            array = self.read_file(fn, **kwargs)
+            if array is not None:
+                value.append(store.store(array))
+                del array
+        store.flush()
         return value
 
-    def zips_to_numpy(self, zipfiles, include_filenames=False, nprocs=1):
-        """ given a list of zip files, extract them and read the extracted tifs into a list of np.ndarrays """
+    def zips_to_files(self, zipfiles, nprocs=1):
+        """ given a list of zip files, extract them next to each other and return the sorted list of extracted files """
         value = []
         if not zipfiles:
             return value
@@ -256,102 +446,407 @@ class dataset():
             return value
 
         basedir = basedirset.pop()
-        ximgs = self.extract_files(zipfiles, basedir, nprocs)
-        if len(ximgs) > 0 and zipfiles:
-            ximgs = sorted(ximgs)
+        return sorted(self.extract_files(zipfiles, basedir, nprocs))
 
-            value = self.files_to_numpy(ximgs)
+    def zips_to_numpy(self, zipfiles, include_filenames=False, nprocs=1, max_memory=None, **kwargs):
+        """ given a list of zip files, extract them and read the extracted tifs into a list of np.ndarrays
+        the peak memory of extraction and decoding is reported if a <max_memory> budget is given,
+        keyword arguments (max_memory, spill_dir, pages, roi, dtype, scaling, downcast) are passed on to files_to_numpy
+        """
+        value = []
+        with memory_stage('{0} extract'.format(self.datasetid), report=max_memory is not None):
+            ximgs = self.zips_to_files(zipfiles, nprocs)
+        if len(ximgs) > 0:
+            with memory_stage('{0} decode'.format(self.datasetid), report=max_memory is not None):
+                value = self.files_to_numpy(ximgs, max_memory=max_memory, **kwargs)
             if include_filenames:
                 value = list(zip(value, ximgs))
 
         return value
 
-    def images_to_numpy(self, rex="", include_filenames=False):
-        """ download images if needed and extract them into a list of numpy ndarrays """
+    def zips_to_shards(self, zipfiles, basename, fmt='npz', max_megabytes=0, nprocs=1, method='greedy', tolerance=0.1,
+                       writer_options=None, force=False, **kwargs):
+        """ given a list of zip files, extract them and stream the extracted tifs into shards of format <fmt> (see stores.WRITERS)
+        starting with <basename>, each array is written as soon as it is decoded (see stores.shard_writer),
+        the shards hold about <max_megabytes> each, planned up front from the sizes in the tif headers
+        with <method> and <tolerance> (see stores.plan_shards), and are written by <nprocs> threads,
+        the tifs are decoded round-robin over the shards so that different shards are compressed in parallel
+        <writer_options> are passed on to the writer (e.g. codec and level for npz, chunks for zarr),
+        keyword arguments (pages, roi, dtype, scaling, downcast) are passed on to read_file
+
+        the shard index records the fingerprints of the <zipfiles>, the export parameters and the checksum of
+        the tif every array was read from, so unless <force> is given, running this again does nothing if neither
+        the archives nor the parameters changed and only rewrites the npz/raw shards whose tifs changed otherwise
+        returns the list of shards written, raises ValueError for read options that don't fit together
+        """
+        check_conversion(kwargs.get('dtype'), kwargs.get('scaling'), kwargs.get('downcast', False))
+        sources = sorted((file_fingerprint(item) for item in zipfiles), key=lambda item: item['file'])
+        parameters = json.loads(json.dumps({'format': fmt, 'max_megabytes': max_megabytes, 'method': method,
+                                            'tolerance': tolerance, 'writer_options': writer_options or {},
+                                            'read_options': kwargs}, sort_keys=True, default=str))
+        previous = None
+        if not force and os.path.isfile(basename+'.json'):
+            previous = shard_index(basename)
+            files = [os.path.join(os.path.dirname(basename), shard['file']) for shard in previous['shards']]
+            if previous.get('parameters') != parameters or not all(os.path.exists(item) for item in files):
+                previous = None
+            elif previous.get('sources') == sources:
+                print('{0} is up to date'.format(basename+'.json'))
+                return files
+
+        ximgs = self.select_files(self.zips_to_files(zipfiles, nprocs))
+        if not ximgs:
+            return []
+        checksums = zip_checksums(zipfiles)
+        infos = [{'source': os.path.basename(fn), 'checksum': checksums.get(fn)} for fn in ximgs]
+
+        plan = None
+        if max_megabytes > 0:
+            sizes = self.estimate_nbytes(ximgs, **kwargs)
+            if sum(sizes) > max_megabytes*1024*1024:
+                plan = plan_shards(sizes, max_megabytes*1024*1024, method, tolerance)
+
+        options = dict(writer_options or {})
+        if previous is not None and issubclass(WRITERS[fmt], shard_writer):
+            # keep the shards that would receive the very same tifs again
+            plan = plan or [list(range(len(ximgs)))]
+            names = shard_names(os.path.basename(basename), len(plan), WRITERS[fmt].extension)
+            before = dict((shard['file'], shard['arrays']) for shard in previous['shards'])
+            options['keep'] = {}
+            for shard, (name, indices) in enumerate(zip(names, plan)):
+                entries = before.get(name, [])
+                if [(entry['index'], entry.get('source'), entry.get('checksum')) for entry in entries] == \
+                   [(idx, infos[idx]['source'], infos[idx]['checksum']) for idx in indices]:
+                    options['keep'][shard] = entries
+            if options['keep']:
+                print('keeping {0} of {1} shards of {2}'.format(len(options['keep']), len(plan), basename))
+        kept = set(idx for shard in options.get('keep', {}) for idx in plan[shard])
+
+        # decoding the tifs round-robin over the shards lets the writer compress several shards at a time
+        order = interleave_plan(plan) if plan and issubclass(WRITERS[fmt], shard_writer) else range(len(ximgs))
+        with WRITERS[fmt](basename, max_megabytes, tolerance, plan=plan, nprocs=nprocs, **options) as writer:
+            writer.extra.update(sources=sources, parameters=parameters)
+            for idx in order:
+                array = None if idx in kept else self.read_file(ximgs[idx], **kwargs)
+                if array is None:
+                    writer.skip(idx)
+                else:
+                    writer.append(array, infos[idx], idx)
+
+        if previous is not None:
+            # shards of the previous run that are no longer part of the output
+            stale = set(shard['file'] for shard in previous['shards']) - set(os.path.basename(item) for item in writer.files)
+            for name in stale:
+                path = os.path.join(os.path.dirname(basename), name)
+                if os.path.isfile(path):
+                    os.remove(path)
+        return writer.files
+
+    def zips_to_npz(self, zipfiles, basename, max_megabytes=0, nprocs=1, method='greedy', tolerance=0.1,
+                    codec='zlib', level=None, **kwargs):
+        """ like zips_to_shards, writing .npz archives compressed with <codec> at <level> (see stores.open_npz) """
+        return self.zips_to_shards(zipfiles, basename, 'npz', max_megabytes, nprocs, method, tolerance,
+                                   writer_options={'codec': codec, 'level': level}, **kwargs)
+
+    def index(self, rex=None, lrex=None, key_rex=None, cache=None, filter_for_rex=".*tif"):
+        """ download and extract images and ground truth matching <rex> and <lrex> (class defaults if None)
+        and return a sample_index that pairs them by <key_rex>, index()[i] is the pair (image, label) of sample i
+        """
+        rex = self.images_rex if rex is None else rex
+        lrex = self.gt_rex if lrex is None else lrex
+
+        crex = re.compile(filter_for_rex)
+        ximgs = [item for item in self.zips_to_files(self.pull_images(rex=rex)) if crex.search(item)]
+        xgt = [item for item in self.zips_to_files(self.pull_gt(rex=lrex)) if crex.search(item)]
+
+        return sample_index(ximgs, xgt, key_rex=key_rex, cache=cache)
+
+    def images_to_numpy(self, rex=None, include_filenames=False, max_memory=None, **kwargs):
+        """ download images if needed and extract them into a list of numpy ndarrays
+        <rex> defaults to the images_rex of the class, arrays beyond <max_memory> bytes are spilled to disk,
+        keyword arguments (spill_dir, pages, roi, dtype, scaling, downcast) are passed on to files_to_numpy
+        """
 
         value = []
-        zips = self.pull_images(rex=rex)
+        rex = self.images_rex if rex is None else rex
+        with memory_stage('{0} download'.format(self.datasetid), report=max_memory is not None):
+            zips = self.pull_images(rex=rex)
 
         if not zips:
             return value
 
-        return self.zips_to_numpy(zips, include_filenames)
+        return self.zips_to_numpy(zips, include_filenames, max_memory=max_memory, **kwargs)
 
-    def gt_to_numpy(self, rex="", include_filenames=False):
-        """ download images if needed and extract them into a list of numpy ndarrays """
+    def gt_to_numpy(self, rex=None, include_filenames=False, max_memory=None, **kwargs):
+        """ download images if needed and extract them into a list of numpy ndarrays
+        <rex> defaults to the gt_rex of the class, arrays beyond <max_memory> bytes are spilled to disk,
+        keyword arguments (spill_dir, pages, roi, dtype, scaling, downcast) are passed on to files_to_numpy
+        """
 
         value = []
-        zips = self.pull_gt(rex=rex)
+        rex = self.gt_rex if rex is None else rex
+        with memory_stage('{0} download'.format(self.datasetid), report=max_memory is not None):
+            zips = self.pull_gt(rex=rex)
 
         if not zips:
             return value
 
-        return self.zips_to_numpy(zips, include_filenames)
+        return self.zips_to_numpy(zips, include_filenames, max_memory=max_memory, **kwargs)
 
 
 class ds_006(dataset):
 
-    def __init__(self, baseurl=None, datasetid=6):
-        if six.PY3:
-            super().__init__(baseurl=baseurl, datasetid=datasetid)
-        else:
-            dataset.__init__(self, baseurl=baseurl, datasetid=datasetid)
+    images_rex = ".*(1[1-9]|2[0-3]).zip"
+    gt_rex = "labels"
 
-    def images_to_numpy(self, rex=".*(1[1-9]|2[0-3]).zip"):
-        """ download images if needed and extract them into a list of numpy ndarrays """
-
-        if six.PY3:
-            return super().images_to_numpy(rex=rex)
-        else:
-            return dataset.images_to_numpy(rex=rex)
-
-    def gt_to_numpy(self, rex="labels"):
-        """ download images if needed and extract them into a list of numpy ndarrays """
-
-        if six.PY3:
-            return super().gt_to_numpy(rex=rex)
-        else:
-            return dataset.gt_to_numpy(rex=rex)
+    def __init__(self, baseurl=None, datasetid=6):
+        super().__init__(baseurl=baseurl, datasetid=datasetid)
 
 
 class ds_008(dataset):
 
     def __init__(self, baseurl=None, datasetid=8):
-        if six.PY3:
-            super().__init__(baseurl=baseurl, datasetid=datasetid)
-        else:
-            dataset.__init__(self, baseurl=baseurl, datasetid=datasetid)
+        super().__init__(baseurl=baseurl, datasetid=datasetid)
 
 
 class ds_027(dataset):
 
     def __init__(self, baseurl=None, datasetid=27):
-        if six.PY3:
-            super().__init__(baseurl=baseurl, datasetid=datasetid)
-        else:
-            dataset.__init__(self, baseurl=baseurl, datasetid=datasetid)
+        super().__init__(baseurl=baseurl, datasetid=datasetid)
 
 
 class ds_024(dataset):
 
+    images_rex = ".*TIFF.zip"
+    gt_rex = "foreground"
+
     def __init__(self, baseurl=None, datasetid=24):
-        if six.PY3:
-            super().__init__(baseurl=baseurl, datasetid=datasetid)
-        else:
-            dataset.__init__(self, baseurl=baseurl, datasetid=datasetid)
-
-    def images_to_numpy(self, rex=".*TIFF.zip"):
-        """ download images if needed and extract them into a list of numpy ndarrays """
-
-        if six.PY3:
-            return super().images_to_numpy(rex=rex)
-        else:
-            return dataset.images_to_numpy(rex=rex)
-
-    def gt_to_numpy(self, rex="foreground"):
-        """ download images if needed and extract them into a list of numpy ndarrays """
-
-        if six.PY3:
-            return super().gt_to_numpy(rex=rex)
-        else:
-            return dataset.gt_to_numpy(rex=rex)
+        super().__init__(baseurl=baseurl, datasetid=datasetid)
+
+
+# dataset classes of the tested datasets by BBBC number, all others are served by dataset itself
+REGISTRY = {6: ds_006, 8: ds_008, 24: ds_024, 27: ds_027}
+
+
+def dataset_number(item):
+    """ return the BBBC number of <item> given as number or name (6, '6', 'BBBC006') """
+    return int(str(item).upper().replace('BBBC', ''))
+
+
+def get_dataset(item, experimental=True):
+    """ create the dataset <item> (number or name, see dataset_number) with its class from REGISTRY,
+    datasets that are not registered give a plain dataset if <experimental> and a KeyError otherwise """
+    dsid = dataset_number(item)
+    if dsid not in REGISTRY and not experimental:
+        raise KeyError('BBBC{0:03} is not among the tested datasets {1}'.format(dsid, sorted(REGISTRY)))
+    return REGISTRY.get(dsid, dataset)(datasetid=dsid)
+
+
+def shard_jobs(jobs, index, count):
+    """ keep the files of <jobs> (see pull_many) that part <index> of <count> (counting from 0) is to pull,
+    all files of all jobs are split into <count> parts of about the same number of bytes (see download.split_by_size)
+    with the sizes known from the catalog (or the server), so <count> nodes together pull every file exactly once
+    returns the jobs with their file lists reduced to those of part <index>
+    """
+    items = [(pos, fname) for pos, job in enumerate(jobs) for fname in job[1]]
+    sizes = [jobs[pos][0].expected_size(fname) for pos, fname in items]
+    keys = [(jobs[pos][0].datasetid, os.path.split(fname)[-1]) for pos, fname in items]
+    mine = split_by_size(sizes, count, keys)[index]
+    value = [(job[0], []) + tuple(job[2:]) for job in jobs]
+    for idx in mine:
+        pos, fname = items[idx]
+        value[pos][1].append(fname)
+    print('shard {0}/{1}: {2} of {3} files, {4:.04} of {5:.04} MB'.format(
+        index, count, len(mine), len(items), sum(sizes[idx] for idx in mine)/(1024.*1024.), sum(sizes)/(1024.*1024.)))
+    return value
+
+
+class prefetch_handle(object):
+    """ files being staged in a background thread, see dataset.prefetch and b3get.prefetch
+    result(), done(), exception() and add_done_callback() are those of the concurrent.futures.Future of the
+    thread, progress() tells how far it got
+    """
+
+    def __init__(self, func):
+        """ run <func>(handle) in a background thread, whatever it returns is the result """
+        self.stage = 'pending'
+        self.received = 0
+        self.expected = 0
+        self._base = 0
+        self._lock = threading.Lock()
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.future = executor.submit(self._run, func)
+        executor.shutdown(wait=False)
+
+    def _run(self, func):
+        try:
+            value = func(self)
+        except Exception:
+            self.stage = 'failed'
+            raise
+        self.stage = 'done'
+        return value
+
+    def _progress(self, received, expected):
+        """ count the bytes of one pull_many, those of earlier ones are done """
+        with self._lock:
+            if received == 0:
+                self._base = self.received
+                self.expected = self._base + expected
+            self.received = self._base + received
+
+    def progress(self):
+        """ return a dict with the stage (pending, listing, downloading, extracting, done or failed),
+        the bytes received so far and the bytes expected (of the files that were not present yet) """
+        with self._lock:
+            return {'stage': self.stage, 'received': self.received, 'expected': self.expected}
+
+    def result(self, timeout=None):
+        """ wait at most <timeout> seconds (forever if None) for the files and return them """
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future.done()
+
+    def exception(self, timeout=None):
+        return self.future.exception(timeout)
+
+    def add_done_callback(self, func):
+        """ call <func>(handle) once the files are staged or staging failed """
+        self.future.add_done_callback(lambda future: func(self))
+
+
+def stage_files(handle, jobs, extract=True, nprocs=1, **kwargs):
+    """ pull the files of <jobs> (see pull_many, keyword arguments are passed on) reporting to the
+    prefetch_handle <handle>, with <extract> extract them as well
+    returns one list per job, the extracted files with <extract>, the zip files otherwise
+    """
+    handle.stage = 'downloading'
+    zips = pull_many(jobs, nprocs, progress=handle._progress, **kwargs)
+    if not extract:
+        return zips
+    handle.stage = 'extracting'
+    return [job[0].zips_to_files(files, nprocs) for job, files in zip(jobs, zips)]
+
+
+def _drop_unpinned(ds, lock, done, todo, report=None):
+    """ split the files of <done> and <todo> (see dataset.plan_downloads) that <lock> records with their url off
+    the others, which are reported (appended to <report>) as failed, returns the remaining done and todo """
+    def pinned(url, dstf):
+        entry = lock.get(dstf) if lock is not None else None
+        return entry is not None and entry['url'] == url
+
+    items = [("/".join([ds.baseurl.rstrip('/'), os.path.split(item)[-1]]), item, None) for item in done]
+    items += [(url, os.path.join(dstdir, os.path.split(url)[-1]), size) for url, dstdir, size in todo]
+    dropped = set()
+    for url, dstf, size in items:
+        if pinned(url, dstf):
+            continue
+        where = lock.path if lock is not None else 'any lock file'
+        print('E {0} is not recorded in {1}, skipping it'.format(dstf, where))
+        dropped.add(dstf)
+        if report is not None:
+            report.append({'url': url, 'file': dstf, 'expected_size': size, 'received_size': 0, 'attempts': 0,
+                           'error': 'not recorded in {0}'.format(where)})
+    return ([item for item in done if item not in dropped],
+            [job for job in todo if os.path.join(job[1], os.path.split(job[0])[-1]) not in dropped])
+
+
+def pull_many(jobs, nprocs=1, max_rate=None, adaptive=False, policy=None, report=None, lock=None, locked=False,
+              cache=False, shard=None, mirrors=None, progress=None):
+    """ download the files of several datasets through one global queue of <nprocs> downloads,
+    <jobs> is a list of (dataset, filelist) or (dataset, filelist, dstdir) as for dataset.pull_files,
+    so fetching several datasets takes about as long as the largest of them,
+    <max_rate> and <adaptive> limit all downloads together, <policy> and <report> handle failures (see download.download_files)
+
+    with <cache> files missing in dstdir are fetched into the shared cache (the tmp_location of the dataset, see
+    utils.tmp_location) unless they are there already, and then hardlinked, reflinked or copied into dstdir
+    (see download.materialize), so several folders pulling the same dataset download and store it once
+
+    with <shard> (i, n) only part i of n of the files is pulled (see shard_jobs), the others are left to other nodes
+
+    every file is fetched from the fastest of its sources: the mirrors in <mirrors> (list of URLs or folders,
+    $B3GET_MIRRORS if None, see download.mirror_list) and the dataset site, the others are tried if that fails
+    <progress> is called with the bytes received so far and the bytes to download (see download.download_files)
+
+    the url, size and SHA-256 (computed while the bytes stream in) of all files are recorded in the download.lockfile
+    <lock>, which is saved; with <locked> the lock is only read: locked files that still have their locked size and
+    modification time are trusted, the other locked files are downloaded and have to match their locked SHA-256
+    (those that don't are removed and reported), files the lock does not record are neither downloaded nor
+    returned but reported
+    returns one list of files per job, each holding the files present with the expected size
+    """
+    value = []
+    queue = []    # (url, folder, expected size) to download
+    pending = []  # (url, file, expected size, job index) to deliver
+    links = {}    # file in the cache to the files in dstdir it is materialized as
+    queued = set()
+    present = set()
+    urls = {}
+    if shard is not None:
+        jobs = shard_jobs(jobs, *shard)
+    for job in jobs:
+        ds, filelist = job[:2]
+        done, todo = ds.plan_downloads(filelist, job[2] if len(job) > 2 else None, lock=lock if locked else None)
+        if locked:
+            done, todo = _drop_unpinned(ds, lock, done, todo, report)
+        urls.update((item, "/".join([ds.baseurl.rstrip('/'), os.path.split(item)[-1]])) for item in done)
+        value.append(done)
+        for url, dstdir, size in todo:
+            dstf = os.path.join(dstdir, os.path.split(url)[-1])
+            pending.append((url, dstf, size, len(value) - 1))
+            if not cache or os.path.abspath(dstdir) == os.path.abspath(ds.tmp_location):
+                srcf, folder = dstf, dstdir
+            else:
+                srcf, folder = os.path.join(ds.tmp_location, os.path.split(url)[-1]), ds.tmp_location
+                links.setdefault(srcf, [])
+                if dstf not in links[srcf]:
+                    links[srcf].append(dstf)
+                if size and has_size(srcf, size):
+                    present.add(srcf)
+                    continue
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+            # every file is downloaded once, however many jobs ask for it
+            if os.path.abspath(srcf) not in queued:
+                queued.add(os.path.abspath(srcf))
+                queue.append((url, folder, size))
+
+    hashes = {}
+    mirrors = mirrors if isinstance(mirrors, mirror_list) else mirror_list(mirrors)
+    present.update(download_files(queue, nprocs, max_rate=max_rate, adaptive=adaptive, policy=policy, report=report,
+                                  hashes=hashes, mirrors=mirrors, progress=progress))
+    for srcf, dstfs in links.items():
+        if srcf not in present:
+            continue
+        for dstf in dstfs:
+            print('{0} {1} to {2}'.format(materialize(srcf, dstf), srcf, dstf))
+            present.add(dstf)
+            if srcf in hashes:
+                hashes[dstf] = hashes[srcf]
+
+    for url, dstf, size, idx in pending:
+        if dstf not in present:
+            continue
+        entry = lock.get(dstf) if locked and lock is not None else None
+        digest = hashes.get(dstf) or (file_sha256(dstf) if entry is not None else None)
+        if entry is not None and entry['sha256'] != digest:
+            print('E {0} does not match the SHA-256 recorded in {1}, removing it'.format(dstf, lock.path))
+            for item in [dstf] + [srcf for srcf, linked in links.items() if dstf in linked]:
+                if os.path.isfile(item):
+                    os.remove(item)
+            if report is not None:
+                report.append({'url': url, 'file': dstf, 'expected_size': size, 'received_size': size, 'attempts': 1,
+                               'error': 'SHA-256 {0} does not match the locked {1}'.format(digest, entry['sha256'])})
+            continue
+        urls[dstf] = url
+        value[idx].append(dstf)
+
+    if lock is not None and not locked:
+        for files in value:
+            for fname in files:
+                if fname in hashes or not lock.matches(fname):
+                    lock.record(fname, urls[fname], hashes.get(fname))
+        lock.save()
+
+    return value
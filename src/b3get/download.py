@@ -0,0 +1,821 @@
+""" the download engine: fetching the zip files of the BBBC over http with retries, resumed ranges and mirrors,
+reading remote zip listings through range requests, locking and materializing the cache of the zip files """
+import tempfile
+import io
+import os
+import re
+import requests
+import tqdm
+import time
+import random
+import hashlib
+import heapq
+import json
+import struct
+import shutil
+import sys
+import numpy as np
+import tifffile
+import zipfile
+import threading
+from collections import OrderedDict, deque
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+from multiprocessing import cpu_count
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+from b3get.utils import BBBC_ROOT, tif_header
+
+
+class transient_error(IOError):
+    """ failure of a request that may well succeed when repeated, e.g. a connection dropped mid-transfer """
+
+
+class retry_policy(object):
+    """ how to repeat requests that failed for transient reasons (connection problems, timeouts,
+    HTTP status 408, 429 and 5xx, see retryable): up to <retries> times, waiting <backoff>*2**attempt seconds
+    (at most <max_backoff>, at least what a Retry-After header asks for) reduced by a random <jitter> fraction
+    so that parallel workers do not retry in lock step
+
+    requests get a <connect_timeout> and a read timeout that starts at <read_timeout> and grows by one second
+    per <min_rate> bytes expected from the request, up to <max_read_timeout>
+    """
+
+    def __init__(self, retries=4, backoff=0.5, max_backoff=30., jitter=0.5,
+                 connect_timeout=3.05, read_timeout=10., min_rate=1024*1024, max_read_timeout=120.):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.min_rate = min_rate
+        self.max_read_timeout = max_read_timeout
+
+    def timeout(self, nbytes=None):
+        """ return the (connect, read) timeouts for a request that is expected to return <nbytes> """
+        read = self.read_timeout + (nbytes or 0)/float(self.min_rate)
+        return (self.connect_timeout, min(read, self.max_read_timeout))
+
+    def delay(self, attempt, error=None):
+        """ return the seconds to wait before retry number <attempt> (counting from 0) after <error> """
+        value = min(self.max_backoff, self.backoff*2**attempt)*(1. - self.jitter*random.random())
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            value = max(value, min(float(retry_after), self.max_backoff))
+        return value
+
+    def retryable(self, error):
+        """ return True if the request that failed with <error> is worth repeating """
+        if isinstance(error, requests.exceptions.HTTPError):
+            status = error.response.status_code if error.response is not None else 0
+            return status in (408, 429) or status >= 500
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                                  requests.exceptions.ChunkedEncodingError, transient_error))
+
+    def call(self, func, *args, **kwargs):
+        """ return func(*args, **kwargs), repeating it as long as it fails for transient reasons,
+        the final error is raised with the number of attempts made stored as its attempts attribute """
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as ex:
+                if attempt >= self.retries or not self.retryable(ex):
+                    ex.attempts = attempt + 1
+                    raise
+                time.sleep(self.delay(attempt, ex))
+                attempt += 1
+
+
+# retry policy of all requests that are not given one explicitly
+DEFAULT_RETRY = retry_policy()
+
+
+def _head(url, timeout):
+    r = requests.head(url, timeout=timeout, allow_redirects=True)
+    r.raise_for_status()
+    return r
+
+
+def size_of_content(url, policy=None):
+    """ given an URL, return the number of bytes stored in the header attribute content-length
+    transient failures are retried according to <policy> (DEFAULT_RETRY if None), returns 0 if that fails """
+    policy = policy or DEFAULT_RETRY
+    try:
+        r = policy.call(_head, url, policy.timeout())
+    except Exception as ex:
+        print('E unable to obtain the size of {0} after {1} attempt(s): {2}'.format(url, getattr(ex, 'attempts', 1), ex))
+        return 0
+
+    value = int(r.headers.get('content-length', 0))
+    return value
+
+
+class http_range_file(io.RawIOBase):
+    """ read-only, seekable file object on top of <url> that fetches only the bytes read from it
+    through HTTP range requests, so that e.g. zipfile can read the central directory of a remote archive """
+
+    def __init__(self, url, size=None, block_bytes=64*1024, max_blocks=64, policy=None):
+        """ read <url> (of <size> bytes, obtained from the server if None) in blocks of <block_bytes>,
+        keeping the <max_blocks> most recently used ones, requests are retried according to <policy> """
+        io.RawIOBase.__init__(self)
+        self.policy = policy or DEFAULT_RETRY
+        self.url = url
+        self.size = size_of_content(url, self.policy) if size is None else size
+        self.block_bytes = block_bytes
+        self.max_blocks = max_blocks
+        self.nrequests = 0
+        self._pos = 0
+        self._blocks = OrderedDict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def _block(self, index):
+        """ return block <index> of the remote file, fetching it if it is not among the recently used ones """
+        if index in self._blocks:
+            value = self._blocks.pop(index)
+            self._blocks[index] = value
+            return value
+
+        start = index*self.block_bytes
+        stop = min(start + self.block_bytes, self.size) - 1
+        value = self.policy.call(self._fetch, start, stop)
+        self._blocks[index] = value
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return value
+
+    def _fetch(self, start, stop):
+        """ return the bytes <start> to <stop> (inclusive) of the remote file """
+        r = requests.get(self.url, headers={'Range': 'bytes={0}-{1}'.format(start, stop)},
+                         timeout=self.policy.timeout(stop - start + 1))
+        self.nrequests += 1
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError('{0} does not support range requests (status {1})'.format(self.url, r.status_code))
+        return r.content
+
+    def readinto(self, b):
+        view = memoryview(b)
+        nbytes = min(len(view), max(self.size - self._pos, 0))
+        done = 0
+        while done < nbytes:
+            index, start = divmod(self._pos, self.block_bytes)
+            block = self._block(index)
+            chunk = block[start:start + nbytes - done]
+            if not chunk:
+                break
+            view[done:done + len(chunk)] = chunk
+            done += len(chunk)
+            self._pos += len(chunk)
+        return done
+
+
+def describe_zip(source, filter_for_rex=".*tif"):
+    """ list the members of zip file <source> (path or seekable file object) that match <filter_for_rex>
+    returns a list of dicts with member name, shape, dtype, compressed and decoded size in bytes,
+    only the zip central directory and the tif headers of each member are read, no pixels are decoded
+    """
+    value = []
+    crex = re.compile(filter_for_rex)
+    with zipfile.ZipFile(source, 'r') as zf:
+        for info in zf.infolist():
+            if info.filename.endswith('/') or "__MACOSX" in info.filename or not crex.search(info.filename):
+                continue
+            entry = {'name': info.filename, 'shape': None, 'dtype': None,
+                     'compressed_size': info.compress_size, 'decoded_size': None}
+            try:
+                if info.compress_type == zipfile.ZIP_STORED:
+                    # uncompressed members are read in place, so only their headers are touched
+                    zf.fp.seek(info.header_offset)
+                    name_len, extra_len = struct.unpack('<HH', zf.fp.read(30)[26:30])
+                    offset = info.header_offset + 30 + name_len + extra_len
+                    shape, dtype = tif_header(tifffile.TiffFile(zf.fp, name=info.filename, offset=offset,
+                                                                size=info.file_size))
+                else:
+                    with zf.open(info) as member:
+                        shape, dtype = tif_header(tifffile.TiffFile(member))
+                entry['shape'] = shape
+                entry['dtype'] = str(dtype)
+                entry['decoded_size'] = int(np.prod(shape))*dtype.itemsize
+            except Exception as ex:
+                print('unable to read the tif header of {0} due to {1}'.format(info.filename, ex))
+            value.append(entry)
+    return value
+
+
+def serial_download_file(url, dstfolder, chunk_bytes=1024*1024, npos=None, limiter=None, monitor=None,
+                         policy=None, expected_size=None, hashes=None, writer='readinto', preallocate=True,
+                         mirrors=None):
+    """ download file from <url> into folder <dstfolder>, <url> may also be a file:// URL or a local path
+    every chunk received is paid for at the token_bucket <limiter> and counted by the concurrency_limit <monitor>
+    transient failures are retried according to the retry_policy <policy> (DEFAULT_RETRY if None) with timeouts
+    fit for <expected_size> bytes, the error of the last attempt is raised if all of them fail
+    the SHA-256 of the bytes is computed while they stream in and stored in the dict <hashes> under the path
+    <writer> is one of DOWNLOAD_WRITERS: 'readinto' receives into one reused buffer of <chunk_bytes> and writes it
+    out when full, 'iter_content' writes every chunk requests hands out; with <preallocate> the file is given its
+    full size before the first byte arrives, the bytes go to a part file of this process and thread
+    (<file>.<pid>-<thread>.part) until the download is complete, so concurrent downloads of the same file
+    (e.g. by two users into a shared cache) don't write into each other's bytes and the last complete one wins
+    with the mirror_list <mirrors> the file is fetched from its fastest source, the next one is tried if that fails
+    returns the full path of the successfully downloaded file
+    """
+
+    if not os.path.exists(dstfolder):
+        print('E destination path {} does not exist'.format(dstfolder))
+        return ""
+    if writer not in DOWNLOAD_WRITERS:
+        raise ValueError('unknown download writer {0}, use one of {1}'.format(writer, ', '.join(DOWNLOAD_WRITERS)))
+    policy = policy or DEFAULT_RETRY
+    _, fname = os.path.split(url)
+    dstf = os.path.join(dstfolder, fname)
+    sources = mirrors.rank(url, expected_size) if mirrors is not None else [url]
+    for pos, source in enumerate(sources):
+        try:
+            digest = policy.call(_fetch_file, source, dstf, chunk_bytes, npos, limiter, monitor,
+                                 policy.timeout(expected_size), writer, preallocate)
+            break
+        except Exception as ex:
+            if pos + 1 == len(sources):
+                raise
+            print('W fetching {0} failed ({1}), trying {2}'.format(source, ex, sources[pos + 1]))
+    if hashes is not None:
+        hashes[dstf] = digest
+    return dstf
+
+
+def _fetch_file(url, dstf, chunk_bytes, npos, limiter, monitor, timeout, writer='readinto', preallocate=True):
+    """ one attempt of serial_download_file, returns the SHA-256 hex digest of the file """
+    path = local_path(url)
+    if path is not None:
+        r = None
+        source = open(path, 'rb')
+        total_length = os.fstat(source.fileno()).st_size
+    else:
+        r = requests.get(url, stream=True, timeout=timeout)
+        r.raise_for_status()
+        source = _response_source(r)
+        total_length = int(r.headers.get('content-length', 0))
+
+    # files of the expected size are skipped by the callers, so whatever is at <dstf> is not to be trusted
+    sha = hashlib.sha256()
+    part = '{0}.{1}-{2}.part'.format(dstf, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(part, 'wb') as fo:
+
+            if total_length == 0:  # no content length header or an empty file
+                data = r.content if r is not None else b''
+                fo.write(data)
+                sha.update(data)
+            else:
+                if preallocate:
+                    preallocate_file(fo, total_length)
+                if not npos:
+                    pbar = tqdm.tqdm(total=total_length, unit='B', unit_scale=True)
+                else:
+                    pbar = tqdm.tqdm(total=total_length, unit='B', unit_scale=True, position=npos)
+
+                if writer == 'iter_content' and r is not None:
+                    nbytes = 0
+                    for data in r.iter_content(chunk_size=chunk_bytes):
+                        fo.write(data)
+                        sha.update(data)
+                        pbar.update(len(data))
+                        nbytes += len(data)
+                        if limiter is not None:
+                            limiter.consume(len(data))
+                        if monitor is not None:
+                            monitor.record(len(data))
+                else:
+                    nbytes = _stream_into(source, fo, sha, chunk_bytes, pbar, limiter, monitor)
+                pbar.close()
+                fo.truncate(nbytes)  # drop what was preallocated but not received
+
+                if nbytes != total_length:
+                    error = transient_error('received {0} of {1} bytes from {2}'.format(nbytes, total_length, url))
+                    error.received = nbytes
+                    raise error
+        os.replace(part, dstf)
+    finally:
+        (source if r is None else r).close()
+        if os.path.isfile(part):
+            os.remove(part)
+
+    return sha.hexdigest()
+
+
+DOWNLOAD_WRITERS = ('readinto', 'iter_content')
+
+
+def preallocate_file(handle, nbytes):
+    """ reserve <nbytes> on disk for the open file <handle> so that writing it doesn't fragment it,
+    uses posix_fallocate where there is one, a no-op elsewhere """
+    if nbytes > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(handle.fileno(), 0, nbytes)
+        except OSError:  # not supported by the file system
+            pass
+
+
+def _response_source(response):
+    """ return what to readinto the body of the streamed requests <response> from: its urllib3 response,
+    which decodes gzip or deflate encoded bodies as they are read """
+    response.raw.decode_content = True
+    return response.raw
+
+
+def _stream_into(source, handle, sha, chunk_bytes, pbar=None, limiter=None, monitor=None,
+                 progress_bytes=8*1024*1024):
+    """ copy the bytes of <source> (a file or see _response_source) to <handle> through one buffer of <chunk_bytes>
+    (rounded up to 64 kB) that is filled with readinto and written whenever it is full, so every write but
+    the last one has the same aligned size and no bytes object is created per chunk
+    <sha>, <limiter> and <monitor> see every full buffer, <pbar> is updated every <progress_bytes>
+    returns the number of bytes received
+    """
+    block = 64*1024
+    buf = bytearray(max(block, -(-chunk_bytes // block)*block))
+    view = memoryview(buf)
+    nbytes, pending = 0, 0
+    while True:
+        filled = 0
+        while filled < len(buf):
+            count = source.readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+        if not filled:
+            break
+        handle.write(view[:filled])
+        sha.update(view[:filled])
+        nbytes += filled
+        pending += filled
+        if limiter is not None:
+            limiter.consume(filled)
+        if monitor is not None:
+            monitor.record(filled)
+        if pbar is not None and pending >= progress_bytes:
+            pbar.update(pending)
+            pending = 0
+        if filled < len(buf):
+            break
+    if pbar is not None and pending:
+        pbar.update(pending)
+    return nbytes
+
+
+def benchmark_download(url, dstfolder=None, writers=DOWNLOAD_WRITERS, repeats=3, chunk_bytes=1024*1024):
+    """ download <url> <repeats> times with each of <writers> (see serial_download_file) into a scratch folder
+    inside <dstfolder> (the system temporary folder if None), which is removed afterwards, so files already
+    present in <dstfolder> are left alone
+    returns a list of dicts with writer, seconds (fastest repeat), throughput (MB per second) and cpu_seconds
+    (process time of the fastest repeat)
+    """
+    value = []
+    scratch = tempfile.mkdtemp(prefix='b3get-benchmark-', dir=dstfolder)
+    dstf = os.path.join(scratch, os.path.split(url)[-1])
+    try:
+        for writer in writers:
+            best = None
+            for _ in range(repeats):
+                start, cpu = time.time(), time.process_time()
+                serial_download_file(url, scratch, chunk_bytes, writer=writer, preallocate=writer != 'iter_content')
+                timing = (max(time.time() - start, 1e-9), time.process_time() - cpu)
+                best = timing if best is None or timing < best else best
+                nbytes = os.stat(dstf).st_size
+                os.remove(dstf)
+            value.append({'writer': writer, 'seconds': best[0], 'cpu_seconds': best[1],
+                          'throughput': nbytes/(1024.*1024.)/best[0]})
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return value
+
+
+def local_path(url):
+    """ return the path of the file <url> refers to if it is a file:// URL or a path, None for other URLs """
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return url2pathname(parsed.path)
+    if len(parsed.scheme) <= 1:  # a path, maybe with a windows drive letter
+        return url
+    return None
+
+
+def probe_source(url, nbytes=256*1024, timeout=(3.05, 10.)):
+    """ measure the source of <url> (URL or path) by reading the first <nbytes> of it
+    returns (latency, throughput): seconds until the first byte and bytes per second after it,
+    (inf, 0) if <url> can't be read """
+    start = time.time()
+    try:
+        path = local_path(url)
+        if path is not None:
+            with open(path, 'rb') as fi:
+                first = time.time()
+                nread = len(fi.read(nbytes))
+        else:
+            r = requests.get(url, headers={'Range': 'bytes=0-{0}'.format(nbytes - 1)}, stream=True, timeout=timeout)
+            r.raise_for_status()
+            first = time.time()
+            nread = len(r.raw.read(nbytes))
+            r.close()
+    except Exception as ex:
+        print('W unable to probe {0}: {1}'.format(url, ex))
+        return float('inf'), 0.
+    return first - start, nread/max(time.time() - first, 1e-6)
+
+
+class mirror_list(object):
+    """ ordered list of mirrors of BBBC_ROOT: other HTTP servers, file:// URLs or local folders holding the
+    datasets in the same layout (<mirror>/BBBC008/BBBC008_v1_images.zip), the origin is the last resort
+    every source is probed once with the first file asked for (see probe_source) and the sources of a file are
+    ranked by the time they are expected to take for it: latency plus size over throughput
+    """
+
+    def __init__(self, mirrors=None, origin=BBBC_ROOT, probe_bytes=256*1024):
+        """ <mirrors> is a list of URLs or folders, None means the comma separated list in $B3GET_MIRRORS """
+        if mirrors is None:
+            mirrors = [item.strip() for item in os.environ.get('B3GET_MIRRORS', '').split(',') if item.strip()]
+        self.mirrors = list(mirrors)
+        self.origin = origin
+        self.probe_bytes = probe_bytes
+        self._probes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def sources(self, url):
+        """ return where <url> can be had from: the same file on every mirror, then <url> itself,
+        only <url> if it does not lie below the origin """
+        if not self.mirrors or not url.startswith(self.origin):
+            return [url]
+        relative = url[len(self.origin):].lstrip('/')
+        value = []
+        for mirror in self.mirrors:
+            if local_path(mirror) is not None and not mirror.startswith('file:'):
+                value.append(os.path.join(mirror, *relative.split('/')))
+            else:
+                value.append(mirror.rstrip('/') + '/' + relative)
+        return value + [url]
+
+    def probe(self, root, url):
+        """ return (latency, throughput) of source <root>, probed with file <url> on first use """
+        with self._lock:
+            if root not in self._probes:
+                self._probes[root] = probe_source(url, self.probe_bytes)
+            return self._probes[root]
+
+    def rank(self, url, size=None):
+        """ return the sources of <url> (see sources) fastest first for a file of <size> bytes,
+        sources that could not be probed come last, in the order given """
+        sources = self.sources(url)
+        if len(sources) == 1:
+            return sources
+        estimates = []
+        for pos, (root, source) in enumerate(zip(self.mirrors + [self.origin], sources)):
+            latency, throughput = self.probe(root, source)
+            seconds = latency + (size or 0)/throughput if throughput > 0 else float('inf')
+            estimates.append((seconds, pos, source))
+        return [source for _, _, source in sorted(estimates)]
+
+
+def file_sha256(path, block_bytes=1024*1024):
+    """ return the SHA-256 hex digest of file <path> """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fi:
+        for block in iter(lambda: fi.read(block_bytes), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class lockfile(object):
+    """ record of the files pulled into a folder (b3get.lock): url, size and SHA-256 of each of them plus
+    the modification time they had when they were recorded, so that a file can be trusted after one stat """
+
+    def __init__(self, path):
+        """ read the lock file <path> (a folder means <path>/b3get.lock), it doesn't need to exist """
+        self.path = os.path.join(path, 'b3get.lock') if os.path.isdir(path) else path
+        self.basedir = os.path.dirname(os.path.abspath(self.path))
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as fi:
+                self.entries = json.load(fi).get('files', {})
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.basedir).replace(os.sep, '/')
+
+    def get(self, path):
+        """ return the entry (url, size, sha256, mtime) of file <path>, None if it isn't locked """
+        return self.entries.get(self._key(path))
+
+    def matches(self, path):
+        """ return True if file <path> is locked and still has the size and modification time it was locked with """
+        entry = self.get(path)
+        if entry is None or not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry.get('mtime')
+
+    def record(self, path, url, sha256=None):
+        """ lock file <path> downloaded from <url> with its SHA-256 (computed from the file if None) """
+        stat = os.stat(path)
+        self.entries[self._key(path)] = {'url': url, 'size': stat.st_size, 'sha256': sha256 or file_sha256(path),
+                                         'mtime': stat.st_mtime_ns}
+
+    def save(self):
+        """ write the lock file, replacing the previous one in one step, entries that others (e.g. other nodes
+        pulling another shard into the same folder) saved in the meantime are kept """
+        if os.path.isfile(self.path):
+            with open(self.path) as fi:
+                self.entries = dict(json.load(fi).get('files', {}), **self.entries)
+        tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as fo:
+            json.dump({'version': 1, 'files': self.entries}, fo, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        return self.path
+
+
+FICLONE = 0x40049409  # linux ioctl to share the extents of one file with another (btrfs, xfs, ...)
+
+
+def reflink(src, dst):
+    """ create <dst> as a copy on write clone of file <src>, raises OSError where the file system can't do that """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError('reflinks are only supported on linux')
+    with open(src, 'rb') as fi, open(dst, 'wb') as fo:
+        fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+    shutil.copystat(src, dst)
+
+
+def materialize(src, dst):
+    """ make file <src> (e.g. in the shared cache) available as <dst> as cheaply as the file systems allow:
+    a hardlink (same file, no extra space), a reflink (copy on write) or else a plain copy, an existing <dst>
+    is replaced; files are never modified in place by b3get, so a linked <dst> can't change <src>
+    returns the way it was done: 'hardlink', 'reflink' or 'copy'
+    """
+    if os.path.isfile(dst) and os.path.samefile(src, dst):
+        return 'hardlink'
+    tmp = dst + '.link'
+    for method, func in (('hardlink', os.link), ('reflink', reflink)):
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            func(src, tmp)
+        except OSError:
+            continue
+        os.replace(tmp, dst)
+        return method
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+    return 'copy'
+
+
+def wrap_serial_download_file(args):
+    """ wrap serial_download to unpack args """
+
+    return serial_download_file(*args)
+
+
+def largest_first(sizes):
+    """ return the indices of <sizes> ordered by decreasing size (ties keep their order, unknown sizes last) """
+    return sorted(range(len(sizes)), key=lambda idx: -(sizes[idx] or 0))
+
+
+def has_size(path, size):
+    """ return True if <path> is a file of <size> bytes, of any size if <size> is unknown (0 or None) """
+    return os.path.isfile(path) and (not size or os.stat(path).st_size == size)
+
+
+class token_bucket(object):
+    """ bandwidth limit shared by threads: on average <rate> bytes per second with bursts of up to <burst> bytes,
+    a rate of None or 0 does not limit anything """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else (rate or 0)
+        self.tokens = self.burst
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """ take <nbytes> tokens, waiting until the bucket has refilled enough if it runs into debt """
+        if not self.rate:
+            return 0.
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self._stamp)*self.rate)
+            self._stamp = now
+            self.tokens -= nbytes
+            wait = -self.tokens/self.rate if self.tokens < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class concurrency_limit(object):
+    """ number of downloads allowed to run at the same time, between 1 and <maximum>
+
+    with <adaptive>, the limit starts at <start> and is adjusted every <interval> seconds from the aggregate
+    throughput measured over that interval: it grows by one as long as that raises throughput by more than <gain>,
+    steps back by one when throughput falls by more than <gain> and is halved when downloads failed,
+    otherwise it stays at <maximum>; <listener> is called with the number of bytes received so far
+    whenever some arrived
+    """
+
+    def __init__(self, maximum, adaptive=False, start=2, interval=2., gain=0.1, listener=None):
+        self.maximum = max(int(maximum), 1)
+        self.adaptive = adaptive
+        self.limit = min(max(int(start), 1), self.maximum) if adaptive else self.maximum
+        self.interval = interval
+        self.gain = gain
+        self.active = 0
+        self.received = 0
+        self.listener = listener
+        self.throughput = None
+        self.history = [self.limit]
+        self._grow = True
+        self._nbytes = 0
+        self._errors = 0
+        self._stamp = time.time()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """ wait until one more download may run """
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait(self.interval)
+                self._adapt()
+            self.active += 1
+
+    def release(self, failed=False):
+        """ mark a download as done, <failed> downloads count as errors """
+        with self._cond:
+            self.active -= 1
+            self._errors += int(bool(failed))
+            self._adapt()
+            self._cond.notify_all()
+
+    def record(self, nbytes):
+        """ count <nbytes> received """
+        with self._cond:
+            self._nbytes += nbytes
+            self.received += nbytes
+            received = self.received
+            if self._adapt():
+                self._cond.notify_all()
+        if self.listener is not None:
+            self.listener(received)
+
+    def _adapt(self):
+        """ adjust the limit once per interval, returns True if it changed (call with the lock held) """
+        now = time.time()
+        if not self.adaptive or now - self._stamp < self.interval:
+            return False
+
+        throughput = self._nbytes/(now - self._stamp)
+        limit = self.limit
+        if self._errors:
+            limit, self._grow = max(limit//2, 1), False
+        elif self.throughput is None or throughput > self.throughput*(1 + self.gain):
+            # the last step paid off, keep going in that direction
+            limit = limit + 1 if self._grow else max(limit - 1, 1)
+        elif throughput < self.throughput*(1 - self.gain):
+            self._grow = not self._grow
+            limit = limit + 1 if self._grow else max(limit - 1, 1)
+        self.limit = min(limit, self.maximum)
+        self.throughput = throughput
+        self._nbytes, self._errors, self._stamp = 0, 0, now
+        self.history.append(self.limit)
+        return self.limit != self.history[-2]
+
+
+def download_files(jobs, nprocs=1, chunk_bytes=1024*1024, max_rate=None, adaptive=False, policy=None, report=None,
+                   hashes=None, mirrors=None, progress=None):
+    """ download all <jobs> (list of (url, destination folder, expected size in bytes)) with one pool
+    of <nprocs> threads (nprocs=-1 means all CPUs), so jobs of different datasets share the same limit
+    the largest files are handed out first and every worker takes the next file as soon as it is idle,
+    so no worker is left with the big files at the end
+    all workers together receive at most <max_rate> bytes per second (see token_bucket), with <adaptive>
+    at most <nprocs> downloads run at a time as long as that raises throughput (see concurrency_limit)
+    failed requests are retried according to <policy> (see retry_policy), a file that can't be downloaded
+    does not stop the others, it is described by a dict (url, file, expected_size, received_size,
+    attempts, error) appended to the list <report>, the SHA-256 of the files downloaded are stored in the dict <hashes>
+    every file is fetched from the fastest of its sources in the mirror_list <mirrors> (see serial_download_file)
+    <progress> is called with the bytes received so far and the bytes of all <jobs> whenever some arrived
+    an expected size of 0 or None is unknown (e.g. the HEAD request failed), such files are taken as they come,
+    the content-length of the download itself is checked anyway
+    returns the files that were downloaded with their expected size, in the order of <jobs>
+    """
+    value = []
+    if not jobs:
+        return value
+
+    nprocs = cpu_count() if nprocs < 0 else nprocs
+    total_bytes = sum(size or 0 for _, _, size in jobs)
+    print('downloading {0} files with {1} threads of {2:04.04} MB in total'.format(len(jobs), nprocs,
+                                                                                   total_bytes/(1024.*1024.)))
+
+    queue = deque(largest_first([size for _, _, size in jobs]))
+    limiter = token_bucket(max_rate, burst=max(chunk_bytes, max_rate or 0))
+    if progress is not None:
+        progress(0, total_bytes)
+    monitor = concurrency_limit(nprocs, adaptive,
+                                listener=None if progress is None else lambda received: progress(received, total_bytes))
+    dpaths = [""]*len(jobs)
+    errors = [None]*len(jobs)
+
+    def worker(position):
+        while True:
+            monitor.acquire()
+            try:
+                idx = queue.popleft()
+            except IndexError:
+                monitor.release()
+                return
+            url, dstdir, exp_size = jobs[idx]
+            try:
+                dpaths[idx] = serial_download_file(url, dstdir, chunk_bytes, position, limiter, monitor,
+                                                   policy, exp_size, hashes, mirrors=mirrors)
+            except Exception as ex:
+                errors[idx] = ex
+            failed = not has_size(dpaths[idx], exp_size)
+            monitor.release(failed)
+
+    threads = [threading.Thread(target=worker, args=(position + 1,)) for position in range(min(nprocs, len(jobs)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print()
+
+    failures = []
+    for (url, dstdir, exp_size), fpath, error in zip(jobs, dpaths, errors):
+        if has_size(fpath, exp_size):
+            print("downloaded {0} to {1} ({2:.4} MB)".format(url, fpath, os.stat(fpath).st_size/(1024.*1024.)))
+            value.append(fpath)
+            continue
+        fpath = fpath or os.path.join(dstdir, os.path.split(url)[-1])
+        failures.append({'url': url, 'file': fpath, 'expected_size': exp_size,
+                         'received_size': os.stat(fpath).st_size if os.path.isfile(fpath) else getattr(error, 'received', 0),
+                         'attempts': getattr(error, 'attempts', 1),
+                         'error': str(error) if error is not None else 'unexpected size'})
+        print("download of {0} to {1} failed ({2} != {3} B) after {4} attempt(s): {5}".format(
+            url, fpath, exp_size, failures[-1]['received_size'], failures[-1]['attempts'], failures[-1]['error']))
+
+    if failures:
+        print('{0} of {1} downloads failed'.format(len(failures), len(jobs)))
+    if report is not None:
+        report.extend(failures)
+    return value
+
+
+def split_by_size(sizes, count, keys=None):
+    """ split the items of <sizes> bytes into <count> parts of about the same number of bytes,
+    largest item first onto the lightest part (LPT); ties are broken by <keys> (one per item, the indices if None)
+    and the lower part number, so the result depends only on sizes and keys, not on the order of the items
+    returns a list of <count> parts, each a sorted list of item indices
+    """
+    keys = list(range(len(sizes))) if keys is None else keys
+    order = sorted(range(len(sizes)), key=lambda idx: (-sizes[idx], keys[idx]))
+    loads = [(0, part) for part in range(count)]
+    value = [[] for _ in range(count)]
+    for idx in order:
+        load, part = heapq.heappop(loads)
+        value[part].append(idx)
+        heapq.heappush(loads, (load + sizes[idx], part))
+    return [sorted(part) for part in value]
+
+
+def parse_shard(text):
+    """ parse <text> of the form 'i/n' (part i of n, counting from 0) into the tuple (i, n) """
+    try:
+        index, count = [int(item) for item in str(text).split('/')]
+    except ValueError:
+        raise ValueError('shard {0} is not of the form i/n'.format(text))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('shard {0} needs 0 <= i < n'.format(text))
+    return index, count
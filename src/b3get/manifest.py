@@ -0,0 +1,227 @@
+""" run a manifest: a .json (or, with python 3.11+, .toml) file that declares which datasets to fetch with which
+filters and how to export them, compiled into one plan that pulls every zip file once, exports the datasets in
+parallel and skips what is up to date according to its stamps
+
+    {"to": "data", "nprocs": 4,
+     "entries": [{"dataset": "BBBC008", "lrex": "foreground",
+                  "export": {"format": "npz", "max_megabytes": 100}},
+                 {"dataset": "BBBC006", "rex": "z16", "name": "BBBC006_z16",
+                  "export": [{"format": "raw"}, {"format": "zarr", "chunks": [1, 256, 256], "name": "BBBC006_zarr"}]}]}
+
+the top level holds the options of the whole run (see MANIFEST_DEFAULTS), to, rex and lrex given there are the
+defaults of the entries (see ENTRY_OPTIONS), an entry without export is only pulled
+"""
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    tomllib = None
+
+from b3get.datasets import get_dataset, dataset_number, pull_many
+from b3get.utils import filter_files, file_fingerprint
+from b3get.download import lockfile, retry_policy
+from b3get.stores import WRITERS
+
+# options of a manifest, relative folders are relative to the manifest
+MANIFEST_DEFAULTS = {'to': '.', 'nprocs': 1, 'max_rate': 0, 'adaptive': False, 'retries': 4, 'cache': False,
+                     'mirrors': None, 'rex': '', 'lrex': None}
+
+# options an entry may give, the pull options (nprocs, cache, ...) apply to the whole run
+ENTRY_OPTIONS = ('dataset', 'to', 'rex', 'lrex', 'name', 'export')
+
+# options of an export, see dataset.zips_to_shards (read holds the pages, roi, dtype, scaling and downcast options)
+EXPORT_DEFAULTS = {'format': 'npz', 'max_megabytes': 0, 'sharding': 'greedy', 'tolerance': 0.1, 'codec': 'zlib',
+                   'level': None, 'chunks': None, 'read': {}}
+
+
+def read_manifest(path):
+    """ return the manifest stored in the .json or .toml file <path> """
+    if os.path.splitext(path)[-1] == '.toml':
+        if tomllib is None:
+            raise RuntimeError('reading {0} needs python 3.11 or newer (tomllib), use a .json manifest'.format(path))
+        with open(path, 'rb') as fi:
+            return tomllib.load(fi)
+    with open(path) as fi:
+        return json.load(fi)
+
+
+def stamp_location(path):
+    """ return the path of the file that records what running manifest <path> produced """
+    return os.path.splitext(path)[0] + '.stamp.json'
+
+
+def _writer_options(export):
+    """ return the writer options of <export> as b3get resave builds them """
+    value = {}
+    if export['format'] in ('npz', 'zarr'):
+        value = {'codec': export['codec'], 'level': export['level']}
+    if export['format'] == 'zarr' and export['chunks']:
+        value['chunks'] = list(export['chunks'])
+    return value
+
+
+def compile_plan(manifest, basedir='.', listings=None):
+    """ compile <manifest> (see read_manifest) into a plan, a dict with
+    - pulls  : one step per dataset and destination folder, the union of the files of all entries
+               (dict with dataset, to and files)
+    - exports: one step per export of an entry, images and labels separately (dict with dataset, what, basename,
+               files, format, max_megabytes, sharding, tolerance, writer_options and read_options)
+    the listings of the datasets are taken from the dict <listings> (dataset id to dict with images and gt) where
+    present and added to it otherwise, relative folders are taken relative to <basedir>
+    raises ValueError for unknown options and for exports that would write to the same files
+    """
+    listings = {} if listings is None else listings
+    unknown = set(manifest) - set(MANIFEST_DEFAULTS) - set(['entries'])
+    if unknown:
+        raise ValueError('unknown manifest option(s) {0}'.format(', '.join(sorted(unknown))))
+    defaults = dict(MANIFEST_DEFAULTS)
+    defaults.update((key, item) for key, item in manifest.items() if key != 'entries')
+    datasets = {}
+    pulls = {}
+    exports = []
+    for entry in manifest.get('entries', []):
+        unknown = set(entry) - set(ENTRY_OPTIONS)
+        if unknown:
+            raise ValueError('option(s) {0} of entry {1} are unknown or only allowed at the top level'.format(
+                ', '.join(sorted(unknown)), entry))
+        options = dict(defaults, **entry)
+        dsid = dataset_number(options['dataset'])
+        if dsid not in datasets:
+            datasets[dsid] = get_dataset(dsid)
+        ds = datasets[dsid]
+        if ds.datasetid not in listings:
+            print('fetching image information for dataset', dsid)
+            listings[ds.datasetid] = {'images': ds.list_images(), 'gt': ds.list_gt()}
+
+        to = os.path.join(basedir, options['to'])
+        imgs = filter_files(listings[ds.datasetid]['images'], options['rex'])
+        gt = filter_files(listings[ds.datasetid]['gt'], options['lrex'])
+        step = pulls.setdefault((dsid, to), {'dataset': ds, 'to': to, 'files': []})
+        step['files'].extend(item for item in imgs + gt if item not in step['files'])
+
+        items = options.get('export')
+        for export in [items] if isinstance(items, dict) else items or []:
+            unknown = set(export) - set(EXPORT_DEFAULTS) - set(['name'])
+            if unknown:
+                raise ValueError('unknown export option(s) {0} in entry {1}'.format(', '.join(sorted(unknown)), entry))
+            export = dict(EXPORT_DEFAULTS, **export)
+            if export['format'] not in WRITERS:
+                raise ValueError('unknown format {0}, use one of {1}'.format(export['format'], ', '.join(sorted(WRITERS))))
+            name = export.get('name') or options.get('name') or 'BBBC{0:03}'.format(dsid)
+            for what, files in (('images', imgs), ('labels', gt)):
+                if not files:
+                    continue
+                exports.append({'dataset': ds, 'what': what, 'basename': os.path.join(to, '{0}_{1}'.format(name, what)),
+                                'files': [os.path.join(to, os.path.split(item)[-1]) for item in files],
+                                'format': export['format'], 'max_megabytes': export['max_megabytes'],
+                                'sharding': export['sharding'], 'tolerance': export['tolerance'],
+                                'writer_options': _writer_options(export), 'read_options': dict(export['read'])})
+
+    basenames = [step['basename'] for step in exports]
+    clashes = sorted(set(item for item in basenames if basenames.count(item) > 1))
+    if clashes:
+        raise ValueError('several exports write {0}, give them different names'.format(', '.join(clashes)))
+    return {'options': defaults, 'pulls': list(pulls.values()), 'exports': exports}
+
+
+def _pull_key(step):
+    return '{0} {1}'.format(step['dataset'].datasetid, os.path.abspath(step['to']))
+
+
+def _up_to_date(step, stamps):
+    """ return True if all files of pull <step> are present as <stamps> recorded them """
+    recorded = stamps.get(_pull_key(step))
+    if recorded is None:
+        return False
+    names = sorted(os.path.split(item)[-1] for item in step['files'])
+    if sorted(recorded) != names:
+        return False
+    for name in names:
+        path = os.path.join(step['to'], name)
+        if not os.path.isfile(path) or file_fingerprint(path) != recorded[name]:
+            return False
+    return True
+
+
+def _export(steps, nprocs, force):
+    """ run the export <steps> of one dataset one after the other, they share the extracted tifs """
+    value = []
+    for step in steps:
+        zips = [item for item in step['files'] if os.path.isfile(item)]
+        if not zips:
+            print('nothing to export to', step['basename'])
+            continue
+        value.extend(step['dataset'].zips_to_shards(zips, step['basename'], step['format'], step['max_megabytes'],
+                                                    nprocs=nprocs, method=step['sharding'],
+                                                    tolerance=step['tolerance'],
+                                                    writer_options=step['writer_options'], force=force,
+                                                    **step['read_options']))
+    return value
+
+
+def run_manifest(path, force=False, dryrun=False, report=None):
+    """ run the manifest stored in <path> (see read_manifest and compile_plan)
+    dataset listings and the files of every pull are stamped in stamp_location(path): listings are reused and
+    pulls whose files are unchanged since the last run are skipped, exports are skipped by dataset.zips_to_shards
+    if their zip files and options did not change; <force> ignores the stamps and rewrites all exports
+    all pulls of one destination folder share one queue of downloads (see datasets.pull_many), the exports of
+    different datasets run in parallel (at most nprocs at a time), failed downloads are appended to <report>
+    returns the plan (see compile_plan) with the list of files the exports wrote or kept stored under written
+    """
+    stamp = stamp_location(path)
+    stamps = {}
+    if not force and os.path.isfile(stamp):
+        with open(stamp) as fi:
+            stamps = json.load(fi)
+    listings = stamps.setdefault('listings', {})
+    pulled = stamps.setdefault('pulls', {})
+
+    plan = compile_plan(read_manifest(path), os.path.dirname(os.path.abspath(path)), listings)
+    options = plan['options']
+    nprocs = max(int(options['nprocs']), 1)
+    if dryrun:
+        for step in plan['pulls']:
+            for fname in step['files']:
+                print('[dryrun] pulling', os.path.join(step['dataset'].baseurl, fname), 'to', step['to'])
+        for step in plan['exports']:
+            print('[dryrun] exporting {0} {1} to {2} ({3})'.format(step['dataset'].datasetid, step['what'],
+                                                                   step['basename'], step['format']))
+        return plan
+
+    folders = {}
+    for step in plan['pulls']:
+        if _up_to_date(step, pulled):
+            print('{0} in {1} is up to date'.format(step['dataset'].datasetid, step['to']))
+            continue
+        if not os.path.isdir(step['to']):
+            os.makedirs(step['to'])
+        folders.setdefault(step['to'], []).append(step)
+    for to, steps in folders.items():
+        pull_many([(step['dataset'], step['files'], to) for step in steps], nprocs,
+                  options['max_rate']*1024*1024, options['adaptive'], policy=retry_policy(retries=options['retries']),
+                  report=report, lock=lockfile(to), cache=options['cache'], mirrors=options['mirrors'])
+        for step in steps:
+            present = [os.path.join(to, os.path.split(item)[-1]) for item in step['files']]
+            if all(os.path.isfile(item) for item in present):
+                pulled[_pull_key(step)] = dict((os.path.basename(item), file_fingerprint(item)) for item in present)
+
+    with open(stamp, 'w') as fo:
+        json.dump(stamps, fo, indent=1, sort_keys=True)
+
+    plan['written'] = []
+    groups = {}
+    for step in plan['exports']:
+        groups.setdefault(step['dataset'].datasetid, []).append(step)
+    if groups:
+        pool = ThreadPool(min(nprocs, len(groups)))
+        written = pool.map(lambda steps: _export(steps, max(nprocs//len(groups), 1), force), list(groups.values()))
+        pool.close()
+        pool.join()
+        for files in written:
+            plan['written'].extend(files)
+        print('wrote', ', '.join(plan['written']))
+
+    return plan
@@ -0,0 +1,923 @@
+""" the storage formats datasets are exported to: npz shards, raw shards and zarr arrays, their writers, the index
+of the shards and the readers that stream a sharded dataset back in order """
+import io
+import os
+import re
+import math
+import time
+import heapq
+import json
+import zlib
+import bz2
+import lzma
+import itertools
+import shutil
+import numpy as np
+import zipfile
+import threading
+from collections import deque
+from itertools import zip_longest
+from multiprocessing.pool import ThreadPool
+
+from b3get.utils import DECODED_CACHE
+
+
+def interleave_plan(plan):
+    """ return the item indices of the shards in <plan> (see plan_shards) in round-robin order, the first item
+    of every shard, then the second ones and so on, so that consecutive items go to different shards """
+    return [idx for row in zip_longest(*plan) for idx in row if idx is not None]
+
+
+def plan_shards(sizes, max_bytes, method='greedy', tolerance=0.1):
+    """ assign items of <sizes> bytes to shards holding about <max_bytes> each
+    method 'greedy'  : fill shards in order, a shard is closed once the next item would push it beyond max_bytes*(1+tolerance)
+    method 'balanced': spread the items over the fewest shards that stay within max_bytes*(1+tolerance),
+                       largest item first onto the lightest shard (LPT), so all shards end up with similar sizes
+    items larger than max_bytes end up in a shard of their own
+    returns a list of shards, each a sorted list of item indices
+    """
+    value = []
+    if not sizes:
+        return value
+
+    limit = max_bytes*(1. + tolerance)
+    if method == 'greedy':
+        load = 0
+        for idx, size in enumerate(sizes):
+            if value and load + size <= limit:
+                value[-1].append(idx)
+                load += size
+            else:
+                value.append([idx])
+                load = size
+        return value
+
+    if method != 'balanced':
+        raise ValueError('unknown sharding method {0}, use one of greedy or balanced'.format(method))
+
+    order = sorted(range(len(sizes)), key=lambda idx: (-sizes[idx], idx))
+    nshards = max(int(math.ceil(sum(sizes)/float(max_bytes))), 1)
+    while True:
+        loads = [(0, shard) for shard in range(nshards)]
+        value = [[] for _ in range(nshards)]
+        for idx in order:
+            load, shard = heapq.heappop(loads)
+            value[shard].append(idx)
+            heapq.heappush(loads, (load + sizes[idx], shard))
+        overfull = [shard for load, shard in loads if load > limit and len(value[shard]) > 1]
+        if not overfull or nshards >= len(sizes):
+            break
+        nshards += 1
+
+    return [sorted(shard) for shard in value if shard]
+
+
+def shard_names(basename, nshards, extension='.npz'):
+    """ return the file names of <nshards> shards: <basename><extension> for one shard,
+    <basename>0<extension>, <basename>1<extension>, ... (zero padded) otherwise """
+    if nshards == 1:
+        return [basename+extension]
+    ndigits = len(str(nshards))
+    return [basename+(('{0:0'+str(ndigits)+'}').format(i))+extension for i in range(nshards)]
+
+
+def array_entry(name, index, array, offset):
+    """ describe <array> stored as <name> at byte <offset> of a shard, <index> is its position in the whole dataset """
+    return {'name': name, 'index': index, 'shape': list(array.shape), 'dtype': array.dtype.str,
+            'offset': offset, 'nbytes': array.nbytes}
+
+
+def write_shard_index(basename, files, arrays, fmt='npz', **extra):
+    """ write the shard index <basename>.json describing which arrays (list of array_entry lists, one per shard)
+    are stored in which of the shard <files> of format <fmt>, byte offsets locate an array inside its shard
+    (npz: array data preceding it, raw: position in the file), <extra> entries are added to the index
+    returns the path of the index """
+    index = {'format': fmt,
+             'shards': [{'file': os.path.basename(fname), 'arrays': entries} for fname, entries in zip(files, arrays)]}
+    index.update(extra)
+    dst = basename+'.json'
+    with open(dst, 'w') as fo:
+        json.dump(index, fo, indent=1)
+    return dst
+
+
+# codecs available for npz archives, all of them are understood by np.load
+CODECS = {'stored': zipfile.ZIP_STORED,
+          'zlib': zipfile.ZIP_DEFLATED,
+          'bz2': zipfile.ZIP_BZIP2,
+          'lzma': zipfile.ZIP_LZMA}
+
+
+def open_npz(dst, codec='zlib', level=None):
+    """ open archive <dst> for writing with <codec> (see CODECS) at compression <level>
+    (zlib: 0-9, bz2: 1-9, ignored for stored and lzma, None is the codec default) """
+    if codec not in CODECS:
+        raise ValueError('unknown codec {0}, use one of {1}'.format(codec, ", ".join(sorted(CODECS))))
+    return zipfile.ZipFile(dst, mode='w', compression=CODECS[codec], allowZip64=True, compresslevel=level)
+
+
+def write_npz_member(zf, name, array):
+    """ write <array> as member <name>.npy of the open ZipFile <zf> with its codec and level, the zip entry
+    carries a fixed timestamp (unlike np.savez) so that archives with the same content are identical byte for byte """
+    info = zipfile.ZipInfo(name+'.npy', date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zf.compression
+    info.external_attr = 0o600 << 16
+    # the level attribute got public in python 3.13
+    setattr(info, 'compress_level' if hasattr(zipfile.ZipInfo, 'compress_level') else '_compresslevel', zf.compresslevel)
+    with zf.open(info, mode='w', force_zip64=True) as fo:
+        np.lib.format.write_array(fo, np.asanyarray(array), allow_pickle=False)
+
+
+def write_npz(dst, arrays, codec='zlib', level=None):
+    """ write the list <arrays> into archive <dst> as arr_0, arr_1, ... (like np.savez_compressed) using <codec> and <level> """
+    with open_npz(dst, codec, level) as zf:
+        for idx, array in enumerate(arrays):
+            write_npz_member(zf, 'arr_{0}'.format(idx), array)
+    return dst
+
+
+def benchmark_codecs(arrays, codecs=('stored', 'zlib', 'bz2', 'lzma'), level=None):
+    """ compress <arrays> in memory with each of <codecs> at <level> (see open_npz)
+    returns a list of dicts with codec, level, seconds, throughput (MB of array data per second) and ratio (array data/compressed)
+    """
+    value = []
+    nbytes = sum(item.nbytes for item in arrays)
+    for codec in codecs:
+        buf = io.BytesIO()
+        start = time.time()
+        with open_npz(buf, codec, level) as zf:
+            for idx, array in enumerate(arrays):
+                write_npz_member(zf, 'arr_{0}'.format(idx), array)
+        seconds = max(time.time() - start, 1e-9)
+        value.append({'codec': codec, 'level': level, 'seconds': seconds,
+                      'throughput': nbytes/(1024.*1024.)/seconds,
+                      'ratio': nbytes/float(max(len(buf.getvalue()), 1))})
+    return value
+
+
+def wrap_write_npz(args):
+    """ wrap write_npz to unpack args """
+    return write_npz(*args)
+
+
+def chunk_npz(ndalist, basename, max_megabytes=1, method='greedy', tolerance=0.1, nprocs=1, codec='zlib', level=None):
+    """ given a list of numpy.ndarrays <ndalist>, store them compressed inside <basename>
+    if the storage volume of ndalist exceeds max_megabytes, chunk the data by the byte size of each array
+    (see plan_shards for <method> and <tolerance>), max_megabytes=0 writes one single archive
+    the archives are compressed with <codec> at <level> (see open_npz) by <nprocs> threads in parallel,
+    the output does not depend on <nprocs>
+    the shard index <basename>.json records which array went to which archive and the codec used
+    returns the list of archives written
+    """
+    value = []
+    if not ndalist:
+        return value
+
+    max_bytes = max_megabytes*1024*1024
+    sizes = [item.nbytes for item in ndalist]
+    if max_bytes > 0 and sum(sizes) > max_bytes:
+        shards = plan_shards(sizes, max_bytes, method, tolerance)
+    else:
+        shards = [list(range(len(ndalist)))]
+
+    value = shard_names(basename, len(shards))
+    jobs = [(dst, [ndalist[idx] for idx in shard], codec, level) for dst, shard in zip(value, shards)]
+    if nprocs > 1 and len(jobs) > 1:
+        # zlib releases the GIL, threads spare us from pickling the arrays to worker processes
+        workers = ThreadPool(min(nprocs, len(jobs)))
+        workers.map(wrap_write_npz, jobs)
+        workers.close()
+        workers.join()
+    else:
+        [wrap_write_npz(job) for job in jobs]
+
+    entries = []
+    for shard in shards:
+        offset = 0
+        entries.append([])
+        for pos, idx in enumerate(shard):
+            entries[-1].append(array_entry('arr_{0}'.format(pos), idx, ndalist[idx], offset))
+            offset += ndalist[idx].nbytes
+
+    write_shard_index(basename, value, entries, codec=codec, level=level)
+    return value
+
+
+class shard_writer(object):
+    """ distribute numpy arrays over shard files one at a time as they arrive,
+    so only the array being written has to be in memory, deriving classes define the file format
+
+    without a <plan>, a new shard is started whenever the current one would exceed
+    <max_megabytes>*(1+<tolerance>) of array data (the greedy plan_shards method applied on the fly),
+    with a <plan> (list of shards as returned by plan_shards) the i-th array appended goes to the shard listing i
+
+    the shards are named like chunk_npz names them: <basename><extension> if a single shard was written,
+    <basename>0<extension>, <basename>1<extension>, ... otherwise, inside each shard arrays are called arr_0, arr_1, ...
+    and the shard index <basename>.json is written on close (see write_shard_index) including the <extra> entries
+
+    with <nprocs> > 1, arrays are written by a pool of threads while the caller decodes the next ones,
+    arrays of different shards in parallel and those of the same shard in the order they were appended,
+    so the shards do not depend on <nprocs>, at most 2*<nprocs> arrays are kept in flight; with a <plan>,
+    appending the arrays in round-robin order over the shards (see interleave_plan, passing each <index>)
+    keeps up to <nprocs> shards busy, the arrays of one single shard are always compressed one after the other
+
+    shards of the <plan> listed in <keep> (shard number -> its entries in the previous shard index) exist already
+    under their final name and are left untouched, the arrays planned for them have to be skipped
+
+    if the writer is left with an exception (or abort is called), the shards written so far are removed and
+    neither shards nor the index are replaced, so an interrupted run leaves the previous output as it was
+    """
+
+    extension = ''
+    fmt = ''
+
+    def __init__(self, basename, max_megabytes=0, tolerance=0.1, plan=None, nprocs=1, keep=None):
+        """ write to shards starting with <basename>, max_megabytes=0 writes one single shard """
+        self.basename = basename
+        self.max_bytes = max_megabytes*1024*1024
+        self.tolerance = tolerance
+        self.nprocs = nprocs
+        self.files = []
+        self.index_file = None
+        self.extra = {}
+        self._shard_of = {}
+        self._parts = []
+        self._handles = []
+        self._entries = []
+        self._nbytes = []
+        self._ends = []
+        self._count = 0
+        self._workers = ThreadPool(nprocs) if nprocs > 1 else None
+        self._last = {}
+        self._inflight = deque()
+
+        names = shard_names(basename, len(plan or []), self.extension)
+        for shard, indices in enumerate(plan or []):
+            if keep and shard in keep:
+                self._keep_shard(names[shard], keep[shard])
+            else:
+                self._open_shard()
+            self._shard_of.update((idx, shard) for idx in indices)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            self.abort()
+        else:
+            self.close()
+        return False
+
+    def _open_file(self, path):
+        """ open shard file <path> for writing and return its handle """
+        raise NotImplementedError
+
+    def _place(self, end, array):
+        """ return the offset at which <array> is stored in a shard that currently ends at byte <end> """
+        return end
+
+    def _write_array(self, handle, name, offset, array):
+        """ write <array> as <name> at <offset> into the shard opened as <handle> """
+        raise NotImplementedError
+
+    def _index_extra(self):
+        """ return additional entries of the shard index """
+        return {}
+
+    def _open_shard(self):
+        path = '{0}.part{1}{2}'.format(self.basename, len(self._parts), self.extension)
+        self._parts.append(path)
+        self._handles.append(self._open_file(path))
+        self._entries.append([])
+        self._nbytes.append(0)
+        self._ends.append(0)
+
+    def _keep_shard(self, path, entries):
+        """ add the existing shard <path> holding <entries> """
+        self._parts.append(None)
+        self._handles.append(None)
+        self._entries.append(list(entries))
+        self._nbytes.append(sum(entry['nbytes'] for entry in entries))
+        self._ends.append(max([entry['offset'] + entry['nbytes'] for entry in entries] or [0]))
+
+    def _next_shard(self, array, index):
+        """ return the shard array number <index> has to go to, opening a new one if needed """
+        if self._shard_of:
+            if index not in self._shard_of:
+                raise IndexError('array {0} is not part of the plan of {1}'.format(index, self.basename))
+            return self._shard_of[index]
+
+        limit = self.max_bytes*(1. + self.tolerance)
+        if not self._parts or (self.max_bytes > 0 and self._entries[-1] and
+                               self._nbytes[-1] + array.nbytes > limit):
+            self._open_shard()
+        return len(self._parts) - 1
+
+    def _write(self, shard, name, offset, array, previous=None):
+        """ write <array> as <name> into <shard> once the <previous> write to that shard is done """
+        if previous is not None:
+            previous.wait()
+        self._write_array(self._handles[shard], name, offset, array)
+
+    def append(self, array, info=None, index=None):
+        """ write <array> to the shard it belongs to, <info> is added to its entry in the shard index,
+        <index> is the number of the array in the plan, the one after the previously appended array if None """
+        array = np.asanyarray(array)
+        index = self._count if index is None else index
+        shard = self._next_shard(array, index)
+        if self._parts[shard] is None:
+            raise ValueError('array {0} belongs to shard {1} which is kept as it is'.format(index, shard))
+        name = 'arr_{0}'.format(len(self._entries[shard]))
+        offset = self._place(self._ends[shard], array)
+
+        if self._workers is None:
+            self._write(shard, name, offset, array)
+        else:
+            while len(self._inflight) >= 2*self.nprocs:
+                self._inflight.popleft().get()
+            # tasks are picked up in order, so the previous write of a shard is always running or done
+            result = self._workers.apply_async(self._write, (shard, name, offset, array, self._last.get(shard)))
+            self._last[shard] = result
+            self._inflight.append(result)
+        self._entries[shard].append(dict(array_entry(name, index, array, offset), **(info or {})))
+        self._nbytes[shard] += array.nbytes
+        self._ends[shard] = offset + array.nbytes
+        self._count = index + 1
+
+    def skip(self, index=None):
+        """ leave out the next array (or array number <index>), e.g. because it could not be read,
+        without shifting the plan """
+        self._count = (self._count if index is None else index) + 1
+
+    def _finish_writes(self, wait=True):
+        """ wait for the pending writes (raising their errors if <wait>) and close the shard files """
+        if self._workers is not None:
+            while self._inflight:
+                result = self._inflight.popleft()
+                if wait:
+                    result.get()
+                else:
+                    result.wait()
+            self._workers.close()
+            self._workers.join()
+            self._workers = None
+        for idx, handle in enumerate(self._handles):
+            if handle is not None:
+                handle.close()
+                self._handles[idx] = None
+
+    def abort(self):
+        """ drop the shards written so far, existing shards and index are left as they are """
+        self._finish_writes(wait=False)
+        for part in self._parts:
+            if part is not None and os.path.exists(part):
+                os.remove(part)
+        self._parts = []
+
+    def close(self):
+        """ finish all shards, give them their final names and write the shard index <basename>.json
+        returns the list of shards """
+        try:
+            self._finish_writes()
+        except BaseException:
+            self.abort()
+            raise
+        if self.files or not self._parts:
+            return self.files
+
+        self.files = shard_names(self.basename, len(self._parts), self.extension)
+        for part, dst in zip(self._parts, self.files):
+            if part is None:
+                continue
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.rename(part, dst)
+        self.index_file = write_shard_index(self.basename, self.files, self._entries, fmt=self.fmt,
+                                            **dict(self._index_extra(), **self.extra))
+        return self.files
+
+
+class npz_writer(shard_writer):
+    """ shard_writer producing (compressed) .npz archives, readable with np.load,
+    byte offsets in the index count the array data preceding an array inside its archive """
+
+    extension = '.npz'
+    fmt = 'npz'
+
+    def __init__(self, basename, max_megabytes=0, tolerance=0.1, plan=None, nprocs=1, keep=None,
+                 codec='zlib', level=None):
+        """ write to archives starting with <basename> using <codec> at <level> (see open_npz),
+        max_megabytes=0 writes one single archive """
+        self.codec = codec
+        self.level = level
+        shard_writer.__init__(self, basename, max_megabytes, tolerance, plan, nprocs, keep)
+
+    def _open_file(self, path):
+        return open_npz(path, self.codec, self.level)
+
+    def _write_array(self, handle, name, offset, array):
+        write_npz_member(handle, name, array)
+
+    def _index_extra(self):
+        return {'codec': self.codec, 'level': self.level}
+
+
+class raw_writer(shard_writer):
+    """ shard_writer producing flat .raw files that hold the C-ordered bytes of each array at
+    <alignment> byte boundaries, the byte offsets in the index are positions in the file,
+    so that open_raw can hand out the arrays as views of a memory map """
+
+    extension = '.raw'
+    fmt = 'raw'
+
+    def __init__(self, basename, max_megabytes=0, tolerance=0.1, plan=None, nprocs=1, keep=None, alignment=64):
+        """ write to files starting with <basename>, max_megabytes=0 writes one single file """
+        self.alignment = alignment
+        shard_writer.__init__(self, basename, max_megabytes, tolerance, plan, nprocs, keep)
+
+    def _open_file(self, path):
+        return open(path, 'wb')
+
+    def _place(self, end, array):
+        return int(math.ceil(end/float(self.alignment)))*self.alignment
+
+    def _write_array(self, handle, name, offset, array):
+        handle.seek(offset)
+        handle.write(np.ascontiguousarray(array).data)
+
+    def _index_extra(self):
+        return {'alignment': self.alignment}
+
+
+def zarr_compressor(codec='zlib', level=None):
+    """ return the zarr v2 (numcodecs) compressor configuration for <codec> (see CODECS) at <level> """
+    if codec == 'stored':
+        return None
+    if codec in ('zlib', 'bz2'):
+        return {'id': codec, 'level': 1 if level is None else level}
+    if codec == 'lzma':
+        return {'id': 'lzma', 'format': lzma.FORMAT_XZ, 'check': -1, 'preset': level, 'filters': None}
+    raise ValueError('unknown codec {0}, use one of {1}'.format(codec, ", ".join(sorted(CODECS))))
+
+
+def zarr_encode(data, compressor):
+    """ compress the bytes <data> of a chunk as described by the zarr <compressor> configuration """
+    if compressor is None:
+        return data
+    if compressor['id'] == 'zlib':
+        return zlib.compress(data, compressor['level'])
+    if compressor['id'] == 'bz2':
+        return bz2.compress(data, compressor['level'])
+    if compressor['id'] == 'lzma':
+        return lzma.compress(data, format=compressor['format'], check=compressor['check'], preset=compressor['preset'])
+    raise ValueError('unsupported zarr compressor {0}'.format(compressor['id']))
+
+
+def zarr_decode(data, compressor):
+    """ decompress the bytes <data> of a chunk as described by the zarr <compressor> configuration """
+    if compressor is None:
+        return data
+    if compressor['id'] == 'zlib':
+        return zlib.decompress(data)
+    if compressor['id'] == 'bz2':
+        return bz2.decompress(data)
+    if compressor['id'] == 'lzma':
+        return lzma.decompress(data)
+    raise ValueError('unsupported zarr compressor {0}'.format(compressor['id']))
+
+
+def default_chunks(shape):
+    """ chunk shape used if none is given: blocks of 64 voxels per axis for volumes, 256 pixels per axis for planes """
+    edge = 64 if len(shape) >= 3 else 256
+    return tuple(max(min(size, edge), 1) for size in shape)
+
+
+class zarr_writer(object):
+    """ write numpy arrays as they arrive into a zarr v2 directory store <basename>.zarr: a group holding
+    one array per appended image (named 0, 1, ...), each split into independently compressed chunk files
+    plus .zarray metadata, so that readers (zarr or open_zarr) can load sub-volumes without touching the rest
+
+    the chunks of an array are compressed by <nprocs> threads in parallel, the sharding arguments
+    (<max_megabytes>, <tolerance>, <plan>) are accepted like for the shard_writer classes and ignored,
+    the index <basename>.json lists the arrays of the store; the store is written to a temporary folder
+    that replaces an existing <basename>.zarr on close, so no arrays of an earlier store are left behind
+    """
+
+    extension = '.zarr'
+    fmt = 'zarr'
+
+    def __init__(self, basename, max_megabytes=0, tolerance=0.1, plan=None, nprocs=1,
+                 chunks=None, codec='zlib', level=None):
+        """ write to <basename>.zarr with chunks of shape <chunks> (default_chunks if None, trailing axes
+        if it has fewer entries than an array has dimensions) compressed with <codec> at <level> """
+        self.basename = basename
+        self.path = basename+self.extension
+        self._tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        self.chunks = tuple(chunks) if chunks else None
+        self.compressor = zarr_compressor(codec, level)
+        self.codec = codec
+        self.level = level
+        self.nprocs = nprocs
+        self.files = []
+        self.index_file = None
+        self.extra = {}
+        self._entries = []
+        self._count = 0
+        self._workers = ThreadPool(nprocs) if nprocs > 1 else None
+
+        if os.path.isdir(self._tmp):
+            shutil.rmtree(self._tmp)
+        os.makedirs(self._tmp)
+        with open(os.path.join(self._tmp, '.zgroup'), 'w') as fo:
+            json.dump({'zarr_format': 2}, fo)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            self.abort()
+        else:
+            self.close()
+        return False
+
+    def _chunks_of(self, shape):
+        if self.chunks is None:
+            return default_chunks(shape)
+        chunks = self.chunks[-len(shape):] if len(shape) else ()
+        chunks = tuple(shape[:len(shape)-len(chunks)]) + tuple(chunks)
+        return tuple(max(min(size, chunk), 1) for size, chunk in zip(shape, chunks))
+
+    def _write_chunk(self, args):
+        """ pad and compress the chunk at grid position <idx> of <array> and store it in <dstdir> """
+        dstdir, array, chunks, idx = args
+        region = tuple(slice(i*c, (i+1)*c) for i, c in zip(idx, chunks))
+        block = array[region]
+        if block.shape != chunks:
+            padded = np.zeros(chunks, dtype=array.dtype)
+            padded[tuple(slice(0, n) for n in block.shape)] = block
+            block = padded
+        name = '.'.join(str(i) for i in idx) if idx else '0'
+        with open(os.path.join(dstdir, name), 'wb') as fo:
+            fo.write(zarr_encode(np.ascontiguousarray(block).tobytes(), self.compressor))
+
+    def append(self, array, info=None, index=None):
+        """ write <array> as the next array of the store (named <index> if given), <info> is added to its entry
+        in the shard index """
+        array = np.asanyarray(array)
+        index = self._count if index is None else index
+        name = str(index)
+        dstdir = os.path.join(self._tmp, name)
+        os.makedirs(dstdir)
+
+        chunks = self._chunks_of(array.shape)
+        meta = {'zarr_format': 2, 'shape': list(array.shape), 'chunks': list(chunks), 'dtype': array.dtype.str,
+                'compressor': self.compressor, 'fill_value': 0, 'order': 'C', 'filters': None,
+                'dimension_separator': '.'}
+        with open(os.path.join(dstdir, '.zarray'), 'w') as fo:
+            json.dump(meta, fo, indent=1)
+
+        grid = [range(int(math.ceil(size/float(chunk)))) for size, chunk in zip(array.shape, chunks)]
+        jobs = [(dstdir, array, chunks, idx) for idx in itertools.product(*grid)]
+        if self._workers is not None and len(jobs) > 1:
+            self._workers.map(self._write_chunk, jobs)
+        else:
+            [self._write_chunk(job) for job in jobs]
+
+        self._entries.append(dict(array_entry(name, index, array, 0), **(info or {})))
+        self._count = index + 1
+
+    def skip(self, index=None):
+        """ leave out the next array (or array number <index>), e.g. because it could not be read """
+        self._count = (self._count if index is None else index) + 1
+
+    def _stop_workers(self):
+        if self._workers is not None:
+            self._workers.close()
+            self._workers.join()
+            self._workers = None
+
+    def abort(self):
+        """ drop what was written so far and keep an existing store as it is """
+        self._stop_workers()
+        if os.path.isdir(self._tmp):
+            shutil.rmtree(self._tmp)
+
+    def close(self):
+        """ finish the store, replace an existing <basename>.zarr with it and write the index <basename>.json,
+        returns the list with the store directory """
+        self._stop_workers()
+        if self.files:
+            return self.files
+
+        if os.path.isdir(self.path):
+            old = '{0}.{1}.old'.format(self.path, os.getpid())
+            os.rename(self.path, old)
+            os.rename(self._tmp, self.path)
+            shutil.rmtree(old)
+        else:
+            os.rename(self._tmp, self.path)
+        self.files = [self.path]
+        self.index_file = write_shard_index(self.basename, self.files, [self._entries], fmt=self.fmt,
+                                            codec=self.codec, level=self.level, **self.extra)
+        return self.files
+
+
+class zarr_array(object):
+    """ read-only access to one array of a zarr v2 directory store (C order, no filters),
+    indexing it with ints and slices reads and decompresses only the chunks the selection touches """
+
+    def __init__(self, path):
+        with open(os.path.join(path, '.zarray')) as fi:
+            meta = json.load(fi)
+        if meta.get('zarr_format') != 2 or meta.get('order', 'C') != 'C' or meta.get('filters'):
+            raise ValueError('{0} is not a C ordered zarr v2 array without filters'.format(path))
+
+        self.path = path
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.compressor = meta.get('compressor')
+        self.fill_value = meta.get('fill_value') or 0
+        self.separator = meta.get('dimension_separator', '.')
+
+    def __len__(self):
+        return self.shape[0] if self.shape else 0
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _chunk(self, idx):
+        """ return the decoded chunk at grid position <idx>, filled with fill_value if it was never written """
+        name = self.separator.join(str(i) for i in idx) if idx else '0'
+        fname = os.path.join(self.path, name)
+        if not os.path.isfile(fname):
+            return np.full(self.chunks, self.fill_value, dtype=self.dtype)
+        with open(fname, 'rb') as fi:
+            data = zarr_decode(fi.read(), self.compressor)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for array of shape {0}'.format(self.shape))
+        key = key + (slice(None),)*(self.ndim - len(key))
+
+        starts, stops, post = [], [], []
+        for item, size in zip(key, self.shape):
+            if isinstance(item, slice):
+                # read the bounding box of the selected elements, apply the step afterwards
+                start, stop, step = item.indices(size)
+                selected = range(start, stop, step)
+                if not len(selected):
+                    starts.append(0)
+                    stops.append(0)
+                    post.append(slice(None))
+                    continue
+                lo, hi = min(selected[0], selected[-1]), max(selected[0], selected[-1])
+                starts.append(lo)
+                stops.append(hi + 1)
+                first, last = selected[0] - lo, selected[-1] - lo
+                post.append(slice(first, last + 1 if step > 0 else (last - 1 if last > 0 else None), step))
+            else:
+                item = int(item) + size if int(item) < 0 else int(item)
+                if not 0 <= item < size:
+                    raise IndexError('index {0} is out of bounds for axis with size {1}'.format(item, size))
+                starts.append(item)
+                stops.append(item + 1)
+                post.append(0)
+
+        value = np.full([stop - start for start, stop in zip(starts, stops)], self.fill_value, dtype=self.dtype)
+        grid = [range(start//chunk, int(math.ceil(stop/float(chunk))))
+                for start, stop, chunk in zip(starts, stops, self.chunks)]
+        for idx in itertools.product(*grid):
+            chunk = self._chunk(idx)
+            src, dst = [], []
+            for i, c, start, stop in zip(idx, self.chunks, starts, stops):
+                lo, hi = max(i*c, start), min((i+1)*c, stop)
+                src.append(slice(lo - i*c, hi - i*c))
+                dst.append(slice(lo - start, hi - start))
+            value[tuple(dst)] = chunk[tuple(src)]
+
+        return value[tuple(post)]
+
+
+def open_zarr(path):
+    """ open the zarr v2 directory store at <path>: a list of zarr_array (sorted by name) for a group
+    like the ones zarr_writer produces, a single zarr_array if <path> is an array """
+    if os.path.isfile(os.path.join(path, '.zarray')):
+        return zarr_array(path)
+
+    names = [name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name, '.zarray'))]
+    names = sorted(names, key=lambda name: (int(name) if name.isdigit() else float('inf'), name))
+    return [zarr_array(os.path.join(path, name)) for name in names]
+
+
+# shard formats that resave can write
+WRITERS = {'npz': npz_writer, 'raw': raw_writer, 'zarr': zarr_writer}
+
+
+def open_raw(index_file, mode='r'):
+    """ open the .raw shards listed in the shard index <index_file> (as written by raw_writer)
+    returns the arrays in the order they were written as np.memmap views, no data is read or copied
+    """
+    with open(index_file) as fi:
+        index = json.load(fi)
+    if index.get('format') != 'raw':
+        raise ValueError('{0} does not index raw shards but {1}'.format(index_file, index.get('format')))
+
+    value = []
+    basedir = os.path.dirname(index_file)
+    for shard in index['shards']:
+        path = os.path.join(basedir, shard['file'])
+        mapped = np.memmap(path, dtype='uint8', mode=mode) if os.path.getsize(path) > 0 else None
+        for entry in shard['arrays']:
+            dtype = np.dtype(entry['dtype'])
+            if entry['nbytes'] == 0:
+                view = np.empty(entry['shape'], dtype=dtype)
+            else:
+                view = mapped[entry['offset']:entry['offset']+entry['nbytes']].view(dtype).reshape(entry['shape'])
+            value.append((entry['index'], view))
+
+    return [view for _, view in sorted(value, key=lambda item: item[0])]
+
+
+# file extensions of the shards written by the WRITERS
+SHARD_EXTENSIONS = ('.npz', '.raw', '.zarr')
+
+
+def shard_basename(path):
+    """ return the basename of the set of shards <path> refers to, <path> can be the shard index (.json),
+    one of the shards or the basename itself, returns None if no shards are found """
+    root, ext = os.path.splitext(path)
+    candidates = [path]
+    if ext in ('.json',) + SHARD_EXTENSIONS:
+        # numbered shards belong to the basename without their number
+        candidates = [root.rstrip('0123456789'), root] if root.rstrip('0123456789') != root else [root]
+    for candidate in candidates:
+        if os.path.isfile(candidate+'.json'):
+            return candidate
+    for candidate in candidates:
+        for extension in SHARD_EXTENSIONS:
+            if os.path.exists(candidate+extension) or os.path.exists(candidate+'0'+extension):
+                return candidate
+    return None
+
+
+def npz_members(fname):
+    """ list the arrays inside the npz archive <fname> as (name, shape, dtype) by reading their .npy headers only """
+    value = []
+    with zipfile.ZipFile(fname) as zf:
+        for info in zf.infolist():
+            if not info.filename.endswith('.npy'):
+                continue
+            with zf.open(info) as fo:
+                version = np.lib.format.read_magic(fo)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(fo)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(fo)
+            value.append((info.filename[:-4], shape, dtype))
+    return value
+
+
+def shard_index(basename):
+    """ return the shard index of the shards starting with <basename> (see write_shard_index),
+    npz archives without an index (as written by older versions) are indexed by listing their members """
+    if os.path.isfile(basename+'.json'):
+        with open(basename+'.json') as fi:
+            return json.load(fi)
+
+    rex = re.compile(re.escape(os.path.basename(basename))+r'(\d*)\.npz$')
+    basedir = os.path.dirname(basename) or '.'
+    found = [(rex.match(name), name) for name in os.listdir(basedir)]
+    files = sorted([(int(match.group(1) or 0), name) for match, name in found if match])
+    if not files:
+        raise IOError('no shard index or npz archives found for {0}'.format(basename))
+
+    shards = []
+    count = 0
+    for _, name in files:
+        members = npz_members(os.path.join(basedir, name))
+        members = sorted(members, key=lambda item: int(item[0][4:]) if item[0][4:].isdigit() else item[0])
+        entries = []
+        for member, shape, dtype in members:
+            entries.append({'name': member, 'index': count, 'shape': list(shape), 'dtype': dtype.str,
+                            'offset': None, 'nbytes': int(np.prod(shape, dtype='int64'))*dtype.itemsize})
+            count += 1
+        shards.append({'file': name, 'arrays': entries})
+
+    return {'format': 'npz', 'shards': shards}
+
+
+class shard_sequence(object):
+    """ lazy random access to the arrays stored in a set of shards (npz, raw or zarr) as one sequence,
+    it is built from the shard index so no shard has to be opened up front; shards are opened on first use,
+    arrays are decoded on demand (slices and lists of indices by <nprocs> threads in parallel)
+    and decoded arrays are kept in a byte-bounded cache, raw shards are handed out as np.memmap views """
+
+    def __init__(self, basename, nprocs=1, cache=None):
+        """
+        open the shards described by the index <basename>.json
+        - nprocs: number of threads that decode arrays when more than one is requested
+        - cache : byte_lru_cache to hold decoded arrays (defaults to DECODED_CACHE)
+        """
+        self.basename = basename
+        self.index = shard_index(basename)
+        self.format = self.index['format']
+        if self.format not in WRITERS:
+            raise ValueError('{0} indexes shards of unknown format {1}'.format(basename, self.format))
+        self.nprocs = nprocs
+        self.cache = cache if cache is not None else DECODED_CACHE
+
+        basedir = os.path.dirname(basename)
+        self.entries = []
+        for shard in self.index['shards']:
+            path = os.path.join(basedir, shard['file'])
+            self.entries.extend((entry['index'], path, entry) for entry in shard['arrays'])
+        self.entries = [(path, entry) for _, path, entry in sorted(self.entries, key=lambda item: item[0])]
+
+        self._handles = {}
+        self._lock = threading.Lock()
+        self._workers = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.decode(range(*i.indices(len(self))))
+        if isinstance(i, (list, tuple, np.ndarray)):
+            return self.decode(i)
+        path, entry = self.entries[i]
+        return self._array(path, entry)
+
+    def shape(self, i):
+        """ return the shape of array <i> without decoding it """
+        return tuple(self.entries[i][1]['shape'])
+
+    def dtype(self, i):
+        """ return the dtype of array <i> without decoding it """
+        return np.dtype(self.entries[i][1]['dtype'])
+
+    def decode(self, indices):
+        """ return the arrays at <indices>, decoded by <nprocs> threads """
+        indices = [int(i) for i in indices]
+        if self.nprocs > 1 and len(indices) > 1:
+            if self._workers is None:
+                self._workers = ThreadPool(self.nprocs)
+            return self._workers.map(self.__getitem__, indices)
+        return [self[i] for i in indices]
+
+    def _handle(self, path):
+        """ return the open shard at <path>, opening it on first use """
+        with self._lock:
+            if path not in self._handles:
+                if self.format == 'npz':
+                    self._handles[path] = zipfile.ZipFile(path)
+                elif self.format == 'raw':
+                    self._handles[path] = np.memmap(path, dtype='uint8', mode='r') if os.path.getsize(path) else None
+                else:
+                    self._handles[path] = path
+            return self._handles[path]
+
+    def _array(self, path, entry):
+        if self.format == 'raw':
+            if entry['nbytes'] == 0:
+                return np.empty(entry['shape'], dtype=entry['dtype'])
+            mapped = self._handle(path)
+            view = mapped[entry['offset']:entry['offset']+entry['nbytes']]
+            return view.view(entry['dtype']).reshape(entry['shape'])
+
+        key = (os.path.abspath(path), entry['name'])
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        if self.format == 'npz':
+            with self._handle(path).open(entry['name']+'.npy') as fo:
+                value = np.lib.format.read_array(fo)
+        else:
+            value = zarr_array(os.path.join(self._handle(path), entry['name']))[()]
+        return self.cache.put(key, value)
+
+    def close(self):
+        """ close all open shards and stop the decoding threads """
+        if self._workers is not None:
+            self._workers.close()
+            self._workers.join()
+            self._workers = None
+        with self._lock:
+            for handle in self._handles.values():
+                if isinstance(handle, zipfile.ZipFile):
+                    handle.close()
+            self._handles = {}
@@ -1,20 +1,34 @@
-from __future__ import print_function, with_statement
-
+import atexit
 import tempfile
 import os
 import re
-import requests
-import tqdm
 import math
 import numpy as np
+import tifffile
 import zipfile
+import threading
+import tracemalloc
+from collections import OrderedDict
+
+
+# where the BBBC datasets are published, BBBC_URL.format(number) is the page of one dataset
+BBBC_ROOT = 'https://data.broadinstitute.org/bbbc/'
+
+
+BBBC_URL = BBBC_ROOT + 'BBBC{0:03}/'
 
 
 def tmp_location():
     """ return a folder under /tmp or similar,
+    If $B3GET_CACHE is set, use (and create) this folder, e.g. one on a file system shared by several users.
     If something exists that matches the name '.*-b3get', use this.
     If nothing is found, a new folder under /tmp is created and returned
     """
+    cache = os.environ.get('B3GET_CACHE')
+    if cache:
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+        return cache
     tmp = tempfile.gettempdir()
     folders = [subdir[0] for subdir in os.walk(tmp) if subdir[0].endswith('-b3get')]
     if len(folders) > 0:
@@ -32,104 +46,375 @@ def filter_files(alist, rex):
     return srcs
 
 
-def size_of_content(url):
-    """ given an URL, return the number of bytes stored in the header attribute content-length """
-    try:
-        r = requests.head(url, timeout=2)
-    except requests.exceptions.Timeout as texc:
-        print('timed out on', url, texc)
-        return 0
-    except Exception as ex:
-        raise ex
-
-    value = 0
-    if not r.ok:
-        print('E url {} does not exist'.format(url))
-        return value
+def sample_key(path, key_rex=None):
+    """ return the key used to pair file <path> with its counterpart
+    by default this is the basename without extension, if <key_rex> is given
+    the first group of its match on the basename is used (or the full match if it has no groups)
+    returns None if <key_rex> does not match
+    """
+    bname = os.path.basename(path)
+    if not key_rex:
+        return os.path.splitext(bname)[0]
+
+    match = re.search(key_rex, bname)
+    if not match:
+        return None
+    return match.group(1) if match.groups() else match.group(0)
+
+
+def pair_files(images, labels, key_rex=None):
+    """ pair every file in <images> with the file in <labels> that has the same sample_key
+    returns a list of (image, label) tuples sorted by image path,
+    images without a matching label are dropped
+    """
+    value = []
+    by_key = {}
+    for lab in sorted(labels):
+        key = sample_key(lab, key_rex)
+        if key is None:
+            continue
+        if key in by_key:
+            print('W {0} and {1} share the key {2}, using the former'.format(by_key[key], lab, key))
+            continue
+        by_key[key] = lab
+
+    for img in sorted(images):
+        key = sample_key(img, key_rex)
+        if key not in by_key:
+            print('W no label found for {0}, skipping it'.format(img))
+            continue
+        value.append((img, by_key[key]))
 
-    value = int(r.headers.get('content-length'))
     return value
 
 
-def serial_download_file(url, dstfolder, chunk_bytes=1024*1024, npos=None):
-    """ download file from <url> into folder <dstfolder>
-    returns the full path of the successfully downloaded file
+def as_slice(item):
+    """ convert a (start, stop) pair into a slice, ints and slices are returned unchanged """
+    if isinstance(item, (tuple, list)):
+        return slice(*item)
+    return item
+
+
+def page_keys(pages, npages):
+    """ convert <pages> (int, slice or sequence of ints) into what tifffile accepts as page key
+    for a series of <npages> pages """
+    if isinstance(pages, slice):
+        return list(range(npages))[pages]
+    if np.ndim(pages) > 0:
+        return list(pages)
+    return int(pages)
+
+
+def read_tiff(fname, pages=None, roi=None):
+    """ read the first series of tif file <fname>, decoding only the selected part of it
+    pages: int, slice or sequence of page indices (z-planes of a stack) to read, all if None
+    roi  : tuple of slices or (start, stop) pairs cropping the selected pages,
+           if <pages> is None and <roi> has one entry more than a page has dimensions,
+           its first entry selects the pages (i.e. a 3D roi on a z-stack)
+    Uncompressed files are memory mapped so that only the region of interest is read,
+    compressed files are decoded page by page and only the selected pages are decoded.
     """
+    roi = tuple(as_slice(item) for item in roi) if roi else ()
 
-    if not os.path.exists(dstfolder):
-        print('E destination path {} does not exist'.format(dstfolder))
-        return ""
-    r = requests.get(url, stream=True, timeout=2)
-    assert r.ok, "unable to access URL: {}".format(url)
-    _, fname = os.path.split(url)
-    dstf = os.path.join(dstfolder, fname)
-    total_length = int(r.headers.get('content-length'))
-
-    if os.path.isfile(dstf) and os.stat(dstf).st_size == total_length:  # nothing to download
-        return dstf
-    with open(dstf, 'wb') as fo:
-
-        if total_length == 0:  # no content length header
-            fo.write(r.content)
-        else:
-            total_length = int(total_length)
-            nbytes = 0
-            pbar = None
-            if not npos:
-                pbar = tqdm.tqdm(total=total_length, unit='B', unit_scale=True)
+    with tifffile.TiffFile(fname) as tif:
+        series = tif.series[0]
+        npages = len(series.pages)
+        if pages is None and npages > 1 and len(roi) > len(series.keyframe.shape):
+            pages, roi = roi[0], roi[1:]
+
+        if pages is None and not roi:
+            return series.asarray()
+
+        if series.dataoffset is not None:
+            mapped = tifffile.memmap(fname, series=0, mode='r')
+            if pages is not None and npages > 1:
+                key = page_keys(pages, npages) if not isinstance(pages, slice) else pages
+                roi = (key,) + roi
+            value = np.array(mapped[roi])
+            del mapped
+            return value
+
+        if pages is None or npages == 1:
+            # like the memory map, a single page ignores <pages>
+            return series.asarray()[roi].copy()
+
+        key = page_keys(pages, npages)
+        value = tif.asarray(key=key, series=0)
+        if isinstance(key, list):
+            roi = (slice(None),) + roi
+        return value[roi].copy()
+
+
+def selected_shape(shape, key):
+    """ return the shape of an array of <shape> indexed with the tuple <key> of ints, slices and one sequence """
+    value = []
+    for axis, size in enumerate(shape):
+        item = key[axis] if axis < len(key) else slice(None)
+        if isinstance(item, slice):
+            value.append(len(range(*item.indices(size))))
+        elif np.ndim(item) > 0:
+            value.append(len(item))
+    return tuple(value)
+
+
+def tiff_shape(fname, pages=None, roi=None):
+    """ return (shape, dtype) of what read_tiff(<fname>, <pages>, <roi>) returns, only the tif header is read """
+    roi = tuple(as_slice(item) for item in roi) if roi else ()
+
+    with tifffile.TiffFile(fname) as tif:
+        series = tif.series[0]
+        npages = len(series.pages)
+        shape, dtype = series.shape, np.dtype(series.dtype)
+        if pages is None and npages > 1 and len(roi) > len(series.keyframe.shape):
+            pages, roi = roi[0], roi[1:]
+        if pages is not None:
+            if npages > 1:
+                roi = (page_keys(pages, npages) if not isinstance(pages, slice) else pages,) + roi
             else:
-                pbar = tqdm.tqdm(total=total_length, unit='B', unit_scale=True, position=npos)
+                shape = series.keyframe.shape
 
-            for data in r.iter_content(chunk_size=chunk_bytes):
-                fo.write(data)
-                pbar.update(len(data))
-                nbytes += len(data)
+    return selected_shape(shape, roi), dtype
 
-    return dstf
 
+def converted_dtype(dtype, target=None, scaling=None):
+    """ return the dtype that convert(<array of dtype>, <target>, <scaling>) produces (downcasting aside) """
+    if target is not None:
+        return np.dtype(target)
+    return np.dtype('float32') if scaling else np.dtype(dtype)
 
-def wrap_serial_download_file(args):
-    """ wrap serial_download to unpack args """
 
-    return serial_download_file(*args)
+def min_dtype(array):
+    """ return the smallest integer dtype that holds all values of the integer array <array>,
+    unsigned types are preferred, non-integer arrays keep their dtype """
+    if array.dtype.kind not in 'biu' or array.size == 0:
+        return array.dtype
 
+    lo, hi = array.min(), array.max()
+    candidates = ('uint8', 'uint16', 'uint32', 'uint64') if lo >= 0 else ('int8', 'int16', 'int32', 'int64')
+    for cand in candidates:
+        info = np.iinfo(cand)
+        if lo >= info.min and hi <= info.max:
+            return np.dtype(cand)
+    return array.dtype
 
-def chunk_npz(ndalist, basename, max_megabytes=1):
-    """ given a list of numpy.ndarrays <ndalist>, store them compressed inside <basename>
-    if the storage volume of ndalist exceeds max_megabytes, chunk the data
 
+SCALINGS = ('minmax', 'zscore')
+
+
+def check_conversion(dtype=None, scaling=None, downcast=False):
+    """ raise ValueError if convert can't apply <dtype>, <scaling> and <downcast>, so that callers can reject
+    them before any file is read """
+    if downcast and (dtype is not None or scaling):
+        raise ValueError('downcast picks the smallest integer dtype itself, it can\'t be combined with dtype or scaling')
+    if scaling and scaling not in SCALINGS:
+        raise ValueError('unknown scaling {0}, use one of {1}'.format(scaling, ' or '.join(SCALINGS)))
+    try:
+        target = np.dtype('float32' if dtype is None and scaling else dtype)
+    except TypeError:
+        raise ValueError('unknown dtype {0}'.format(dtype))
+    if scaling == 'zscore' and target.kind != 'f':
+        raise ValueError('zscore scaling requires a float dtype, got {0}'.format(target))
+    if scaling == 'minmax' and target.kind not in 'fiu':
+        raise ValueError('minmax scaling requires a float or integer dtype, got {0}'.format(target))
+
+
+def convert(array, dtype=None, scaling=None, downcast=False, block_items=1024*1024):
+    """ convert a freshly decoded <array> so that no copy at native precision has to be kept
+    downcast: cast <array> to the smallest integer dtype that holds its values (see min_dtype), for labels
+    dtype   : target dtype of the conversion (defaults to float32 if <scaling> is given, else the dtype of <array>)
+    scaling : None casts the values,
+              'minmax' maps [min, max] of <array> to [0, 1] for float or to the full range of integer <dtype>,
+              'zscore' subtracts the mean and divides by the standard deviation (float <dtype> only)
+    scaling is computed in float32 blocks of <block_items> elements, so only the result is allocated in full
+    raises ValueError for options that don't fit together (see check_conversion)
     """
-    value = []
-    if not ndalist:
-        return value
+    check_conversion(dtype, scaling, downcast)
+    if downcast:
+        return array.astype(min_dtype(array), copy=False)
 
-    total_bytes = sum([item.nbytes for item in ndalist])
-    total_mb = total_bytes/(1024.*1024.)
-    if total_mb > max_megabytes:
-        nchunks = int(math.ceil(total_mb/max_megabytes))
-        nitems = int(math.ceil(len(ndalist)/nchunks))
-        ndigits = len(str(nchunks))
-        cnt = 0
-        for i in range(int(math.ceil(nchunks))):
-            if cnt >= len(ndalist):
-                break
-            end = -1 if cnt+nitems > len(ndalist) else cnt+nitems
-            dst = basename+(('{0:0'+str(ndigits)+'}.npz').format(i))
-            np.savez_compressed(dst,
-                                *ndalist[cnt:end])
-            cnt += nitems
-            value.append(dst)
+    if not scaling:
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    dtype = np.dtype('float32' if dtype is None else dtype)
+    if scaling == 'minmax':
+        lo, hi = float(array.min()), float(array.max())
+        if dtype.kind == 'f':
+            dst_lo, dst_hi = 0., 1.
+        else:
+            dst_lo, dst_hi = float(np.iinfo(dtype).min), float(np.iinfo(dtype).max)
+        shift, scale, offset = lo, (dst_hi - dst_lo)/(hi - lo) if hi > lo else 0., dst_lo
     else:
-        dst = basename+'.npz'
-        np.savez_compressed(dst,
-                            *ndalist)
-        value.append(dst)
+        std = float(array.std(dtype='float64'))
+        shift, scale, offset = float(array.mean(dtype='float64')), 1./std if std > 0 else 0., 0.
+
+    value = np.empty(array.shape, dtype=dtype)
+    src = np.ascontiguousarray(array).reshape(-1)
+    dst = value.reshape(-1)
+    for start in range(0, src.size, block_items):
+        block = src[start:start+block_items].astype('float32')
+        block -= shift
+        block *= scale
+        block += offset
+        if dtype.kind != 'f':
+            np.rint(block, out=block)
+        dst[start:start+block_items] = block
+
+    return value
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class spill_file(object):
+    """ disk-backed storage for arrays that do not fit into memory,
+    arrays are copied into one np.memmap and handed out as views of it """
+
+    def __init__(self, path, nbytes, narrays=1, alignment=64, delete=False):
+        """ create file <path> for <narrays> arrays of <nbytes> bytes in total (plus alignment padding),
+        with <delete> the file is removed as soon as it is mapped, so its space is freed once the last view is gone
+        (where open files cannot be removed, e.g. on windows, it is removed when python exits) """
+        self.path = path
+        self.alignment = alignment
+        self.offset = 0
+        self.mapped = np.memmap(path, dtype='uint8', mode='w+', shape=(max(int(nbytes) + narrays*alignment, 1),))
+        if delete:
+            try:
+                os.remove(path)
+            except OSError:
+                atexit.register(_remove_quietly, path)
+
+    def store(self, array):
+        """ copy <array> into the file and return the np.memmap view holding it """
+        start = int(math.ceil(self.offset/float(self.alignment)))*self.alignment
+        stop = start + array.nbytes
+        if stop > self.mapped.size:
+            raise RuntimeError('{0} B do not fit into {1} at offset {2}'.format(array.nbytes, self.path, start))
+        view = self.mapped[start:stop].view(array.dtype).reshape(array.shape)
+        view[...] = array
+        self.offset = stop
+        return view
+
+    def flush(self):
+        self.mapped.flush()
+
+
+class memory_stage(object):
+    """ context manager that reports the peak memory allocated (by python and numpy) during a stage,
+    measured with tracemalloc, nothing is measured if <report> is False """
+
+    def __init__(self, name, report=True):
+        self.name = name
+        self.report = report
+        self.peak = 0
+        self._started = False
+        self._base = 0
+
+    def __enter__(self):
+        if not self.report:
+            return self
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc):
+        if not self.report:
+            return False
+        self.peak = max(tracemalloc.get_traced_memory()[1] - self._base, 0)
+        if self._started:
+            tracemalloc.stop()
+        print('[memory] {0}: peak {1:.4} MB'.format(self.name, self.peak/(1024.*1024.)))
+        return False
+
+
+class byte_lru_cache(object):
+    """ least-recently-used cache for numpy arrays, bounded by the sum of their nbytes,
+    cached arrays are handed out to every reader and therefore made read-only, copy them to change them """
+
+    def __init__(self, max_bytes=512*1024*1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """ return the array stored under <key> and mark it as recently used, <default> if absent """
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        """ store <value> under <key>, evicting the least recently used arrays until it fits
+        arrays larger than max_bytes are not cached at all
+        """
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key).nbytes
+            if value.nbytes > self.max_bytes:
+                return value
+            while self._items and self.nbytes + value.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+            value.flags.writeable = False
+            self._items[key] = value
+            self.nbytes += value.nbytes
+        return value
+
+    def clear(self):
+        """ drop all cached arrays """
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+# decoded arrays shared by all datasets of this process
+DECODED_CACHE = byte_lru_cache()
+
+
+def tif_header(tif):
+    """ return shape and dtype of the first series of the opened TiffFile <tif> and close it """
+    with tif:
+        series = tif.series[0]
+        return tuple(series.shape), np.dtype(series.dtype)
+
+
+def file_fingerprint(path):
+    """ describe <path> by its name, size and modification time, cheap enough to check on every run """
+    stat = os.stat(path)
+    return {'file': os.path.basename(path), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def zip_checksums(zipfiles):
+    """ return the CRC32 and size of every member of <zipfiles> as 'crc:size',
+    keyed by the path unzip_to extracts the member to (next to its archive) """
+    value = {}
+    for azipfile in zipfiles:
+        basedir = os.path.dirname(azipfile)
+        with zipfile.ZipFile(azipfile) as zf:
+            for info in zf.infolist():
+                value[os.path.join(basedir, info.filename)] = '{0:08x}:{1}'.format(info.CRC, info.file_size)
     return value
 
 
 def unzip_to(azipfile, basedir, force=False):
     """ unzip file <zipfile> into <basedir>
-    If the full content of <zipfile> is already found inside <basedir>, do nothing.
+    If the full content of <zipfile> is already found inside <basedir> (and is newer than <zipfile>), do nothing.
     If <force> is True, always unzip"""
 
     value = []
@@ -138,11 +423,13 @@ def unzip_to(azipfile, basedir, force=False):
     if not content:
         return value
 
+    zmtime = os.stat(azipfile).st_mtime
     for info in content:
         xsize = info.file_size
         xname = info.filename
         exp_path = os.path.join(basedir, xname)
-        if not os.path.isfile(exp_path) or not os.stat(exp_path).st_size == xsize:
+        if force or not os.path.isfile(exp_path) or not os.stat(exp_path).st_size == xsize or \
+           os.stat(exp_path).st_mtime < zmtime:
             zf.extract(xname, basedir)
         value.append(exp_path)
 
@@ -152,3 +439,16 @@ def unzip_to(azipfile, basedir, force=False):
 def wrap_unzip_to(args):
     """ wrapper around unzip_to that unpacks the arguments """
     return unzip_to(*args)
+
+
+# moved to b3get.download and b3get.stores, still importable from here
+_MOVED = {'size_of_content': 'download', 'serial_download_file': 'download', 'wrap_serial_download_file': 'download',
+          'chunk_npz': 'stores'}
+
+
+def __getattr__(name):
+    """ resolve the names that moved out of utils lazily, importing their module here would be circular """
+    if name in _MOVED:
+        import importlib
+        return getattr(importlib.import_module('b3get.' + _MOVED[name]), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,28 @@
+import os
+import pytest
+import shutil
+import tempfile
+
+from b3get import catalog
+from b3get.datasets import dataset
+
+
+@pytest.fixture
+def offline_dataset(monkeypatch):
+    """ factory of datasets that don't contact any site when they are created, offline_dataset(baseurl, name)
+    is dataset <name> at <baseurl>/<name>/ (e.g. a local test server) whose zip files <images> and <gt> are
+    listed completely in a temporary catalog ($B3GET_CATALOG), its files are downloaded into a temporary
+    cache ($B3GET_CACHE) that is removed after the test """
+    cache = tempfile.mkdtemp()
+    path = os.path.join(cache, 'catalog.json')
+    monkeypatch.setenv('B3GET_CACHE', cache)
+    monkeypatch.setenv('B3GET_CATALOG', path)
+
+    def create(baseurl='http://127.0.0.1', name='BBBC000', images=(), gt=()):
+        catalog.save_catalog({name: {'images': list(images), 'gt': list(gt)}}, path)
+        return dataset('{0}/{1}/'.format(baseurl.rstrip('/'), name))
+
+    yield create
+    monkeypatch.delenv('B3GET_CATALOG')
+    catalog.load_catalog(reload=True)
+    shutil.rmtree(cache, ignore_errors=True)
@@ -1,4 +1,4 @@
-from b3get import to_numpy
+from b3get import to_numpy, prefetch
 import numpy as np
 
 
@@ -22,3 +22,15 @@ def test_008():
     assert isinstance(labs[0], np.ndarray)
     assert labs[0].shape == (512, 512)
     assert imgs[0].dtype == np.uint8
+
+
+def test_prefetch_008():
+    handle = prefetch([8, 43])
+    (imgs, labs), missing = handle.result()
+    assert missing == (None, None)
+    assert len([item for item in imgs if item.endswith('.tif')]) == 24
+    assert len(labs) > 0
+    assert handle.progress()['stage'] == 'done'
+
+    imgs, _ = to_numpy(8)
+    assert len(imgs) == 24
@@ -0,0 +1,105 @@
+import json
+import os
+import pytest
+import tempfile
+
+from b3get import catalog
+from b3get import datasets
+from b3get.datasets import ds_008, REGISTRY, dataset_number, get_dataset
+
+
+@pytest.fixture
+def user_catalog(monkeypatch):
+    path = tempfile.mktemp(suffix='.json')
+    monkeypatch.setenv('B3GET_CATALOG', path)
+    catalog.load_catalog(reload=True)
+    yield path
+    if os.path.exists(path):
+        os.remove(path)
+    monkeypatch.delenv('B3GET_CATALOG')
+    catalog.load_catalog(reload=True)
+
+
+def test_packaged_catalog(user_catalog):
+    entries = catalog.load_catalog()
+    assert set('BBBC{0:03}'.format(dsid) for dsid in REGISTRY) <= set(entries)
+    assert catalog.file_entry('BBBC008', 'BBBC008_v1_foreground.zip')['size'] == 484995
+    url = 'https://data.broadinstitute.org/bbbc/BBBC008/BBBC008_v1_foreground.zip'
+    assert catalog.file_entry('BBBC008', url)['count'] == 24
+    assert catalog.file_entry('BBBC008', 'unknown.zip') == {}
+    assert catalog.dataset_entry('BBBC999') == {}
+
+
+def test_user_catalog_takes_precedence(user_catalog):
+    catalog.save_catalog({'BBBC008': {'images': ['BBBC008_v1_images.zip'], 'gt': ['BBBC008_v1_foreground.zip'],
+                                      'files': {'BBBC008_v1_images.zip': {'size': 1234}}}})
+    with open(user_catalog) as fi:
+        assert 'BBBC008' in json.load(fi)
+
+    entry = catalog.dataset_entry('BBBC008')
+    assert entry['images'] == ['BBBC008_v1_images.zip']
+    assert entry['title'].startswith('Human HT29')
+    assert entry['files']['BBBC008_v1_images.zip']['size'] == 1234
+    assert entry['files']['BBBC008_v1_foreground.zip']['size'] == 484995
+
+
+def test_offline_dataset(user_catalog, monkeypatch):
+    catalog.save_catalog({'BBBC008': {'images': ['BBBC008_v1_images.zip'], 'gt': ['BBBC008_v1_foreground.zip'],
+                                      'files': {'BBBC008_v1_images.zip': {'size': 1234}}}})
+
+    def offline(*args, **kwargs):
+        raise AssertionError('no request expected')
+    monkeypatch.setattr(datasets.requests, 'get', offline)
+    monkeypatch.setattr(datasets, 'size_of_content', offline)
+
+    ds = get_dataset('BBBC008')
+    assert isinstance(ds, ds_008)
+    assert ds.title().startswith('Human HT29')
+    assert ds.list_images() == ['BBBC008_v1_images.zip']
+    assert ds.list_gt(True)[0].endswith('/BBBC008_v1_foreground.zip')
+    assert ds.expected_size(ds.list_images(True)[0]) == 1234
+    assert ds.expected_size('BBBC008_v1_foreground.zip') == 484995
+
+
+def test_registry():
+    assert dataset_number(6) == 6
+    assert dataset_number('24') == 24
+    assert dataset_number('BBBC027') == 27
+    assert dataset_number('bbbc008') == 8
+
+    with pytest.raises(KeyError):
+        get_dataset(12, experimental=False)
+    with pytest.raises(RuntimeError):
+        get_dataset(43)
+
+
+def test_describe_dataset(monkeypatch):
+    class fake(object):
+        baseurl = 'https://example.org/BBBC000/'
+        datasetid = 'BBBC000'
+
+        def list_images(self):
+            return ['BBBC000_images.zip']
+
+        def list_gt(self):
+            return ['BBBC000_labels.zip']
+
+        def title(self):
+            return 'fake'
+
+        def describe(self, rex=None, lrex=None):
+            return [{'zip': 'BBBC000_images.zip', 'shape': (8, 8), 'dtype': 'uint8', 'decoded_size': 64},
+                    {'zip': 'BBBC000_images.zip', 'shape': (8, 8), 'dtype': 'uint8', 'decoded_size': 64},
+                    {'zip': 'BBBC000_labels.zip', 'shape': (8, 8), 'dtype': 'uint8', 'decoded_size': 64},
+                    {'zip': 'BBBC000_labels.zip', 'shape': (4, 8), 'dtype': 'uint8', 'decoded_size': 32}]
+
+    monkeypatch.setattr(catalog, 'size_of_content', lambda url: len(url))
+    entry = catalog.describe_dataset(fake())
+    assert entry['title'] == 'fake'
+    assert entry['images'] == ['BBBC000_images.zip']
+    images = entry['files']['BBBC000_images.zip']
+    assert images == {'size': len(fake.baseurl + 'BBBC000_images.zip'), 'count': 2, 'decoded_size': 128,
+                      'shape': [8, 8], 'dtype': 'uint8'}
+    labels = entry['files']['BBBC000_labels.zip']
+    assert labels['shape'] is None
+    assert labels['dtype'] == 'uint8'
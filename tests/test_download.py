@@ -0,0 +1,484 @@
+import functools
+import gzip
+import os
+import pytest
+import re
+import requests
+import shutil
+import tempfile
+import threading
+import time
+
+from http.server import SimpleHTTPRequestHandler, HTTPServer
+
+from b3get.datasets import pull_many, shard_jobs
+from b3get.download import download_files, largest_first, token_bucket, concurrency_limit, retry_policy, size_of_content
+from b3get.download import lockfile, file_sha256, serial_download_file, benchmark_download, materialize, split_by_size
+from b3get.download import parse_shard, mirror_list, local_path, _response_source
+
+
+class quiet_handler(SimpleHTTPRequestHandler):
+    """ serves files, also as /BBBC<nnn>/<file> for the datasets of the tests, requests to /flaky/<file>
+    fail with 503 twice before they succeed, /gzip/<file> is sent gzip encoded """
+
+    failures = {}
+
+    def log_message(self, *args):
+        pass
+
+    def translate_path(self, path):
+        return SimpleHTTPRequestHandler.translate_path(self, re.sub('^/BBBC[0-9]{3}/', '/', path))
+
+    def do_GET(self):
+        if self.path.startswith('/flaky/'):
+            if self.failures.get(self.path, 0) < 2:
+                self.failures[self.path] = self.failures.get(self.path, 0) + 1
+                self.send_error(503)
+                return
+            self.path = self.path[len('/flaky'):]
+        if self.path.startswith('/gzip/'):
+            with open(os.path.join(self.directory, self.path[len('/gzip/'):]), 'rb') as fi:
+                data = gzip.compress(fi.read())
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        SimpleHTTPRequestHandler.do_GET(self)
+
+
+@pytest.fixture
+def server():
+    """ serve a folder with a few files of different sizes on localhost """
+    srcdir = tempfile.mkdtemp()
+    for name, size in (('a.zip', 1000), ('b.zip', 300000), ('c.zip', 5)):
+        with open(os.path.join(srcdir, name), 'wb') as fo:
+            fo.write(os.urandom(size))
+
+    httpd = HTTPServer(('127.0.0.1', 0), functools.partial(quiet_handler, directory=srcdir))
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{0}'.format(httpd.server_address[1]), srcdir
+    httpd.shutdown()
+    httpd.server_close()
+    shutil.rmtree(srcdir)
+
+
+def test_download_files(server):
+    baseurl, srcdir = server
+    dstdir = tempfile.mkdtemp()
+    jobs = [(baseurl + '/a.zip', dstdir, 1000), (baseurl + '/b.zip', dstdir, 300000), (baseurl + '/c.zip', dstdir, 6)]
+    report = []
+    files = download_files(jobs, nprocs=2, report=report)
+    assert files == [os.path.join(dstdir, 'a.zip'), os.path.join(dstdir, 'b.zip')]
+    assert len(report) == 1
+    assert report[0]['url'].endswith('c.zip')
+    assert report[0]['received_size'] == 5
+    with open(files[1], 'rb') as fi, open(os.path.join(srcdir, 'b.zip'), 'rb') as fe:
+        assert fi.read() == fe.read()
+
+    # an unknown size (HEAD failed) is not held against the download
+    report = []
+    os.remove(files[0])
+    assert download_files([(baseurl + '/a.zip', dstdir, 0), (baseurl + '/c.zip', dstdir, None)],
+                          report=report) == [files[0], os.path.join(dstdir, 'c.zip')]
+    assert report == []
+    assert os.stat(files[0]).st_size == 1000
+    shutil.rmtree(dstdir)
+
+
+def test_pull_many(server, offline_dataset):
+    baseurl, _ = server
+    first = offline_dataset(baseurl, 'BBBC000')
+    second = offline_dataset(baseurl, 'BBBC001')
+
+    files = pull_many([(first, ['a.zip', 'b.zip']), (second, ['c.zip'])], nprocs=3)
+    assert files == [[os.path.join(first.tmp_location, 'a.zip'), os.path.join(first.tmp_location, 'b.zip')],
+                     [os.path.join(second.tmp_location, 'c.zip')]]
+    assert os.stat(files[0][1]).st_size == 300000
+
+    # present files are not downloaded again
+    again = pull_many([(first, ['a.zip', 'b.zip'])], nprocs=3)
+    assert again == files[:1]
+
+
+def test_largest_first():
+    assert largest_first([5, 300, 20, 300, 1]) == [1, 3, 2, 0, 4]
+    assert largest_first([]) == []
+
+
+def test_token_bucket():
+    unlimited = token_bucket()
+    assert unlimited.consume(10**9) == 0.
+
+    bucket = token_bucket(100000, burst=10000)
+    assert bucket.consume(10000) == 0.
+    start = time.time()
+    waited = bucket.consume(20000)
+    assert waited > 0.15
+    assert time.time() - start > 0.15
+
+
+def test_concurrency_limit_adapts():
+    fixed = concurrency_limit(4)
+    assert fixed.limit == 4
+
+    limit = concurrency_limit(8, adaptive=True, start=2, interval=1.)
+    assert limit.limit == 2
+
+    def interval(nbytes):
+        limit._stamp -= 1.
+        limit.record(nbytes)
+
+    interval(1000)  # first measurement: grow
+    assert limit.limit == 3
+    interval(2000)  # more throughput: keep growing
+    assert limit.limit == 4
+    interval(2100)  # no significant change: hold
+    assert limit.limit == 4
+    interval(500)   # throughput dropped: step back
+    assert limit.limit == 3
+
+    limit.acquire()
+    limit._stamp -= 1.
+    limit.release(failed=True)  # errors: halve
+    assert limit.limit == 1
+    assert limit.history == [2, 3, 4, 4, 3, 1]
+
+
+def test_download_files_rate_limited(server):
+    baseurl, _ = server
+    dstdir = tempfile.mkdtemp()
+    start = time.time()
+    files = download_files([(baseurl + '/b.zip', dstdir, 300000)], nprocs=2, chunk_bytes=16384, max_rate=150000)
+    assert len(files) == 1
+    assert time.time() - start > 0.8
+    shutil.rmtree(dstdir)
+
+
+def test_download_files_adaptive(server):
+    baseurl, _ = server
+    dstdir = tempfile.mkdtemp()
+    jobs = [(baseurl + '/{0}.zip'.format(name), dstdir, size) for name, size in (('a', 1000), ('b', 300000), ('c', 5))]
+    files = download_files(jobs, nprocs=4, adaptive=True)
+    assert len(files) == 3
+    shutil.rmtree(dstdir)
+
+
+def test_retry_policy():
+    policy = retry_policy(backoff=1., max_backoff=5., jitter=0.5, read_timeout=10., min_rate=1024, max_read_timeout=60.)
+    assert 0.5 <= policy.delay(0) <= 1.
+    assert 2. <= policy.delay(2) <= 4.
+    assert 2.5 <= policy.delay(10) <= 5.
+    assert policy.timeout() == (policy.connect_timeout, 10.)
+    assert policy.timeout(10*1024) == (policy.connect_timeout, 20.)
+    assert policy.timeout(10**9)[1] == 60.
+
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise requests.exceptions.ConnectionError('reset')
+        return 'done'
+    assert retry_policy(backoff=0.).call(flaky) == 'done'
+    assert len(calls) == 3
+
+    def broken():
+        raise ValueError('not transient')
+    with pytest.raises(ValueError) as err:
+        retry_policy(backoff=0.).call(broken)
+    assert err.value.attempts == 1
+
+
+def test_download_files_retries(server):
+    baseurl, _ = server
+    dstdir = tempfile.mkdtemp()
+    policy = retry_policy(backoff=0.01)
+    report = []
+    jobs = [(baseurl + '/flaky/a.zip', dstdir, 1000), (baseurl + '/missing.zip', dstdir, 10)]
+    files = download_files(jobs, nprocs=2, policy=policy, report=report)
+    assert files == [os.path.join(dstdir, 'a.zip')]
+    assert len(report) == 1
+    assert report[0]['url'].endswith('missing.zip')
+    assert report[0]['attempts'] == 1
+    assert '404' in report[0]['error']
+
+    assert size_of_content(baseurl + '/missing.zip', policy) == 0
+    shutil.rmtree(dstdir)
+
+
+def test_pull_many_lock(server, monkeypatch, offline_dataset):
+    baseurl, srcdir = server
+    ds = offline_dataset(baseurl, 'BBBC000')
+    lock = lockfile(os.path.join(ds.tmp_location, 'b3get.lock'))
+
+    files = pull_many([(ds, ['a.zip', 'b.zip'])], nprocs=2, lock=lock)[0]
+    assert os.path.isfile(os.path.join(ds.tmp_location, 'b3get.lock'))
+    again = lockfile(os.path.join(ds.tmp_location, 'b3get.lock'))
+    assert len(again) == 2
+    entry = again.get(files[1])
+    assert entry['url'] == baseurl + '/BBBC000/b.zip'
+    assert entry['size'] == 300000
+    assert entry['sha256'] == file_sha256(os.path.join(srcdir, 'b.zip'))
+
+    # locked: files are trusted after one stat, sizes come from the lock
+    def offline(*args, **kwargs):
+        raise AssertionError('no request expected')
+    with monkeypatch.context() as patch:
+        patch.setattr(ds, 'expected_size', offline)
+        patch.setattr('b3get.datasets.download_files', lambda jobs, *args, **kwargs: offline() if jobs else [])
+        assert pull_many([(ds, ['a.zip', 'b.zip'])], lock=again, locked=True)[0] == files
+
+    # files the lock does not record are reported, not downloaded
+    report = []
+    assert pull_many([(ds, ['a.zip', 'c.zip'])], lock=again, locked=True, report=report)[0] == files[:1]
+    assert not os.path.exists(os.path.join(ds.tmp_location, 'c.zip'))
+    assert [item['url'] for item in report] == [baseurl + '/BBBC000/c.zip']
+    assert 'not recorded' in report[0]['error']
+
+    # a local change is repaired by downloading the file again
+    with open(files[1], 'r+b') as fo:
+        fo.write(b'broken')
+    assert pull_many([(ds, ['a.zip', 'b.zip'])], lock=again, locked=True)[0] == files
+    assert file_sha256(files[1]) == entry['sha256']
+
+    # a remote change does not match the lock
+    with open(os.path.join(srcdir, 'b.zip'), 'r+b') as fo:
+        fo.write(b'changed')
+    os.utime(files[1], (0, 0))
+    report = []
+    assert pull_many([(ds, ['a.zip', 'b.zip'])], lock=again, locked=True, report=report)[0] == files[:1]
+    assert not os.path.exists(files[1])
+    assert 'SHA-256' in report[0]['error']
+    assert lockfile(ds.tmp_location).get(files[1])['sha256'] == entry['sha256']
+
+
+@pytest.mark.parametrize('writer', ['readinto', 'iter_content'])
+def test_serial_download_writers(server, writer):
+    baseurl, srcdir = server
+    dstdir = tempfile.mkdtemp()
+    hashes = {}
+    # a buffer smaller than the file and not a multiple of it
+    fpath = serial_download_file(baseurl + '/b.zip', dstdir, chunk_bytes=100000, hashes=hashes, writer=writer)
+    assert fpath == os.path.join(dstdir, 'b.zip')
+    assert [item for item in os.listdir(dstdir) if item.endswith('.part')] == []
+    assert os.stat(fpath).st_size == 300000
+    assert hashes[fpath] == file_sha256(os.path.join(srcdir, 'b.zip'))
+    shutil.rmtree(dstdir)
+
+
+@pytest.mark.parametrize('path', ['/b.zip', '/gzip/b.zip'])
+def test_response_source(server, path):
+    baseurl, srcdir = server
+    buf = bytearray(64*1024)
+    received = bytearray()
+    with requests.get(baseurl + path, stream=True) as r:
+        source = _response_source(r)
+        while True:
+            count = source.readinto(buf)
+            if not count:
+                break
+            received += buf[:count]
+    with open(os.path.join(srcdir, 'b.zip'), 'rb') as fi:
+        assert bytes(received) == fi.read()
+
+
+def test_benchmark_download(server):
+    baseurl, _ = server
+    dstdir = tempfile.mkdtemp()
+    # a file of the same name in the destination is left alone
+    with open(os.path.join(dstdir, 'b.zip'), 'wb') as fo:
+        fo.write(b'pulled before')
+    res = benchmark_download(baseurl + '/b.zip', dstdir, repeats=2)
+    assert [item['writer'] for item in res] == ['readinto', 'iter_content']
+    assert all(item['throughput'] > 0 for item in res)
+    assert os.listdir(dstdir) == ['b.zip']
+    with open(os.path.join(dstdir, 'b.zip'), 'rb') as fi:
+        assert fi.read() == b'pulled before'
+    shutil.rmtree(dstdir)
+
+
+def test_materialize():
+    srcdir = tempfile.mkdtemp()
+    src = os.path.join(srcdir, 'a.zip')
+    with open(src, 'wb') as fo:
+        fo.write(os.urandom(100))
+    dst = os.path.join(srcdir, 'b.zip')
+    with open(dst, 'wb') as fo:
+        fo.write(b'stale')
+
+    assert materialize(src, dst) == 'hardlink'
+    assert os.path.samefile(src, dst)
+    assert materialize(src, dst) == 'hardlink'
+    shutil.rmtree(srcdir)
+
+
+def test_pull_many_cache(server, monkeypatch, offline_dataset):
+    baseurl, srcdir = server
+    ds = offline_dataset(baseurl, 'BBBC000')
+    first, second = tempfile.mkdtemp(), tempfile.mkdtemp()
+
+    files = pull_many([(ds, ['a.zip', 'b.zip'], first)], nprocs=2, lock=lockfile(first), cache=True)[0]
+    assert files == [os.path.join(first, 'a.zip'), os.path.join(first, 'b.zip')]
+    assert os.path.samefile(files[1], os.path.join(ds.tmp_location, 'b.zip'))
+    assert lockfile(first).get(files[1])['sha256'] == file_sha256(os.path.join(srcdir, 'b.zip'))
+
+    # a second consumer is served from the cache without downloading
+    with monkeypatch.context() as patch:
+        patch.setattr('b3get.datasets.download_files', lambda jobs, *args, **kwargs: [] if not jobs else 1/0)
+        files = pull_many([(ds, ['a.zip', 'b.zip'], second)], lock=lockfile(second), cache=True)[0]
+    assert files == [os.path.join(second, 'a.zip'), os.path.join(second, 'b.zip')]
+    assert os.path.samefile(files[0], os.path.join(first, 'a.zip'))
+    assert len(lockfile(second)) == 2
+
+    # two folders of one pull share one download
+    third, fourth = tempfile.mkdtemp(), tempfile.mkdtemp()
+    os.remove(os.path.join(ds.tmp_location, 'a.zip'))
+    files = pull_many([(ds, ['a.zip'], third), (ds, ['a.zip'], fourth)], nprocs=2, cache=True)
+    assert files == [[os.path.join(third, 'a.zip')], [os.path.join(fourth, 'a.zip')]]
+    assert os.path.samefile(files[0][0], files[1][0])
+    shutil.rmtree(third)
+    shutil.rmtree(fourth)
+
+    for item in (first, second, ds.tmp_location):
+        shutil.rmtree(item)
+
+
+def test_split_by_size():
+    sizes = [5, 300, 1000, 20, 700, 10]
+    parts = split_by_size(sizes, 3)
+    assert sorted(idx for part in parts for idx in part) == list(range(len(sizes)))
+    assert [sum(sizes[idx] for idx in part) for part in parts] == [1000, 700, 335]
+
+    # the assignment follows the keys, not the order of the items
+    names = ['f{0}'.format(idx) for idx in range(len(sizes))]
+    order = [3, 0, 5, 1, 4, 2]
+    shuffled = split_by_size([sizes[idx] for idx in order], 3, [names[idx] for idx in order])
+    assert [sorted(names[order[idx]] for idx in part) for part in shuffled] == \
+        [sorted(names[idx] for idx in part) for part in parts]
+    assert split_by_size([], 2) == [[], []]
+
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (1, 4)
+    for text in ('4/4', '-1/2', '1', 'a/b', '0/0'):
+        with pytest.raises(ValueError):
+            parse_shard(text)
+
+
+def test_pull_many_shards(server, offline_dataset):
+    baseurl, _ = server
+    ds = offline_dataset(baseurl, 'BBBC000')
+    names = ['a.zip', 'b.zip', 'c.zip']
+
+    parts = [shard_jobs([(ds, names)], idx, 2)[0][1] for idx in range(2)]
+    assert parts == [['b.zip'], ['a.zip', 'c.zip']]
+
+    files = [pull_many([(ds, names)], shard=(idx, 2))[0] for idx in range(2)]
+    assert sorted(os.path.basename(item) for part in files for item in part) == names
+
+
+def test_mirror_list_sources(monkeypatch):
+    monkeypatch.setenv('B3GET_MIRRORS', 'http://mirror/bbbc/, /data/bbbc')
+    mirrors = mirror_list()
+    assert mirrors.mirrors == ['http://mirror/bbbc/', '/data/bbbc']
+    url = mirrors.origin + 'BBBC008/a.zip'
+    assert mirrors.sources(url) == ['http://mirror/bbbc/BBBC008/a.zip', os.path.join('/data/bbbc', 'BBBC008', 'a.zip'), url]
+    assert mirrors.sources('http://elsewhere/a.zip') == ['http://elsewhere/a.zip']
+    assert mirror_list([]).sources(url) == [url]
+
+    assert local_path('/data/a.zip') == '/data/a.zip'
+    assert local_path('file:///data/a.zip') == '/data/a.zip'
+    assert local_path('https://mirror/a.zip') is None
+
+
+def test_mirror_fastest_and_failover(server):
+    baseurl, srcdir = server
+    dstdir = tempfile.mkdtemp()
+    # the local mirror is fastest but lacks c.zip, the dead mirror can't be probed
+    mirror = tempfile.mkdtemp()
+    for name in ('a.zip', 'b.zip'):
+        shutil.copy(os.path.join(srcdir, name), mirror)
+    mirrors = mirror_list(['http://127.0.0.1:1/', 'file://' + mirror], origin=baseurl + '/')
+
+    assert mirrors.rank(baseurl + '/b.zip', 300000) == ['file://' + mirror + '/b.zip', baseurl + '/b.zip',
+                                                        'http://127.0.0.1:1/b.zip']
+    jobs = [(baseurl + '/' + name, dstdir, size) for name, size in (('a.zip', 1000), ('b.zip', 300000), ('c.zip', 5))]
+    hashes = {}
+    files = download_files(jobs, nprocs=2, hashes=hashes, mirrors=mirrors, policy=retry_policy(retries=0))
+    assert [os.path.basename(item) for item in files] == ['a.zip', 'b.zip', 'c.zip']
+    for item in files:
+        assert hashes[item] == file_sha256(os.path.join(srcdir, os.path.basename(item)))
+    shutil.rmtree(mirror)
+    shutil.rmtree(dstdir)
+
+
+def test_prefetch(server, offline_dataset):
+    baseurl, srcdir = server
+    ds = offline_dataset(baseurl, 'BBBC000', images=['a.zip', 'b.zip'], gt=['c.zip'])
+
+    finished = []
+    handle = ds.prefetch(extract=False, nprocs=2)
+    handle.add_done_callback(finished.append)
+    imgs, gt = handle.result(timeout=60)
+    assert imgs == [os.path.join(ds.tmp_location, 'a.zip'), os.path.join(ds.tmp_location, 'b.zip')]
+    assert gt == [os.path.join(ds.tmp_location, 'c.zip')]
+    assert handle.progress() == {'stage': 'done', 'received': 301005, 'expected': 301005}
+    assert handle.done() and finished == [handle]
+
+    # failures end up in the future
+    ds.list_gt = lambda: 1/0
+    handle = ds.prefetch()
+    assert isinstance(handle.exception(timeout=60), ZeroDivisionError)
+    assert handle.progress()['stage'] == 'failed'
+
+
+def test_prefetch_extracts(server, offline_dataset):
+    from tests.test_resave import write_zip
+    baseurl, srcdir = server
+    write_zip(srcdir, 'd', range(2))
+    ds = offline_dataset(baseurl, 'BBBC000', images=['d.zip'])
+
+    imgs, gt = ds.prefetch(nprocs=2).result(timeout=60)
+    assert [os.path.basename(item) for item in imgs if item.endswith('.tif')] == ['img_000.tif', 'img_001.tif']
+    assert gt == []
+
+
+def test_concurrent_downloads_of_one_file(server):
+    baseurl, srcdir = server
+    dstdir = tempfile.mkdtemp()
+    errors = []
+
+    def fetch():
+        try:
+            serial_download_file(baseurl + '/b.zip', dstdir, chunk_bytes=64*1024)
+        except Exception as ex:
+            errors.append(ex)
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert os.listdir(dstdir) == ['b.zip']
+    assert file_sha256(os.path.join(dstdir, 'b.zip')) == file_sha256(os.path.join(srcdir, 'b.zip'))
+    shutil.rmtree(dstdir)
+
+
+def test_resave_benchmark_pulls_what_it_samples(server, monkeypatch, offline_dataset):
+    from tests.test_resave import write_zip
+    from b3get.cli import main
+    baseurl, srcdir = server
+    write_zip(srcdir, 'd', range(3))
+    write_zip(srcdir, 'e', range(3, 5))
+    ds = offline_dataset(baseurl, 'BBBC000', images=['d.zip', 'e.zip'])
+    monkeypatch.setattr('b3get.datasets.get_dataset', lambda *args: ds)
+    dstdir = tempfile.mkdtemp()
+
+    assert main(['b3get', 'resave', '-b', '2', '-o', dstdir, '0']) == 0
+    assert os.path.isfile(os.path.join(dstdir, 'd.zip'))
+    assert not os.path.exists(os.path.join(dstdir, 'e.zip'))
+    shutil.rmtree(dstdir)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from b3get.utils import min_dtype, convert, check_conversion
+
+
+def test_min_dtype():
+    assert min_dtype(np.array([0, 200], dtype='int64')) == np.uint8
+    assert min_dtype(np.array([0, 300], dtype='uint32')) == np.uint16
+    assert min_dtype(np.array([-1, 100], dtype='int32')) == np.int8
+    assert min_dtype(np.array([0.5], dtype='float64')) == np.float64
+
+
+def test_downcast_labels():
+    labels = np.zeros((64, 64), dtype='uint32')
+    labels[10:20, 10:20] = 42
+    value = convert(labels, downcast=True)
+    assert value.dtype == np.uint8
+    assert np.array_equal(value, labels)
+
+
+def test_minmax_to_float():
+    image = np.arange(1000, 1000+64*64, dtype='uint16').reshape(64, 64)
+    value = convert(image, scaling='minmax', block_items=1000)
+    assert value.dtype == np.float32
+    assert value.min() == 0.
+    assert value.max() == 1.
+    assert np.allclose(value, (image - 1000.)/(64*64 - 1))
+
+
+def test_minmax_to_uint8():
+    image = np.linspace(0, 4095, 256*256).astype('uint16').reshape(256, 256)
+    value = convert(image, dtype='uint8', scaling='minmax')
+    assert value.dtype == np.uint8
+    assert value.min() == 0
+    assert value.max() == 255
+
+
+def test_zscore():
+    image = np.random.RandomState(42).randint(0, 4096, size=(32, 32)).astype('uint16')
+    value = convert(image, scaling='zscore')
+    assert abs(value.mean()) < 1e-4
+    assert abs(value.std() - 1.) < 1e-4
+    with pytest.raises(ValueError):
+        convert(image, dtype='uint8', scaling='zscore')
+
+
+def test_plain_cast():
+    image = np.arange(16, dtype='uint16')
+    assert convert(image) is image
+    assert convert(image, dtype='float32').dtype == np.float32
+
+
+@pytest.mark.parametrize('options', [{'scaling': 'min-max'}, {'dtype': 'uint8', 'scaling': 'zscore'},
+                                     {'dtype': 'float32', 'downcast': True}, {'scaling': 'minmax', 'downcast': True},
+                                     {'dtype': 'no such type'}, {'dtype': 'bool', 'scaling': 'minmax'}])
+def test_invalid_conversions(options):
+    with pytest.raises(ValueError):
+        check_conversion(**options)
+    with pytest.raises(ValueError):
+        convert(np.arange(16, dtype='uint16'), **options)
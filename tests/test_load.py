@@ -0,0 +1,82 @@
+import numpy as np
+import os
+import pytest
+import shutil
+import tempfile
+
+import b3get
+from b3get.utils import byte_lru_cache
+from b3get.stores import npz_writer, raw_writer, zarr_writer, shard_basename, shard_sequence
+
+
+@pytest.fixture
+def outdir():
+    basedir = tempfile.mkdtemp()
+    yield basedir
+    shutil.rmtree(basedir)
+
+
+def arrays(nitems=8, value=0):
+    return [np.full((4, 32, 16), value + idx, dtype='uint16') for idx in range(nitems)]
+
+
+@pytest.mark.parametrize('writer', [npz_writer, raw_writer, zarr_writer])
+def test_load_shards(outdir, writer):
+    basename = os.path.join(outdir, 'BBBC006_images')
+    plan = [[0, 1, 2], [3, 4, 5], [6, 7]]
+    with writer(basename, 1, plan=plan if writer is not zarr_writer else None) as wr:
+        for array in arrays():
+            wr.append(array)
+
+    seq = b3get.load(basename+'.json', cache=byte_lru_cache())
+    assert isinstance(seq, shard_sequence)
+    assert len(seq) == 8
+    assert seq.shape(5) == (4, 32, 16)
+    assert seq.dtype(5) == np.uint16
+    assert np.all(seq[5] == 5)
+    assert np.all(seq[-1] == 7)
+    assert [item[0, 0, 0] for item in seq[1:7:2]] == [1, 3, 5]
+    seq.close()
+
+
+def test_load_parallel_and_cached(outdir):
+    basename = os.path.join(outdir, 'BBBC006_images')
+    with npz_writer(basename, 1, plan=[[0, 1, 2, 3], [4, 5, 6, 7]]) as wr:
+        for array in arrays():
+            wr.append(array)
+    assert shard_basename(wr.files[1]) == basename
+
+    cache = byte_lru_cache()
+    with b3get.load(wr.files[1], nprocs=4, cache=cache) as seq:
+        decoded = seq[:]
+        assert [item[0, 0, 0] for item in decoded] == list(range(8))
+        assert len(cache) == 8
+        assert seq[[7, 0]][0] is decoded[7]
+        assert not any(item.flags.writeable for item in decoded)
+
+
+def test_load_prefix(outdir):
+    prefix = os.path.join(outdir, 'BBBC006')
+    for suffix, value in (('_images', 0), ('_labels', 100)):
+        with raw_writer(prefix+suffix) as wr:
+            for array in arrays(3, value):
+                wr.append(array)
+
+    imgs, labs = b3get.load(prefix)
+    assert len(imgs) == len(labs) == 3
+    assert np.all(imgs[2] == 2)
+    assert np.all(labs[2] == 102)
+
+    with pytest.raises(IOError):
+        b3get.load(os.path.join(outdir, 'BBBC008'))
+
+
+def test_load_npz_without_index(outdir):
+    data = arrays(12)
+    np.savez(os.path.join(outdir, 'old_images0.npz'), *data[:6])
+    np.savez(os.path.join(outdir, 'old_images1.npz'), *data[6:])
+
+    seq = b3get.load(os.path.join(outdir, 'old_images'), cache=byte_lru_cache())
+    assert len(seq) == 12
+    assert seq.shape(11) == (4, 32, 16)
+    assert [item[0, 0, 0] for item in seq[:]] == list(range(12))
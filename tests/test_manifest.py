@@ -0,0 +1,91 @@
+import functools
+import json
+import os
+import pytest
+import shutil
+import tempfile
+import threading
+
+from http.server import HTTPServer
+
+from b3get.manifest import compile_plan, run_manifest, stamp_location
+from tests.test_download import quiet_handler
+from tests.test_resave import write_zip
+
+
+@pytest.fixture
+def site(monkeypatch, offline_dataset):
+    """ serve two image and one label archive on localhost as dataset BBBC000, a manifest folder to run in """
+    srcdir = tempfile.mkdtemp()
+    write_zip(srcdir, 'a', range(0, 3))
+    write_zip(srcdir, 'b', range(3, 5))
+    write_zip(srcdir, 'labels', range(0, 5))
+
+    httpd = HTTPServer(('127.0.0.1', 0), functools.partial(quiet_handler, directory=srcdir))
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    ds = offline_dataset('http://127.0.0.1:{0}'.format(httpd.server_address[1]), 'BBBC000')
+    listed = []
+    ds.list_images = lambda: listed.append('images') or ['a.zip', 'b.zip']
+    ds.list_gt = lambda: listed.append('gt') or ['labels.zip']
+    monkeypatch.setattr('b3get.manifest.get_dataset', lambda dsid: ds)
+
+    workdir = tempfile.mkdtemp()
+    yield ds, workdir, listed
+    httpd.shutdown()
+    httpd.server_close()
+    for item in (srcdir, workdir):
+        shutil.rmtree(item)
+
+
+def write_manifest(workdir, manifest):
+    path = os.path.join(workdir, 'manifest.json')
+    with open(path, 'w') as fo:
+        json.dump(manifest, fo)
+    return path
+
+
+MANIFEST = {'to': 'out', 'entries': [{'dataset': 'BBBC000', 'export': {'format': 'npz'}},
+                                     {'dataset': 0, 'rex': 'a', 'lrex': 'none', 'name': 'subset',
+                                      'export': {'format': 'raw'}}]}
+
+
+def test_compile_plan(site):
+    ds, workdir, listed = site
+    plan = compile_plan(MANIFEST, workdir)
+    assert len(plan['pulls']) == 1
+    assert plan['pulls'][0]['files'] == ['a.zip', 'b.zip', 'labels.zip']
+    assert [(step['what'], os.path.basename(step['basename'])) for step in plan['exports']] == \
+        [('images', 'BBBC000_images'), ('labels', 'BBBC000_labels'), ('images', 'subset_images')]
+    assert listed == ['images', 'gt']
+
+    with pytest.raises(ValueError):
+        compile_plan({'entries': [{'dataset': 0, 'export': {}}, {'dataset': 0, 'export': {'format': 'raw'}}]})
+    with pytest.raises(ValueError):
+        compile_plan({'entries': [{'dataset': 0, 'rexx': 'a'}]})
+    with pytest.raises(ValueError):
+        compile_plan({'entries': [{'dataset': 0, 'cache': True}]})
+
+
+def test_run_manifest(site, monkeypatch):
+    ds, workdir, listed = site
+    path = write_manifest(workdir, MANIFEST)
+    outdir = os.path.join(workdir, 'out')
+
+    plan = run_manifest(path)
+    assert sorted(os.path.basename(item) for item in plan['written']) == \
+        ['BBBC000_images.npz', 'BBBC000_labels.npz', 'subset_images.raw']
+    for name in ('BBBC000_images.json', 'BBBC000_labels.json', 'subset_images.json', 'b3get.lock'):
+        assert os.path.isfile(os.path.join(outdir, name))
+    with open(os.path.join(outdir, 'subset_images.json')) as fi:
+        assert [item['file'] for item in json.load(fi)['sources']] == ['a.zip']
+    assert os.path.isfile(stamp_location(path))
+    before = dict((item, os.stat(item).st_mtime_ns) for item in plan['written'])
+
+    # the second run neither lists, downloads nor exports anything
+    monkeypatch.setattr('b3get.manifest.pull_many', lambda *args, **kwargs: 1/0)
+    plan = run_manifest(path)
+    assert listed == ['images', 'gt']
+    assert dict((item, os.stat(item).st_mtime_ns) for item in plan['written']) == before
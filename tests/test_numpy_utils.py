@@ -1,9 +1,10 @@
+import json
 import numpy as np
 import os
 import pytest
 import tempfile
 
-from b3get.utils import chunk_npz
+from b3get.stores import chunk_npz, npz_writer, plan_shards, interleave_plan, benchmark_codecs, raw_writer, open_raw
 
 @pytest.fixture
 def list_of_ndarrays():
@@ -144,3 +145,203 @@ def test_with_quarter_gb():
     assert back[backf[-1]].shape == list_of_ndarrays[-1].shape
     assert np.all(back[backf[-1]] == list_of_ndarrays[-1])
     [os.remove(f) for f in files]
+
+
+def test_npz_writer_single(list_of_ndarrays):
+    tmpf = tempfile.mktemp()
+    with npz_writer(tmpf) as writer:
+        for item in list_of_ndarrays:
+            writer.append(item)
+    assert writer.files == [tmpf + '.npz']
+
+    npt = np.load(writer.files[0])
+    assert len(npt.files) == 16
+    assert np.array_equal(npt['arr_15'], list_of_ndarrays[15])
+    [os.remove(f) for f in writer.files]
+
+
+def test_npz_writer_in_chunks(list_of_ndarrays):
+    tmpf = tempfile.mktemp()
+    with npz_writer(tmpf, .5) as writer:
+        for item in list_of_ndarrays:
+            writer.append(item)
+    files = writer.files
+    assert len(files) == 8
+    assert files[0] == tmpf + '0.npz'
+    assert not os.path.exists(tmpf + '.part0.npz')
+
+    seen = []
+    for fname in files:
+        npt = np.load(fname)
+        assert len(npt.files) == 2
+        seen.extend(npt['arr_{0}'.format(i)] for i in range(2))
+    assert all(np.array_equal(a, b) for a, b in zip(seen, list_of_ndarrays))
+    [os.remove(f) for f in files]
+
+
+def test_plan_shards_greedy():
+    sizes = [4, 4, 4, 4, 1, 1, 10]
+    assert plan_shards(sizes, 8) == [[0, 1], [2, 3], [4, 5], [6]]
+    assert plan_shards(sizes, 8, tolerance=0.25) == [[0, 1], [2, 3, 4, 5], [6]]
+    assert interleave_plan(plan_shards(sizes, 8, tolerance=0.25)) == [0, 2, 6, 1, 3, 4, 5]
+
+
+def test_plan_shards_balanced():
+    sizes = [9, 1, 5, 5, 2, 8, 3, 7]
+    shards = plan_shards(sizes, 10, method='balanced')
+    assert sorted(idx for shard in shards for idx in shard) == list(range(len(sizes)))
+    loads = [sum(sizes[idx] for idx in shard) for shard in shards]
+    assert len(shards) == 4
+    assert max(loads) - min(loads) <= 1
+
+
+def test_in_chunks_keeps_last_array():
+    ndalist = [np.full((64, 64), idx, dtype='uint8') for idx in range(5)]
+    tmpf = tempfile.mktemp()
+    files = chunk_npz(ndalist, tmpf, 2*64*64/(1024.*1024.), tolerance=0.)
+    assert len(files) == 3
+    last = np.load(files[-1])
+    assert len(last.files) == 1
+    assert np.all(last['arr_0'] == 4)
+    [os.remove(f) for f in files]
+    os.remove(tmpf + '.json')
+
+
+def test_in_chunks_index(list_of_ndarrays):
+    tmpf = tempfile.mktemp()
+    sized = list_of_ndarrays[:3] + [np.ones((512, 512), dtype='uint32')]
+    files = chunk_npz(sized, tmpf, 1, method='balanced')
+    with open(tmpf + '.json') as fi:
+        index = json.load(fi)
+
+    assert index['format'] == 'npz'
+    assert [shard['file'] for shard in index['shards']] == [os.path.basename(f) for f in files]
+    entries = [entry for shard in index['shards'] for entry in shard['arrays']]
+    assert sorted(entry['index'] for entry in entries) == [0, 1, 2, 3]
+    for shard, fname in zip(index['shards'], files):
+        npt = np.load(fname)
+        offset = 0
+        for entry in shard['arrays']:
+            assert entry['offset'] == offset
+            assert np.array_equal(npt[entry['name']], sized[entry['index']])
+            assert entry['shape'] == list(sized[entry['index']].shape)
+            assert np.dtype(entry['dtype']) == sized[entry['index']].dtype
+            offset += entry['nbytes']
+    [os.remove(f) for f in files]
+    os.remove(tmpf + '.json')
+
+
+def test_npz_writer_with_plan(list_of_ndarrays):
+    tmpf = tempfile.mktemp()
+    plan = plan_shards([item.nbytes for item in list_of_ndarrays], 1024*1024, method='balanced')
+    with npz_writer(tmpf, 1, plan=plan) as writer:
+        for item in list_of_ndarrays:
+            writer.append(item)
+    assert len(writer.files) == len(plan) == 4
+
+    with open(writer.index_file) as fi:
+        index = json.load(fi)
+    for shard, indices, fname in zip(index['shards'], plan, writer.files):
+        assert [entry['index'] for entry in shard['arrays']] == indices
+        npt = np.load(fname)
+        for entry in shard['arrays']:
+            assert np.array_equal(npt[entry['name']], list_of_ndarrays[entry['index']])
+    [os.remove(f) for f in writer.files]
+    os.remove(writer.index_file)
+
+
+def test_in_chunks_parallel_identical(list_of_ndarrays):
+    serial = chunk_npz(list_of_ndarrays, tempfile.mktemp(), .5)
+    parallel = chunk_npz(list_of_ndarrays, tempfile.mktemp(), .5, nprocs=4)
+    assert len(serial) == len(parallel) == 8
+    for a, b in zip(serial, parallel):
+        with open(a, 'rb') as fa, open(b, 'rb') as fb:
+            assert fa.read() == fb.read()
+    [os.remove(f) for f in serial + parallel]
+
+
+@pytest.mark.parametrize('method', ['greedy', 'balanced'])
+def test_npz_writer_parallel_identical(list_of_ndarrays, method):
+    plan = plan_shards([item.nbytes for item in list_of_ndarrays], 1024*1024, method=method)
+    written = []
+    for nprocs in (1, 4):
+        with npz_writer(tempfile.mktemp(), 1, plan=plan, nprocs=nprocs) as writer:
+            for item in list_of_ndarrays:
+                writer.append(item)
+        written.append(writer.files)
+    # appending round-robin over the shards gives the same shards
+    with npz_writer(tempfile.mktemp(), 1, plan=plan, nprocs=4) as writer:
+        for idx in interleave_plan(plan):
+            writer.append(list_of_ndarrays[idx], index=idx)
+    written.append(writer.files)
+
+    for a, b, c in zip(*written):
+        with open(a, 'rb') as fa, open(b, 'rb') as fb, open(c, 'rb') as fc:
+            assert fa.read() == fb.read() == fc.read()
+    [os.remove(f) for f in written[0] + written[1] + written[2]]
+
+
+@pytest.mark.parametrize('codec,level', [('stored', None), ('zlib', 1), ('zlib', 9), ('bz2', 9), ('lzma', None)])
+def test_in_chunks_codecs(list_of_ndarrays, codec, level):
+    tmpf = tempfile.mktemp()
+    files = chunk_npz(list_of_ndarrays, tmpf, 2, codec=codec, level=level)
+    assert len(files) == 2
+    npt = np.load(files[-1])
+    assert np.array_equal(npt['arr_7'], list_of_ndarrays[-1])
+
+    with open(tmpf + '.json') as fi:
+        index = json.load(fi)
+    assert index['codec'] == codec
+    assert index['level'] == level
+    if codec == 'stored':
+        assert os.stat(files[0]).st_size > 8*256*1024
+    [os.remove(f) for f in files]
+    os.remove(tmpf + '.json')
+
+
+def test_unknown_codec(list_of_ndarrays):
+    with pytest.raises(ValueError):
+        chunk_npz(list_of_ndarrays, tempfile.mktemp(), 2, codec='snappy')
+
+
+def test_benchmark_codecs(list_of_ndarrays):
+    results = benchmark_codecs(list_of_ndarrays[:4], codecs=('stored', 'zlib'))
+    assert [res['codec'] for res in results] == ['stored', 'zlib']
+    assert results[0]['ratio'] < 1.01
+    assert results[1]['ratio'] > 10
+    assert all(res['throughput'] > 0 for res in results)
+
+
+def test_raw_writer_roundtrip():
+    arrays = [np.full((7, 5), idx, dtype='uint8') for idx in range(6)] + [np.arange(10, dtype='float64')]
+    tmpf = tempfile.mktemp()
+    with raw_writer(tmpf, 100/(1024.*1024.), tolerance=0.) as writer:
+        for item in arrays:
+            writer.append(item)
+    assert len(writer.files) == 4
+    assert writer.files[0].endswith('0.raw')
+
+    with open(writer.index_file) as fi:
+        index = json.load(fi)
+    assert index['format'] == 'raw'
+    for shard in index['shards']:
+        assert all(entry['offset'] % 64 == 0 for entry in shard['arrays'])
+
+    loaded = open_raw(writer.index_file)
+    assert len(loaded) == len(arrays)
+    for view, item in zip(loaded, arrays):
+        assert isinstance(view, np.memmap)
+        assert view.dtype == item.dtype
+        assert np.array_equal(view, item)
+    del loaded
+    [os.remove(f) for f in writer.files]
+    os.remove(writer.index_file)
+
+
+def test_open_raw_rejects_npz(list_of_ndarrays):
+    tmpf = tempfile.mktemp()
+    files = chunk_npz(list_of_ndarrays, tmpf, 0)
+    with pytest.raises(ValueError):
+        open_raw(tmpf + '.json')
+    [os.remove(f) for f in files]
+    os.remove(tmpf + '.json')
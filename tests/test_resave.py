@@ -0,0 +1,112 @@
+import json
+import numpy as np
+import os
+import pytest
+import shutil
+import tempfile
+import tifffile
+import time
+import zipfile
+
+import b3get
+from b3get.utils import byte_lru_cache
+
+
+def write_zip(basedir, name, values):
+    """ zip one 32x32 uint16 tif per entry of <values> into <basedir>/<name>.zip """
+    dst = os.path.join(basedir, name+'.zip')
+    with zipfile.ZipFile(dst, 'w') as zf:
+        for value in values:
+            fname = os.path.join(basedir, 'tmp.tif')
+            tifffile.imwrite(fname, np.full((32, 32), value, dtype='uint16'))
+            zf.write(fname, '{0}/img_{1:03}.tif'.format(name, value % 100))
+            os.remove(fname)
+    # the archive is newer than anything extracted from it before
+    stamp = time.time() + len(os.listdir(basedir))
+    os.utime(dst, (stamp, stamp))
+    return dst
+
+
+@pytest.fixture
+def workdir(offline_dataset):
+    basedir = tempfile.mkdtemp()
+    yield offline_dataset(), basedir
+    shutil.rmtree(basedir)
+
+
+def mtimes(files):
+    return [os.stat(item).st_mtime_ns for item in files]
+
+
+def test_resave_is_incremental(workdir):
+    ds, basedir = workdir
+    zips = [write_zip(basedir, 'a', range(0, 4)), write_zip(basedir, 'b', range(4, 8))]
+    basename = os.path.join(basedir, 'BBBC000_images')
+    max_megabytes = 4*32*32*2/(1024.*1024.)
+
+    files = ds.zips_to_shards(zips, basename, 'npz', max_megabytes, tolerance=0.)
+    assert len(files) == 2
+    with open(basename+'.json') as fi:
+        index = json.load(fi)
+    assert [item['file'] for item in index['sources']] == ['a.zip', 'b.zip']
+    assert index['parameters']['format'] == 'npz'
+    assert index['shards'][0]['arrays'][0]['source'] == 'img_000.tif'
+    before = mtimes(files + [basename+'.json'])
+
+    # nothing changed: nothing is extracted, decoded or written
+    time.sleep(0.01)
+    assert ds.zips_to_shards(zips, basename, 'npz', max_megabytes, tolerance=0.) == files
+    assert mtimes(files + [basename+'.json']) == before
+
+    # one archive changed: only its shard is written again
+    zips[1] = write_zip(basedir, 'b', range(104, 108))
+    assert ds.zips_to_shards(zips, basename, 'npz', max_megabytes, tolerance=0.) == files
+    after = mtimes(files)
+    assert after[0] == before[0]
+    assert after[1] != before[1]
+
+    seq = b3get.load(basename, cache=byte_lru_cache())
+    assert [int(item[0, 0]) for item in seq[:]] == [0, 1, 2, 3, 104, 105, 106, 107]
+
+    # different parameters: everything is written again
+    ds.zips_to_shards(zips, basename, 'npz', max_megabytes, tolerance=0., writer_options={'codec': 'stored'})
+    assert mtimes(files)[0] != before[0]
+
+
+def test_resave_removes_stale_shards(workdir):
+    ds, basedir = workdir
+    zips = [write_zip(basedir, 'a', range(0, 8))]
+    basename = os.path.join(basedir, 'BBBC000_images')
+    max_megabytes = 4*32*32*2/(1024.*1024.)
+
+    files = ds.zips_to_shards(zips, basename, 'raw', max_megabytes, tolerance=0.)
+    assert len(files) == 2
+
+    zips = [write_zip(basedir, 'a', range(0, 4))]
+    again = ds.zips_to_shards(zips, basename, 'raw', max_megabytes, tolerance=0.)
+    assert again == [basename+'.raw']
+    assert not any(os.path.exists(item) for item in files)
+    assert len(b3get.load(basename)) == 4
+
+
+@pytest.mark.parametrize('nprocs', [1, 2])
+def test_interrupted_resave_is_rebuilt(workdir, monkeypatch, nprocs):
+    ds, basedir = workdir
+    zips = [write_zip(basedir, 'a', range(0, 4))]
+    basename = os.path.join(basedir, 'BBBC000_images')
+    read_file = ds.read_file
+
+    def interrupted(fname, **kwargs):
+        if fname.endswith('img_002.tif'):
+            raise KeyboardInterrupt()
+        return read_file(fname, **kwargs)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(ds, 'read_file', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            ds.zips_to_shards(zips, basename, 'npz', nprocs=nprocs)
+    assert sorted(os.listdir(basedir)) == ['a', 'a.zip']
+
+    files = ds.zips_to_shards(zips, basename, 'npz', nprocs=nprocs)
+    assert files == [basename+'.npz']
+    assert [int(item[0, 0]) for item in b3get.load(basename)[:]] == [0, 1, 2, 3]
@@ -0,0 +1,95 @@
+import numpy as np
+import os
+import pytest
+import tempfile
+import shutil
+import tifffile
+
+from b3get.utils import sample_key, pair_files, byte_lru_cache
+from b3get.datasets import sample_index
+
+
+@pytest.fixture
+def tif_pairs():
+    basedir = tempfile.mkdtemp()
+    imgdir = os.path.join(basedir, 'images')
+    labdir = os.path.join(basedir, 'labels')
+    os.makedirs(imgdir)
+    os.makedirs(labdir)
+
+    images, labels = [], []
+    for idx in range(4):
+        img = os.path.join(imgdir, 'sample_{0}.tif'.format(idx))
+        lab = os.path.join(labdir, 'sample_{0}.tif'.format(3 - idx))
+        tifffile.imwrite(img, np.full((8, 8), idx, dtype='uint16'))
+        tifffile.imwrite(lab, np.full((8, 8), 3 - idx, dtype='uint8'))
+        images.append(img)
+        labels.append(lab)
+
+    yield images, labels
+    shutil.rmtree(basedir)
+
+
+def test_sample_key():
+    assert sample_key('/some/where/a01_s1.tif') == 'a01_s1'
+    assert sample_key('/some/where/a01_s1_w1.tif', r'(a\d+_s\d+)') == 'a01_s1'
+    assert sample_key('/some/where/a01_s1_w1.tif', r'a\d+') == 'a01'
+    assert sample_key('/some/where/b01.tif', r'a\d+') is None
+
+
+def test_pair_files_reversed_order(tif_pairs):
+    images, labels = tif_pairs
+    pairs = pair_files(images, labels)
+    assert len(pairs) == 4
+    for img, lab in pairs:
+        assert os.path.basename(img) == os.path.basename(lab)
+
+
+def test_pair_files_drops_unmatched(tif_pairs):
+    images, labels = tif_pairs
+    pairs = pair_files(images, labels[:2])
+    assert len(pairs) == 2
+
+
+def test_lru_cache_evicts_oldest():
+    cache = byte_lru_cache(max_bytes=3*1024)
+    for idx in range(3):
+        cache.put(idx, np.zeros(1024, dtype='uint8'))
+    assert len(cache) == 3
+    assert cache.get(0) is not None  # 0 is now the most recent
+
+    cache.put(3, np.zeros(1024, dtype='uint8'))
+    assert 1 not in cache
+    assert 0 in cache
+    assert cache.nbytes == 3*1024
+
+    cache.put(4, np.zeros(4*1024, dtype='uint8'))
+    assert 4 not in cache
+    assert cache.nbytes == 3*1024
+
+
+def test_sample_index(tif_pairs):
+    images, labels = tif_pairs
+    cache = byte_lru_cache()
+    idx = sample_index(images, labels, cache=cache)
+    assert len(idx) == 4
+
+    img, lab = idx[2]
+    assert img.dtype == np.uint16
+    assert lab.dtype == np.uint8
+    assert np.all(img == 2)
+    assert np.all(lab == 2)
+    assert len(cache) == 2
+
+    again, _ = idx[2]
+    assert again is img
+
+    # the cached arrays are shared with every other index, so they can't be changed in place
+    with pytest.raises(ValueError):
+        img += 7
+    augmented = img + 7
+    assert np.all(sample_index(images, labels, cache=cache)[2][0] == 2)
+    assert np.all(augmented == 9)
+
+    assert len(idx[1:3]) == 2
+    assert np.all(idx[-1][0] == 3)
@@ -0,0 +1,107 @@
+import numpy as np
+import os
+import pytest
+import tempfile
+import shutil
+import tifffile
+
+from b3get.utils import read_tiff, tiff_shape, spill_file, memory_stage
+
+
+@pytest.fixture(params=[None, 'zlib'])
+def a_stack(request):
+    basedir = tempfile.mkdtemp()
+    volume = np.arange(8*16*12, dtype='uint16').reshape(8, 16, 12)
+    fname = os.path.join(basedir, 'stack.tif')
+    tifffile.imwrite(fname, volume, photometric='minisblack', compression=request.param)
+    yield fname, volume
+    shutil.rmtree(basedir)
+
+
+def test_read_full(a_stack):
+    fname, volume = a_stack
+    assert np.array_equal(read_tiff(fname), volume)
+
+
+def test_read_pages(a_stack):
+    fname, volume = a_stack
+    assert np.array_equal(read_tiff(fname, pages=3), volume[3])
+    assert np.array_equal(read_tiff(fname, pages=slice(2, 5)), volume[2:5])
+    assert np.array_equal(read_tiff(fname, pages=[1, 6]), volume[[1, 6]])
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_read_single_page(compression):
+    basedir = tempfile.mkdtemp()
+    image = np.arange(16*12, dtype='uint16').reshape(16, 12)
+    fname = os.path.join(basedir, 'image.tif')
+    tifffile.imwrite(fname, image, photometric='minisblack', compression=compression)
+    for pages in (0, [0], slice(0, 1)):
+        value = read_tiff(fname, pages=pages, roi=((2, 10),))
+        assert np.array_equal(value, image[2:10])
+        assert tiff_shape(fname, pages=pages, roi=((2, 10),)) == (value.shape, value.dtype)
+    shutil.rmtree(basedir)
+
+
+def test_read_roi_2d(a_stack):
+    fname, volume = a_stack
+    value = read_tiff(fname, pages=slice(0, 4), roi=((2, 10), (3, 7)))
+    assert value.shape == (4, 8, 4)
+    assert np.array_equal(value, volume[:4, 2:10, 3:7])
+
+
+def test_read_roi_3d(a_stack):
+    fname, volume = a_stack
+    value = read_tiff(fname, roi=(slice(1, 5), slice(0, 4), (6, 12)))
+    assert value.shape == (4, 4, 6)
+    assert np.array_equal(value, volume[1:5, :4, 6:])
+    assert not isinstance(value, np.memmap)
+
+
+def test_tiff_shape(a_stack):
+    fname, volume = a_stack
+    assert tiff_shape(fname) == (volume.shape, volume.dtype)
+    assert tiff_shape(fname, pages=3)[0] == volume[3].shape
+    assert tiff_shape(fname, pages=[1, 6], roi=((2, 10), (3, 7)))[0] == volume[[1, 6], 2:10, 3:7].shape
+    assert tiff_shape(fname, roi=(slice(1, 5), slice(0, 4), (6, 12)))[0] == (4, 4, 6)
+
+
+def test_spill_file():
+    basedir = tempfile.mkdtemp()
+    store = spill_file(os.path.join(basedir, 'arrays.spill'), 2*(100*2 + 3*4), narrays=4)
+    arrays = [np.arange(100, dtype='uint16'), np.ones((3,), dtype='float32')]*2
+    views = [store.store(item) for item in arrays]
+    for view, item in zip(views, arrays):
+        assert isinstance(view, np.memmap)
+        assert view.dtype == item.dtype
+        assert np.array_equal(view, item)
+    with pytest.raises(RuntimeError):
+        store.store(np.ones(1024, dtype='uint8'))
+    del views, store
+    shutil.rmtree(basedir)
+
+
+def test_files_to_numpy_spills(a_stack, offline_dataset):
+    fname, volume = a_stack
+    ds = offline_dataset()
+
+    with pytest.raises(ValueError):
+        ds.files_to_numpy([fname], scaling='min-max')
+    in_memory = ds.files_to_numpy([fname], max_memory=volume.nbytes)
+    assert not isinstance(in_memory[0], np.memmap)
+
+    spilled = ds.files_to_numpy([fname], max_memory=volume.nbytes//2 - 1, pages=slice(0, 8, 2))
+    assert isinstance(spilled[0], np.memmap)
+    assert np.array_equal(spilled[0], volume[::2])
+    assert [name for name in os.listdir(ds.tmp_location) if name.endswith('.spill')] == []
+    del spilled
+
+
+def test_memory_stage():
+    with memory_stage('allocate') as stage:
+        value = np.ones(1024*1024, dtype='uint8')
+    assert stage.peak >= value.nbytes
+
+    with memory_stage('silent', report=False) as stage:
+        value = np.ones(1024*1024, dtype='uint8')
+    assert stage.peak == 0
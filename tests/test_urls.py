@@ -1,11 +1,9 @@
-from __future__ import print_function, with_statement
-
 import os
 import shutil
 import requests
-import six
 from bs4 import BeautifulSoup
-from b3get.utils import tmp_location, size_of_content, serial_download_file
+from b3get.utils import tmp_location
+from b3get.download import size_of_content, serial_download_file
 from io import BytesIO
 
 main_url = "https://data.broadinstitute.org/bbbc/image_sets.html"
@@ -68,10 +66,7 @@ def test_manually_size_of_content():
     r = requests.head(url)
     assert r.ok
     assert r.headers
-    if six.PY2:
-        assert "content-length" in [item.lower() for item in r.headers.keys()]
-    else:
-        assert "content-length" in r.headers.keys()
+    assert "content-length" in r.headers.keys()
     assert r.headers.get("content-length")
     assert int(r.headers.get("content-length")) > 0
     assert int(r.headers.get("content-length")) == 484995
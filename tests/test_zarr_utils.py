@@ -0,0 +1,90 @@
+import json
+import numpy as np
+import os
+import pytest
+import shutil
+import tempfile
+
+from b3get.stores import zarr_writer, zarr_array, open_zarr
+
+
+@pytest.fixture
+def a_volume():
+    return np.random.RandomState(13).randint(0, 1000, size=(20, 33, 17)).astype('uint16')
+
+
+@pytest.mark.parametrize('codec', ['stored', 'zlib', 'bz2', 'lzma'])
+def test_zarr_roundtrip(a_volume, codec):
+    basedir = tempfile.mkdtemp()
+    basename = os.path.join(basedir, 'BBBC000_images')
+    with zarr_writer(basename, chunks=(8, 8, 8), codec=codec, nprocs=3) as writer:
+        writer.append(a_volume)
+        writer.append(a_volume[0])
+    assert writer.files == [basename + '.zarr']
+
+    with open(os.path.join(basename + '.zarr', '0', '.zarray')) as fi:
+        meta = json.load(fi)
+    assert meta['chunks'] == [8, 8, 8]
+    assert meta['dtype'] == '<u2'
+    assert len(os.listdir(os.path.join(basename + '.zarr', '0'))) == 3*5*3 + 1
+
+    arrays = open_zarr(basename + '.zarr')
+    assert len(arrays) == 2
+    assert arrays[0].shape == a_volume.shape
+    assert arrays[1].chunks == (8, 8)
+    assert np.array_equal(arrays[0][:], a_volume)
+    assert np.array_equal(arrays[1][:], a_volume[0])
+    shutil.rmtree(basedir)
+
+
+def test_zarr_regions(a_volume):
+    basedir = tempfile.mkdtemp()
+    with zarr_writer(os.path.join(basedir, 'vol'), chunks=(8, 8, 8)) as writer:
+        writer.append(a_volume)
+
+    vol = zarr_array(os.path.join(basedir, 'vol.zarr', '0'))
+    for key in [(slice(3, 12), slice(7, 30), slice(0, 5)),
+                (4, slice(None), 16),
+                (-1,),
+                (slice(None, None, 3), slice(30, 2, -4)),
+                (slice(5, 5),)]:
+        assert np.array_equal(vol[key], a_volume[key]), key
+
+    with pytest.raises(IndexError):
+        vol[20]
+    shutil.rmtree(basedir)
+
+
+def test_zarr_missing_chunks_are_filled(a_volume):
+    basedir = tempfile.mkdtemp()
+    with zarr_writer(os.path.join(basedir, 'vol'), chunks=(10, 33, 17)) as writer:
+        writer.append(a_volume)
+    os.remove(os.path.join(basedir, 'vol.zarr', '0', '1.0.0'))
+
+    vol = open_zarr(os.path.join(basedir, 'vol.zarr', '0'))
+    assert np.array_equal(vol[:10], a_volume[:10])
+    assert np.all(vol[10:] == 0)
+    shutil.rmtree(basedir)
+
+
+def test_zarr_rewrite_replaces_store(a_volume):
+    basedir = tempfile.mkdtemp()
+    basename = os.path.join(basedir, 'vol')
+    with zarr_writer(basename) as writer:
+        for item in a_volume[:3]:
+            writer.append(item)
+    with zarr_writer(basename) as writer:
+        writer.append(a_volume[3])
+        writer.append(a_volume[4])
+    arrays = open_zarr(basename + '.zarr')
+    assert len(arrays) == 2
+    assert np.array_equal(arrays[0][:], a_volume[3])
+
+    # a failing export leaves the previous store as it is
+    with pytest.raises(RuntimeError):
+        with zarr_writer(basename) as writer:
+            writer.append(a_volume[0])
+            raise RuntimeError('unreadable image')
+    assert len(open_zarr(basename + '.zarr')) == 2
+    assert sorted(os.listdir(basedir)) == ['vol.json', 'vol.zarr']
+    shutil.rmtree(basedir)
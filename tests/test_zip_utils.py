@@ -4,7 +4,9 @@ import pytest
 import tempfile
 import zipfile
 import shutil
+import tifffile
 from b3get.utils import unzip_to
+from b3get.download import describe_zip
 
 
 @pytest.fixture
@@ -114,3 +116,36 @@ def test_unzip_twice_impartial(azipfile):
     os.remove(zf)
     [ os.remove(c) for c in src_files ]
     shutil.rmtree(somedir)
+
+
+@pytest.fixture(params=[zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def atifzip(request):
+    basedir = tempfile.mkdtemp()
+    fname = os.path.join(basedir, 'stack.tif')
+    tifffile.imwrite(fname, np.zeros((4, 32, 16), dtype='uint16'), photometric='minisblack')
+
+    zip_path = os.path.join(basedir, 'stack_images.zip')
+    with zipfile.ZipFile(zip_path, 'w', request.param) as zf:
+        zf.write(fname, arcname='images/stack.tif')
+        zf.writestr('__MACOSX/images/._stack.tif', 'resource fork')
+        zf.writestr('images/README.txt', 'no image')
+    yield zip_path
+    shutil.rmtree(basedir)
+
+
+def test_describe_zip(atifzip):
+    entries = describe_zip(atifzip)
+    assert len(entries) == 1
+    entry = entries[0]
+    assert entry['name'] == 'images/stack.tif'
+    assert entry['shape'] == (4, 32, 16)
+    assert entry['dtype'] == 'uint16'
+    assert entry['decoded_size'] == 4*32*16*2
+    assert entry['compressed_size'] > 0
+
+
+def test_describe_zip_fileobj(atifzip):
+    with open(atifzip, 'rb') as fo:
+        entries = describe_zip(fo)
+    assert len(entries) == 1
+    assert entries[0]['shape'] == (4, 32, 16)